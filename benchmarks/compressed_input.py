@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+''' Compare network ingest throughput from plain and compressed distance files '''
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from hivclustering import *
+from hivclustering.ingest import _openers
+
+
+def write_distance_file(path, line_count, node_count):
+    with open(path, 'w') as fh:
+        print("ID1,ID2,Distance", file=fh)
+        for k in range(line_count):
+            print("S%d,S%d,%.6f" % (random.randint(1, node_count), random.randint(1, node_count), random.random() * 0.02), file=fh)
+
+
+def time_ingest(path, threshold):
+    network = transmission_network()
+    start = time.perf_counter()
+    network.read_from_csv_file(path, parsePlain, threshold)
+    return time.perf_counter() - start, len(network.edges)
+
+
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser(description='Benchmark reading compressed distance files.')
+    arguments.add_argument('-l', '--lines', help='Number of ID1,ID2,distance lines', type=int, default=1000000)
+    arguments.add_argument('-n', '--nodes', help='Number of distinct sequence IDs', type=int, default=100000)
+    arguments.add_argument('-t', '--threshold', help='Distance threshold', type=float, default=0.015)
+    arguments.add_argument('-r', '--replicates', help='Time each format this many times (report the fastest)', type=int, default=3)
+    settings = arguments.parse_args()
+
+    random.seed(1)
+    directory = tempfile.mkdtemp()
+    try:
+        plain = os.path.join(directory, 'distances.csv')
+        write_distance_file(plain, settings.lines, settings.nodes)
+        files = {'plain': plain}
+        for extension, opener in _openers.items():
+            files[extension] = plain + extension
+            with open(plain, 'rb') as source, opener(files[extension], 'wb') as target:
+                shutil.copyfileobj(source, target, 1 << 20)
+
+        print("\t".join(['Format', 'MB on disk', 'Seconds', 'Lines/s', 'Relative to plain']))
+        baseline = None
+        for label, path in files.items():
+            elapsed = min(time_ingest(path, settings.threshold)[0] for k in range(settings.replicates))
+            baseline = elapsed if baseline is None else baseline
+            print("\t".join([label, "%.1f" % (os.path.getsize(path) / 2**20), "%.2f" % elapsed,
+                             "%.0f" % (settings.lines / elapsed), "%.2f" % (elapsed / baseline)]))
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(directory)
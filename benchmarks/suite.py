@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+''' Time the main network operations on synthetic networks of increasing size.
+
+    run:      suite.py run -s 1000 10000 100000 -o results.json
+    compare:  suite.py compare baseline.json results.json -t 0.25
+
+    Networks come from the generators in transmission_network: a preferential attachment
+    forest (create_a_pref_attachment_network) or a random tree (create_a_random_network),
+    with extra random edges (generate_random_edges) to close cycles and triangles. None of
+    the stages need HyPhy. compare exits with status 1 if any stage is slower than in the
+    baseline by more than the tolerance.
+
+    Startup cost (the time to import the package and to run hivnetworkcsv --help in a new
+    interpreter) is recorded under the 'startup' generator.
+
+    writers.py and compressed_input.py in this directory time the writers and compressed
+    ingest in more detail.
+'''
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from hivclustering import *
+from hivclustering.networkbuild import write_network_json
+
+#-------------------------------------------------------------------------------
+
+
+def make_network(generator, size, extra_edges):
+    network = transmission_network()
+    if generator == 'preferential':
+        network.create_a_pref_attachment_network(network_size=size, start_with=max(1, size // 1000), start_new_tree=0.05)
+    else:
+        network.create_a_random_network(network_size=size)
+    network.generate_random_edges(int(size * extra_edges), use_preferential_attachment=generator == 'preferential')
+    network.clear_adjacency()
+    return network
+
+
+def timed(call, *args, **kwargs):
+    start = time.perf_counter()
+    result = call(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def writer_stages(network, directory):
+    ''' (name, callable) for every writer; each callable writes to a file in directory '''
+
+    def to_file(writer, *args):
+        def write():
+            with open(os.path.join(directory, 'output'), 'w') as fh:
+                writer(fh, *args)
+        return write
+
+    return [('generate_dot', to_file(network.generate_dot)),
+            ('generate_delimited', to_file(network.generate_delimited)),
+            ('generate_csv', to_file(network.generate_csv)),
+            ('write_clusters', to_file(network.write_clusters)),
+            ('spool_pairwise_distances', to_file(network.spool_pairwise_distances)),
+            ('write_network_json', to_file(lambda fh: write_network_json(network, {}, fh))),
+            ('export_columnar', lambda: network.export_columnar(os.path.join(directory, 'output')))]
+
+
+def run_suite(generator, size, settings, directory):
+    random.seed(settings.seed)
+    results = []
+
+    def record(stage, seconds, count=None):
+        results.append({'generator': generator, 'size': size, 'stage': stage, 'seconds': seconds, 'count': count})
+        print("%s\t%d\t%s\t%.3f" % (generator, size, stage, seconds), file=sys.stderr)
+
+    seconds, network = timed(make_network, generator, size, settings.extra_edges)
+    record('generate', seconds, len(network.edges))
+
+    csv_path = os.path.join(directory, 'network.csv')
+    with open(csv_path, 'w') as fh:
+        network.generate_csv(fh)
+
+    def best_of(call, *args, **kwargs):
+        timings = [timed(call, *args, **kwargs) for k in range(settings.replicates)]
+        return min(t[0] for t in timings), timings[-1][1]
+
+    def wanted(stage):
+        return stage not in settings.skip
+
+    if wanted('read_from_csv_file'):
+        seconds, ingested = best_of(lambda: transmission_network().read_from_csv_file(csv_path, parsePlain))
+        record('read_from_csv_file', seconds)
+
+    network.clear_adjacency()
+    seconds, ignored = best_of(network.compute_clusters)
+    record('compute_clusters', seconds, len(network.retrieve_clusters(singletons=False)))
+
+    seconds, edge_set = best_of(network.reduce_edge_set)
+    record('reduce_edge_set', seconds, len(edge_set))
+
+    if wanted('get_degree_distribution'):
+        seconds, ignored = best_of(network.get_degree_distribution)
+        record('get_degree_distribution', seconds)
+
+    if wanted('find_all_triangles'):
+        seconds, triangles = best_of(network.find_all_triangles, edge_set, maximum_number=size * 10)
+        record('find_all_triangles', seconds, len(triangles[0]))
+
+    if wanted('clustering_coefficients'):
+        network.clear_adjacency()
+        network.compute_adjacency()
+        seconds, coefficients = best_of(network.clustering_coefficients)
+        record('clustering_coefficients', seconds, len(coefficients))
+
+    network.compute_clusters()
+    largest_cluster = max([len(c) for c in network.retrieve_clusters(singletons=False).values()] + [0])
+    if wanted('write_centralities'):
+        if largest_cluster <= settings.max_centrality_nodes:
+            seconds, ignored = best_of(network.write_centralities, io.StringIO())
+            record('write_centralities', seconds, largest_cluster)
+        else:
+            print("Skipping centralities: the largest cluster has %d nodes" % largest_cluster, file=sys.stderr)
+
+    for name, write in writer_stages(network, directory):
+        if wanted(name):
+            seconds, ignored = best_of(write)
+            record(name, seconds)
+
+    return results
+
+
+def startup_times(replicates):
+    ''' wall time of starting fresh interpreters which import the package, relative to a bare one '''
+    script = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'scripts', 'hivnetworkcsv')
+    commands = [('import hivclustering', ['-c', 'import hivclustering']),
+                ('import hivclustering.networkbuild', ['-c', 'import hivclustering.networkbuild']),
+                ('hivnetworkcsv --help', [script, '--help'])]
+
+    def best(arguments):
+        return min(timed(subprocess.run, [sys.executable] + arguments, stdout=subprocess.DEVNULL, check=True)[0]
+                   for k in range(max(3, replicates)))
+
+    bare = best(['-c', 'pass'])
+    results = []
+    for stage, arguments in commands:
+        seconds = max(0., best(arguments) - bare)
+        results.append({'generator': 'startup', 'size': 0, 'stage': stage, 'seconds': seconds, 'count': None})
+        print("startup\t%s\t%.3f" % (stage, seconds), file=sys.stderr)
+    return results
+
+
+def run(settings):
+    directory = tempfile.mkdtemp()
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 2 * max(settings.sizes)))
+    results = [] if 'startup' in settings.skip else startup_times(settings.replicates)
+    try:
+        for generator in settings.generators:
+            for size in settings.sizes:
+                results.extend(run_suite(generator, size, settings, directory))
+    finally:
+        shutil.rmtree(directory)
+
+    report = {'python': platform.python_version(), 'platform': platform.platform(), 'seed': settings.seed,
+              'replicates': settings.replicates, 'results': results}
+    json.dump(report, settings.output, indent=1)
+    settings.output.write('\n')
+
+#-------------------------------------------------------------------------------
+
+
+def compare(settings):
+    def keyed(report):
+        return {(r['generator'], r['size'], r['stage']): r['seconds'] for r in json.load(report)['results']}
+
+    baseline = keyed(settings.baseline)
+    current = keyed(settings.current)
+    slower = 0
+
+    print("\t".join(['Generator', 'Size', 'Stage', 'Baseline', 'Current', 'Ratio', '']))
+    for key in sorted(baseline.keys() & current.keys()):
+        ratio = current[key] / baseline[key] if baseline[key] > 0 else 1.
+        # very short stages are too noisy to flag
+        flagged = ratio > 1. + settings.tolerance and current[key] - baseline[key] > settings.minimum
+        slower += flagged
+        print("\t".join([key[0], str(key[1]), key[2], "%.3f" % baseline[key], "%.3f" % current[key], "%.2f" % ratio,
+                         'SLOWER' if flagged else '']))
+
+    for key in sorted(baseline.keys() ^ current.keys()):
+        print("%s %d %s is only in %s" % (key[0], key[1], key[2], 'the baseline' if key in baseline else 'the current results'), file=sys.stderr)
+
+    return 1 if slower else 0
+
+
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser(description='Benchmark network operations on synthetic networks.')
+    commands = arguments.add_subparsers(dest='command')
+    commands.required = True
+
+    run_arguments = commands.add_parser('run', help='Run the benchmarks and write the timings as JSON')
+    run_arguments.add_argument('-s', '--sizes', help='Network sizes (nodes)', type=int, nargs='+', default=[1000, 10000, 100000])
+    run_arguments.add_argument('-g', '--generators', help='Network generators', nargs='+', choices=['preferential', 'random'], default=['preferential', 'random'])
+    run_arguments.add_argument('-e', '--extra-edges', dest='extra_edges', help='Random edges to add, per node', type=float, default=0.1)
+    run_arguments.add_argument('-c', '--max-centrality-nodes', dest='max_centrality_nodes', help='Skip centralities (one breadth-first search per node) if the largest cluster has more nodes than this', type=int, default=2000)
+    run_arguments.add_argument('-x', '--skip', help='Do not time these stages (e.g. clustering_coefficients)', nargs='+', default=[])
+    run_arguments.add_argument('-r', '--replicates', help='Time each stage this many times (report the fastest)', type=int, default=1)
+    run_arguments.add_argument('--seed', help='Random seed', type=int, default=1)
+    run_arguments.add_argument('-o', '--output', help='Write the results here (default stdout)', type=argparse.FileType('w'), default=sys.stdout)
+
+    compare_arguments = commands.add_parser('compare', help='Flag stages which got slower between two result files')
+    compare_arguments.add_argument('baseline', type=argparse.FileType('r'))
+    compare_arguments.add_argument('current', type=argparse.FileType('r'))
+    compare_arguments.add_argument('-t', '--tolerance', help='Allowed relative slowdown', type=float, default=0.2)
+    compare_arguments.add_argument('-m', '--minimum', help='Ignore slowdowns shorter than this many seconds', type=float, default=0.01)
+
+    settings = arguments.parse_args()
+    if settings.command == 'run':
+        run(settings)
+    else:
+        sys.exit(compare(settings))
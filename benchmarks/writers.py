@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+''' Time the network writers (DOT, CSV, delimited, clusters, pairwise distances) on a large random network '''
+
+import argparse
+import os
+import random
+import sys
+import time
+
+from hivclustering import *
+
+
+def make_network(edge_count, node_count):
+    network = transmission_network()
+    for k in range(edge_count):
+        p1, p2 = random.sample(range(node_count), 2)
+        network.add_an_edge("S%d|%02d01%d" % (p1, 1 + p1 % 12, 2000 + p1 % 10),
+                            "S%d|%02d01%d" % (p2, 1 + p2 % 12, 2000 + p2 % 10), random.random() * 0.015, parseAEH)
+    network.compute_clusters()
+    return network
+
+
+def time_writer(writer, *args):
+    with open(os.devnull, 'w') as fh:
+        start = time.perf_counter()
+        writer(fh, *args)
+        return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser(description='Benchmark the network writers.')
+    arguments.add_argument('-e', '--edges', help='Number of edges', type=int, default=1000000)
+    arguments.add_argument('-n', '--nodes', help='Number of nodes', type=int, default=250000)
+    arguments.add_argument('-r', '--replicates', help='Time each writer this many times (report the fastest)', type=int, default=3)
+    settings = arguments.parse_args()
+
+    random.seed(1)
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), settings.nodes))
+    start = time.perf_counter()
+    network = make_network(settings.edges, settings.nodes)
+    print("Built a network with %d nodes and %d edges in %.1f s" % (len(network.nodes), len(network.edges), time.perf_counter() - start), file=sys.stderr)
+
+    writers = {'generate_dot': (network.generate_dot,),
+               'generate_dot (year_vis)': (network.generate_dot, 2005),
+               'generate_delimited': (network.generate_delimited,),
+               'generate_csv': (network.generate_csv,),
+               'write_clusters': (network.write_clusters,),
+               'spool_pairwise_distances': (network.spool_pairwise_distances,)}
+
+    print("\t".join(['Writer', 'Seconds', 'Edges/s']))
+    for label, call in writers.items():
+        elapsed = min(time_writer(*call) for k in range(settings.replicates))
+        print("\t".join([label, "%.2f" % elapsed, "%.0f" % (len(network.edges) / elapsed)]))
+        sys.stdout.flush()
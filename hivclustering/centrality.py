@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+
+''' Per-cluster node centralities and shortest path lengths, computed in parallel.
+
+    Each cluster is independent, so cluster_centralities hands clusters to the shared
+    executor (largest first, since a few large clusters take most of the time) and the
+    workers read the network from shared memory (sharednetwork) instead of receiving
+    pickled patient and edge objects. Large clusters are further split into blocks of
+    source nodes, since the contributions of different sources simply add up.
+
+    From each source, path lengths come from a breadth-first search (hops) or, with
+    weights (genetic distances), from Dijkstra's algorithm on a binary heap, and
+    betweenness from Brandes' accumulation of pair dependencies over the same search.
+    This is O(nodes * edges) per cluster (times log(nodes) with weights) instead of the
+    O(nodes^3) Floyd-Warshall matrices and path enumeration of
+    compute_shortest_paths_with_reconstruction.
+
+    The values are those of transmission_network.compute_path_stat and
+    betweenness_centrality: the mean length of the shortest paths from a node to the other
+    nodes of its cluster, and the fraction of shortest paths between ordered pairs of other
+    nodes which pass through it, divided by (n - 1)(n - 2). Closeness is that of Wasserman
+    and Faust, (r / (n - 1)) * (r / sum of the lengths of the paths to the r nodes a node can
+    reach), which is 1 / mean path length in a connected graph; harmonic centrality is the
+    sum of 1 / path length over the other nodes, divided by (n - 1). Both are 0 for a node
+    which reaches no other node.
+
+    closeness_sums computes only closeness and harmonic centrality. On graphs with a small
+    diameter it runs the searches from a block of sources at once, level by level, with one
+    Python integer per node as the bitset of sources which have reached it; since paths are
+    undirected, the new bits of a node at level L add L to its own sum of path lengths.
+'''
+
+import heapq
+
+import numpy as np
+
+from .executor import get_executor
+from .sharednetwork import attach_worker, detach_worker, worker_view
+
+__all__ = ['dense_limit', 'bitset_diameter', 'single_source', 'source_contributions', 'path_centralities', 'path_length_rows',
+           'shortest_path_lengths', 'estimated_diameter', 'closeness_sums', 'closeness_values', 'subset_closeness',
+           'cluster_centralities']
+
+# the largest number of nodes for which shortest_path_lengths builds a dense matrix
+dense_limit = 2048
+
+# clusters with more nodes than this are split into blocks of sources
+_split_above = 256
+
+# graphs whose (estimated) diameter is at most this are swept with bitset frontiers
+bitset_diameter = 64
+
+# sources per bitset sweep
+_bitset_block = 4096
+
+#-------------------------------------------------------------------------------
+
+
+def single_source(adjacency, source, weights=None):
+    ''' (nodes in order of distance, path lengths (-1 if unreachable), numbers of shortest
+        paths, predecessors on shortest paths) from source; hops unless weights are given
+    '''
+    node_count = len(adjacency)
+    lengths = [-1] * node_count
+    paths = [0] * node_count
+    predecessors = [[] for k in range(node_count)]
+    lengths[source] = 0
+    paths[source] = 1
+
+    if weights is None:
+        order = [source]
+        for node in order:
+            next_length = lengths[node] + 1
+            for neighbor in adjacency[node]:
+                if lengths[neighbor] < 0:
+                    lengths[neighbor] = next_length
+                    order.append(neighbor)
+                if lengths[neighbor] == next_length:
+                    paths[neighbor] += paths[node]
+                    predecessors[neighbor].append(node)
+        return order, lengths, paths, predecessors
+
+    order = []
+    settled = [False] * node_count
+    heap = [(0., source)]
+    while heap:
+        length, node = heapq.heappop(heap)
+        if settled[node]:
+            continue
+        settled[node] = True
+        order.append(node)
+        for neighbor, weight in zip(adjacency[node], weights[node]):
+            if settled[neighbor]:
+                continue
+            candidate = length + weight
+            if lengths[neighbor] < 0 or candidate < lengths[neighbor]:
+                lengths[neighbor] = candidate
+                paths[neighbor] = paths[node]
+                predecessors[neighbor] = [node]
+                heapq.heappush(heap, (candidate, neighbor))
+            elif candidate == lengths[neighbor]:
+                paths[neighbor] += paths[node]
+                predecessors[neighbor].append(node)
+    return order, lengths, paths, predecessors
+
+
+def source_contributions(adjacency, sources, weights=None):
+    ''' for each source: the sum of the lengths of the paths to the nodes it reaches, the sum
+        of their reciprocals and the number of nodes it reaches; and betweenness summed over
+        these sources, unscaled
+    '''
+    node_count = len(adjacency)
+    path_sums = []
+    harmonic_sums = []
+    reached = []
+    betweenness = [0.] * node_count
+
+    for source in sources:
+        order, lengths, paths, predecessors = single_source(adjacency, source, weights)
+        path_sums.append(sum(lengths[k] for k in order))
+        harmonic_sums.append(sum(1. / lengths[k] for k in order if lengths[k] > 0))
+        reached.append(len(order) - 1)
+
+        dependency = [0.] * node_count
+        for node in reversed(order):
+            for predecessor in predecessors[node]:
+                dependency[predecessor] += paths[predecessor] / paths[node] * (1. + dependency[node])
+            if node != source:
+                betweenness[node] += dependency[node]
+
+    return path_sums, harmonic_sums, reached, betweenness
+
+
+def closeness_values(node_count, path_sums, harmonic_sums, reached):
+    ''' (closeness, harmonic centrality) lists from the sums over each node's paths '''
+    if node_count < 2:
+        return [0.] * node_count, [0.] * node_count
+    closeness = [r * r / (node_count - 1) / d if r and d else 0. for d, r in zip(path_sums, reached)]
+    return closeness, [h / (node_count - 1) for h in harmonic_sums]
+
+
+def _finish(node_count, path_sums, harmonic_sums, reached, betweenness):
+    if node_count > 1:
+        mean_paths = [s / (node_count - 1) if r == node_count - 1 else None for s, r in zip(path_sums, reached)]
+    else:
+        mean_paths = [None] * node_count
+    scale = 1. / ((node_count - 1) * (node_count - 2)) if node_count > 2 else 0.
+    return (mean_paths, [b * scale for b in betweenness]) + closeness_values(node_count, path_sums, harmonic_sums, reached)
+
+
+def path_centralities(adjacency, weights=None):
+    ''' (mean path lengths, betweenness, closeness, harmonic centrality) for the nodes of a
+        graph given as adjacency lists of local indices (and, optionally, matching lists of
+        edge lengths); the mean path length of a node which cannot reach every other node is None
+    '''
+    path_sums, harmonic_sums, reached, betweenness = source_contributions(adjacency, range(len(adjacency)), weights)
+    return _finish(len(adjacency), path_sums, harmonic_sums, reached, betweenness)
+
+#-------------------------------------------------------------------------------
+
+
+def estimated_diameter(adjacency):
+    ''' a lower bound (at least half) of the largest diameter of the connected components,
+        from two breadth-first sweeps over each '''
+    seen = [False] * len(adjacency)
+    diameter = 0
+    for start in range(len(adjacency)):
+        if not seen[start]:
+            order = single_source(adjacency, start)[0]
+            for node in order:
+                seen[node] = True
+            farthest = order[-1]
+            diameter = max(diameter, max(single_source(adjacency, farthest)[1]))
+    return diameter
+
+
+def _bitset_sweep(adjacency, sources, path_sums, harmonic_sums, reached):
+    node_count = len(adjacency)
+    seen = [0] * node_count
+    frontier = {}
+    for k, source in enumerate(sources):
+        seen[source] = frontier[source] = 1 << k
+
+    level = 0
+    while frontier:
+        level += 1
+        arriving = {}
+        for node, bits in frontier.items():
+            for neighbor in adjacency[node]:
+                arriving[neighbor] = arriving.get(neighbor, 0) | bits
+        frontier = {}
+        for node, bits in arriving.items():
+            bits &= ~seen[node]
+            if bits:
+                seen[node] |= bits
+                frontier[node] = bits
+                count = bin(bits).count('1')
+                path_sums[node] += level * count
+                harmonic_sums[node] += count / level
+                reached[node] += count
+
+
+def closeness_sums(adjacency, sources, weights=None, bitsets=None):
+    ''' (sums of path lengths, sums of their reciprocals, numbers of paths), one entry per node,
+        over the shortest paths with one end in sources. Adding up the results for blocks of
+        sources which cover every node once gives the totals for each node.
+
+        Without weights, and unless bitsets is False, graphs with an estimated diameter of at
+        most bitset_diameter are swept with bitset frontiers, other graphs with one search per source.
+    '''
+    node_count = len(adjacency)
+    path_sums = [0] * node_count
+    harmonic_sums = [0.] * node_count
+    reached = [0] * node_count
+    sources = list(sources)
+
+    if weights is None and (bitsets or (bitsets is None and estimated_diameter(adjacency) <= bitset_diameter)):
+        for k in range(0, len(sources), _bitset_block):
+            _bitset_sweep(adjacency, sources[k:k + _bitset_block], path_sums, harmonic_sums, reached)
+        return path_sums, harmonic_sums, reached
+
+    for source in sources:
+        order, lengths = single_source(adjacency, source, weights)[:2]
+        path_sums[source] = sum(lengths[k] for k in order)
+        harmonic_sums[source] = sum(1. / lengths[k] for k in order if lengths[k] > 0)
+        reached[source] = len(order) - 1
+    return path_sums, harmonic_sums, reached
+
+
+def _graph_closeness(sources):
+    return closeness_sums(_graph['adjacency'], sources, _graph['weights'], _graph['bitsets'])
+
+
+def subset_closeness(adjacency, weights=None, workers=None):
+    ''' (closeness, harmonic centrality) for every node of a graph, with blocks of sources
+        swept in parallel on workers (default: the shared executor)
+    '''
+    node_count = len(adjacency)
+    workers = workers or get_executor()
+    bitsets = weights is None and estimated_diameter(adjacency) <= bitset_diameter
+    block = max(64, min(_bitset_block, -(-node_count // (4 * workers.workers))))
+    blocks = [range(k, min(k + block, node_count)) for k in range(0, node_count, block)]
+
+    totals = [[0] * node_count, [0.] * node_count, [0] * node_count]
+    for sums in workers.map(_graph_closeness, blocks, setup=_set_graph, setup_args=(adjacency, weights, bitsets), ordered=False):
+        for total, values in zip(totals, sums):
+            for k, v in enumerate(values):
+                if v:
+                    total[k] += v
+    return closeness_values(node_count, *totals)
+
+#-------------------------------------------------------------------------------
+
+
+def _dtype(weights):
+    # hop counts are exact in float32; sums of distances need float64
+    return np.float32 if weights is None else np.float64
+
+
+def _row(adjacency, source, weights):
+    lengths = np.array(single_source(adjacency, source, weights)[1], dtype=_dtype(weights))
+    lengths[lengths < 0] = np.inf
+    return lengths
+
+
+class path_length_rows:
+    ''' the rows of an all-pairs shortest path length matrix, each computed when it is
+        requested (np.float32 hop counts or np.float64 summed distances, inf where there
+        is no path), for graphs too large to hold
+        the whole matrix
+    '''
+
+    def __init__(self, adjacency, weights=None):
+        self.adjacency = adjacency
+        self.weights = weights
+
+    def __len__(self):
+        return len(self.adjacency)
+
+    def __getitem__(self, source):
+        if source < 0:
+            source += len(self.adjacency)
+        if source < 0 or source >= len(self.adjacency):
+            raise IndexError('path_length_rows index out of range')
+        return _row(self.adjacency, source, self.weights)
+
+    def __iter__(self):
+        for source in range(len(self.adjacency)):
+            yield _row(self.adjacency, source, self.weights)
+
+
+_graph = {}
+
+
+def _set_graph(adjacency, weights, bitsets=None):
+    _graph.update({'adjacency': adjacency, 'weights': weights, 'bitsets': bitsets})
+
+
+def _graph_row(source):
+    return _row(_graph['adjacency'], source, _graph['weights'])
+
+
+def shortest_path_lengths(adjacency, weights=None, workers=None):
+    ''' all-pairs shortest path lengths: a dense matrix (rows computed on workers, default
+        the shared executor) for at most dense_limit nodes, otherwise path_length_rows; hop
+        counts are np.float32, summed distances (with weights) np.float64
+    '''
+    node_count = len(adjacency)
+    if node_count > dense_limit:
+        return path_length_rows(adjacency, weights)
+    lengths = np.empty((node_count, node_count), dtype=_dtype(weights))
+    rows = (workers or get_executor()).map(_graph_row, range(node_count), setup=_set_graph, setup_args=(adjacency, weights))
+    for source, row in enumerate(rows):
+        lengths[source] = row
+    return lengths
+
+#-------------------------------------------------------------------------------
+
+
+def _cluster_job(job):
+    cluster_id, start, end, weighted = job
+    if weighted:
+        rows, adjacency, weights = worker_view().cluster_adjacency(cluster_id, weighted=True)
+    else:
+        (rows, adjacency), weights = worker_view().cluster_adjacency(cluster_id), None
+    end = min(end, len(rows))
+    path_sums, harmonic_sums, reached, betweenness = source_contributions(adjacency, range(start, end), weights)
+    return cluster_id, start, rows.tolist() if start == 0 else None, (path_sums, harmonic_sums, reached), betweenness
+
+
+def _blocks(size, workers):
+    if size <= _split_above:
+        return [(0, size)]
+    block = max(64, -(-size // (4 * workers)))
+    return [(k, min(k + block, size)) for k in range(0, size, block)]
+
+
+def cluster_centralities(network, progress=None, workers=None, use_actual_distances=False):
+    ''' yield (cluster ID, [node], [mean path length], [betweenness], [closeness],
+        [harmonic centrality]) for every cluster of
+        the network (as assigned by the last compute_clusters), in retrieve_clusters order;
+        with use_actual_distances, paths are weighted by the distances of their edges.
+        Clusters are computed largest first on workers (default: the shared executor), and
+        each is yielded as soon as it and all clusters before it are done.
+
+        progress, if given, is called as progress (clusters done, clusters, nodes done, nodes)
+        whenever a cluster is finished.
+    '''
+    clusters = network.retrieve_clusters(singletons=False)
+    if not clusters:
+        return
+    workers = workers or get_executor()
+    cluster_order = list(clusters.keys())
+    position = {c: k for k, c in enumerate(cluster_order)}
+    by_size = sorted(cluster_order, key=lambda c: (-len(clusters[c]), position[c]))
+    jobs = [(c, start, end, use_actual_distances) for c in by_size for start, end in _blocks(len(clusters[c]), workers.workers)]
+    nodes = list(network.nodes)
+    total_nodes = sum(len(c) for c in clusters.values())
+
+    with network.export_shared() as shared:
+        partial = {}  # cluster ID -> [blocks left, rows, per-source sums by block start, betweenness]
+        done = {}
+        next_to_yield = 0
+        clusters_done = 0
+        done_nodes = 0
+        for cluster_id, start, rows, sums, betweenness in workers.map(_cluster_job, jobs, setup=attach_worker,
+                                                                       setup_args=(shared.handle,), teardown=detach_worker, ordered=False):
+            if cluster_id not in partial:
+                partial[cluster_id] = [len(_blocks(len(clusters[cluster_id]), workers.workers)), None, {}, None]
+            state = partial[cluster_id]
+            state[0] -= 1
+            state[1] = rows if rows is not None else state[1]
+            state[2][start] = sums
+            state[3] = betweenness if state[3] is None else [a + b for a, b in zip(state[3], betweenness)]
+            if state[0]:
+                continue
+
+            del partial[cluster_id]
+            node_count = len(state[1])
+            blocks = [state[2][start] for start in sorted(state[2])]
+            sums = [[v for block in blocks for v in block[k]] for k in range(3)]
+            done[cluster_id] = ([nodes[r] for r in state[1]],) + _finish(node_count, *sums, state[3])
+            clusters_done += 1
+            done_nodes += node_count
+            if progress is not None:
+                progress(clusters_done, len(cluster_order), done_nodes, total_nodes)
+            while next_to_yield < len(cluster_order) and cluster_order[next_to_yield] in done:
+                cluster_id = cluster_order[next_to_yield]
+                yield (cluster_id,) + done.pop(cluster_id)
+                next_to_yield += 1
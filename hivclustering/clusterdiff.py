@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+''' Match the clusters of two network builds (e.g. last month's and this month's) and
+    classify how each one changed.
+
+    Both builds are reduced to a node -> cluster index, and the overlap between old and
+    new clusters is counted in one pass over the nodes, so the comparison takes time
+    linear in the number of nodes (plus the number of overlapping cluster pairs).
+'''
+
+import csv
+from collections import Counter
+
+from .mtnetwork import transmission_network
+
+__all__ = ['cluster_assignments', 'diff_clusters', 'diff_networks']
+
+#-------------------------------------------------------------------------------
+
+
+def _sequence_id(network, node):
+    ''' the sequence ID write_clusters writes for node (its node ID if it has none) '''
+    for d in node.dates:
+        sequence_id = network.sequence_ids.get(network.make_sequence_key(node.id, d))
+        if sequence_id is not None:
+            return sequence_id
+    return node.id
+
+
+def cluster_assignments(source, id_parser=None):
+    ''' ID -> cluster ID for the clustered nodes of source, which is a transmission_network,
+        the path to a write_clusters CSV (SequenceID,ClusterID) or the path to a network saved
+        with save_snapshot (only from a trusted source; see load_network_snapshot). Nodes are keyed by the sequence ID that write_clusters writes for
+        them (e.g. P1|01012001), so that all three kinds of source can be compared, unless
+        id_parser (a header parser such as parseAEH) is given: then every source is keyed by
+        node (patient) ID, and CSV sequence IDs are reduced to node IDs with id_parser.
+    '''
+    if isinstance(source, str):
+        with open(source, 'rb') as fh:
+            is_pickle = fh.read(1) == b'\x80'
+        if is_pickle:
+            from .mtnetwork import load_network_snapshot
+            source = load_network_snapshot(source)
+        else:
+            assignments = {}
+            with open(source, 'r') as fh:
+                reader = csv.reader(fh)
+                header = next(reader, [])
+                if len(header) < 2:
+                    raise IOError('%s : Expected a CSV file with SequenceID,ClusterID columns' % source)
+                for line in reader:
+                    node_id = line[0] if id_parser is None else id_parser(line[0])[0]['id']
+                    assignments[node_id] = int(line[1])
+            return assignments
+
+    if not isinstance(source, transmission_network):
+        raise TypeError('Expected a transmission_network, a cluster CSV or a network snapshot')
+    if all(node.cluster_id is None for node in source.nodes):
+        source.compute_clusters()
+    if id_parser is None:
+        return {_sequence_id(source, node): node.cluster_id for node in source.nodes if node.cluster_id is not None}
+    return {node.id: node.cluster_id for node in source.nodes if node.cluster_id is not None}
+
+
+def diff_clusters(old, new):
+    ''' compare two node -> cluster dicts and return
+        {'new': [...], 'grown': [...], 'shrunk': [...], 'merged': [...], 'split': [...],
+         'dissolved': [...], 'unchanged': [...], 'summary': {...}}
+
+        new:       new clusters with no node from an old cluster
+        merged:    new clusters with nodes from two or more old clusters
+        split:     old clusters whose nodes ended up in two or more new clusters
+        dissolved: old clusters with no node in any new cluster
+        grown, shrunk, unchanged: old and new clusters matched one to one, which gained
+                   nodes, only lost nodes, or kept the same members
+
+        'added' counts the nodes of a new cluster which were not in any old cluster;
+        'lost' counts the nodes of an old cluster which are not in any new cluster.
+    '''
+    old_sizes = Counter(old.values())
+    new_sizes = Counter(new.values())
+
+    overlap = Counter()
+    for node_id, new_cluster in new.items():
+        old_cluster = old.get(node_id)
+        if old_cluster is not None:
+            overlap[(old_cluster, new_cluster)] += 1
+
+    sources = {}  # new cluster -> {old cluster: shared nodes}
+    targets = {}  # old cluster -> {new cluster: shared nodes}
+    for (old_cluster, new_cluster), count in overlap.items():
+        sources.setdefault(new_cluster, {})[old_cluster] = count
+        targets.setdefault(old_cluster, {})[new_cluster] = count
+
+    def added(new_cluster):
+        return new_sizes[new_cluster] - sum(sources.get(new_cluster, {}).values())
+
+    def lost(old_cluster):
+        return old_sizes[old_cluster] - sum(targets.get(old_cluster, {}).values())
+
+    report = {'new': [], 'grown': [], 'shrunk': [], 'merged': [], 'split': [], 'dissolved': [], 'unchanged': []}
+
+    for new_cluster in sorted(new_sizes):
+        from_old = sources.get(new_cluster)
+        if not from_old:
+            report['new'].append({'cluster': new_cluster, 'size': new_sizes[new_cluster]})
+        elif len(from_old) > 1:
+            merged = sorted(from_old, key=lambda k: (-from_old[k], k))
+            report['merged'].append({'cluster': new_cluster, 'from': merged, 'sizes before': [old_sizes[k] for k in merged],
+                                     'shared': [from_old[k] for k in merged], 'size': new_sizes[new_cluster], 'added': added(new_cluster)})
+        else:
+            old_cluster = next(iter(from_old))
+            if len(targets[old_cluster]) == 1:
+                record = {'cluster': new_cluster, 'from': old_cluster, 'size before': old_sizes[old_cluster],
+                          'size': new_sizes[new_cluster], 'added': added(new_cluster), 'lost': lost(old_cluster)}
+                if record['added']:
+                    report['grown'].append(record)
+                elif record['lost']:
+                    report['shrunk'].append(record)
+                else:
+                    report['unchanged'].append(record)
+
+    for old_cluster in sorted(old_sizes):
+        to_new = targets.get(old_cluster)
+        if not to_new:
+            report['dissolved'].append({'cluster': old_cluster, 'size before': old_sizes[old_cluster]})
+        elif len(to_new) > 1:
+            split = sorted(to_new, key=lambda k: (-to_new[k], k))
+            report['split'].append({'cluster': old_cluster, 'into': split, 'sizes': [new_sizes[k] for k in split],
+                                    'shared': [to_new[k] for k in split], 'size before': old_sizes[old_cluster], 'lost': lost(old_cluster)})
+
+    report['summary'] = dict([(k, len(v)) for k, v in report.items()] +
+                             [('old clusters', len(old_sizes)), ('new clusters', len(new_sizes)),
+                              ('old clustered nodes', len(old)), ('new clustered nodes', len(new))])
+    return report
+
+
+def diff_networks(old, new, id_parser=None):
+    ''' diff_clusters for any two sources accepted by cluster_assignments '''
+    return diff_clusters(cluster_assignments(old, id_parser), cluster_assignments(new, id_parser))
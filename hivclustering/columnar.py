@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+''' Column-oriented binary export of a transmission network.
+
+    An archive is a single file laid out as
+
+        magic (8 bytes) | header length (uint64, little endian) | JSON header | padding | arrays
+
+    Every array starts on a 64-byte boundary of the file, at the offset recorded in the
+    header (relative to the start of the array section), so that load_columnar can map
+    the file and hand out NumPy views of it without copying or parsing anything.
+
+    Tables and columns (schema version 1)
+
+        nodes:    id (string), cluster_id (int32, -1 for singletons), degree (int32),
+                  baseline (datetime64[D]), stage (int8 code into dictionaries['stage']),
+                  edi (datetime64[D]); missing dates are NaT
+        edges:    source, target (int32 row indices into nodes; source is the transmitting
+                  node if direction is 1), distance (float64), direction (int8: 1 directed,
+                  0 undirected), support (float64, triangle test p-value), removed (bool)
+        clusters: cluster_id (int32), size (int32), edges (int32)
+
+    Strings are stored as an int64 offsets array (one entry more than there are rows)
+    and a uint8 array with the UTF-8 encoded values.
+'''
+
+import json
+import mmap
+import struct
+
+import numpy as np
+
+from .mtnetwork import tm_to_datetime
+
+__all__ = ['export_columnar', 'load_columnar', 'string_column', 'schema_version']
+
+schema_version = 1
+
+_magic = b'HIVCOLAR'
+_alignment = 64
+
+#-------------------------------------------------------------------------------
+
+
+def _aligned(offset):
+    return (offset + _alignment - 1) // _alignment * _alignment
+
+
+def _dates(values):
+    return np.array([np.datetime64(tm_to_datetime(d).date(), 'D') if d is not None else np.datetime64('NaT', 'D') for d in values],
+                    dtype='datetime64[D]')
+
+
+def _strings(values):
+    encoded = [str(v).encode('utf-8') for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(v) for v in encoded], out=offsets[1:])
+    return offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+
+class string_column:
+    ''' a read-only column of strings backed by an offsets array and a byte array '''
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('string_column index out of range')
+        return self.data[self.offsets[index]:self.offsets[index + 1]].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    def tolist(self):
+        return list(self)
+
+#-------------------------------------------------------------------------------
+
+
+def _network_tables(network):
+    nodes = list(network.nodes)
+    node_row = {n: k for k, n in enumerate(nodes)}
+
+    stages = {}
+    stage_codes = np.array([stages.setdefault(n.stage, len(stages)) for n in nodes], dtype=np.int8)
+
+    node_table = {'id': _strings([n.id for n in nodes]),
+                  'cluster_id': np.array([n.cluster_id if n.cluster_id is not None else -1 for n in nodes], dtype=np.int32),
+                  'degree': np.array([n.degree for n in nodes], dtype=np.int32),
+                  'baseline': _dates([n.get_baseline_date(True) for n in nodes]),
+                  'stage': stage_codes,
+                  'edi': _dates([n.get_edi() for n in nodes])}
+
+    edges = [e for e in network.reduce_edge_set() if e.visible]
+    sources = np.empty(len(edges), dtype=np.int32)
+    targets = np.empty(len(edges), dtype=np.int32)
+    direction = np.zeros(len(edges), dtype=np.int8)
+    cluster_edges = {}
+
+    for k, e in enumerate(edges):
+        source = e.compute_direction()
+        if source is not None:
+            sources[k] = node_row[source]
+            targets[k] = node_row[e.p2 if source != e.p2 else e.p1]
+            direction[k] = 1
+        else:
+            sources[k] = node_row[e.p1]
+            targets[k] = node_row[e.p2]
+        if e.p1.cluster_id is not None:
+            cluster_edges[e.p1.cluster_id] = cluster_edges.get(e.p1.cluster_id, 0) + 1
+
+    edge_table = {'source': sources, 'target': targets,
+                  'distance': np.array([network.distances[e] for e in edges], dtype=np.float64),
+                  'direction': direction,
+                  'support': np.array([e.edge_reject_p for e in edges], dtype=np.float64),
+                  'removed': np.array([not e.has_support() for e in edges], dtype=np.bool_)}
+
+    clusters = network.retrieve_clusters(singletons=False)
+    cluster_ids = sorted(clusters.keys())
+    cluster_table = {'cluster_id': np.array(cluster_ids, dtype=np.int32),
+                     'size': np.array([len(clusters[c]) for c in cluster_ids], dtype=np.int32),
+                     'edges': np.array([cluster_edges.get(c, 0) for c in cluster_ids], dtype=np.int32)}
+
+    dictionaries = {'stage': sorted(stages, key=stages.get)}
+
+    return {'nodes': node_table, 'edges': edge_table, 'clusters': cluster_table}, dictionaries
+
+
+def export_columnar(network, path):
+    ''' write the node, edge and cluster tables of the network to a columnar archive at path '''
+
+    tables, dictionaries = _network_tables(network)
+
+    header = {'schema_version': schema_version, 'tables': {}, 'dictionaries': dictionaries}
+    arrays = []
+    offset = 0
+
+    def place(array):
+        nonlocal offset
+        offset = _aligned(offset)
+        arrays.append((offset, array))
+        spec = {'dtype': array.dtype.str, 'offset': offset, 'count': len(array)}
+        offset += array.nbytes
+        return spec
+
+    for table_name, columns in tables.items():
+        table = {'rows': 0, 'columns': {}}
+        for column_name, values in columns.items():
+            if isinstance(values, tuple):
+                table['columns'][column_name] = {'kind': 'string', 'offsets': place(values[0]), 'data': place(values[1])}
+                table['rows'] = len(values[0]) - 1
+            else:
+                table['columns'][column_name] = {'kind': 'array', 'array': place(values)}
+                table['rows'] = len(values)
+        header['tables'][table_name] = table
+
+    encoded_header = json.dumps(header, sort_keys=True).encode('utf-8')
+    data_start = _aligned(len(_magic) + 8 + len(encoded_header))
+
+    with open(path, 'wb') as fh:
+        fh.write(_magic)
+        fh.write(struct.pack('<Q', len(encoded_header)))
+        fh.write(encoded_header)
+        for array_offset, array in arrays:
+            fh.write(b'\0' * (data_start + array_offset - fh.tell()))
+            fh.write(array.tobytes())
+
+
+def load_columnar(path):
+    ''' map a columnar archive written by export_columnar and return a dict with
+        'schema_version', 'dictionaries' and a dict of columns for each table
+        ('nodes', 'edges', 'clusters'). Numeric columns are read-only NumPy views of
+        the mapped file; string columns are string_column objects.
+    '''
+
+    with open(path, 'rb') as fh:
+        if fh.read(len(_magic)) != _magic:
+            raise IOError('%s is not a hivclustering columnar archive' % path)
+        header_length = struct.unpack('<Q', fh.read(8))[0]
+        header = json.loads(fh.read(header_length).decode('utf-8'))
+        if header.get('schema_version', 0) > schema_version:
+            raise IOError('%s uses columnar schema version %d; this version of hivclustering reads up to %d' %
+                          (path, header['schema_version'], schema_version))
+        mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    data_start = _aligned(len(_magic) + 8 + header_length)
+
+    def view(spec):
+        if spec['count'] == 0:
+            return np.empty(0, dtype=np.dtype(spec['dtype']))
+        return np.frombuffer(mapped, dtype=np.dtype(spec['dtype']), count=spec['count'], offset=data_start + spec['offset'])
+
+    archive = {'schema_version': header['schema_version'], 'dictionaries': header['dictionaries']}
+    for table_name, table in header['tables'].items():
+        columns = {}
+        for column_name, spec in table['columns'].items():
+            if spec['kind'] == 'string':
+                columns[column_name] = string_column(view(spec['offsets']), view(spec['data']))
+            else:
+                columns[column_name] = view(spec['array'])
+        archive[table_name] = columns
+
+    return archive
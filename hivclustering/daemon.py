@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+
+''' Serve queries against a loaded transmission network.
+
+    The network is loaded once and frozen into a network_snapshot (plain dicts and tuples
+    that are never modified), which every request reads from. A reload builds a new
+    snapshot in a worker thread and then replaces the current one in a single assignment,
+    so requests which are already running finish against the snapshot they started with.
+
+    Two transports are available, both through asyncio:
+
+        Unix domain socket: one JSON object per line in each direction, e.g.
+            {"query": "neighbors", "id": "P1", "threshold": 0.005}
+        HTTP on localhost: GET /<query>?id=P1&threshold=0.005 (POST /reload takes an
+            optional JSON body, e.g. {"inputs": ["new.csv"]})
+
+    Queries: status, cluster (id, members), neighbors (id, threshold), degree (id, threshold),
+    summary (cluster), rethreshold (threshold, id), reload (inputs)
+'''
+
+import asyncio
+import datetime
+import json
+import sys
+import threading
+import urllib.parse
+from bisect import bisect_right
+from collections import OrderedDict
+
+from .mtnetwork import transmission_network, _union_find
+
+__all__ = ['network_snapshot', 'network_daemon', 'load_network']
+
+# re-thresholded clusterings kept per snapshot (each one covers every clustered node)
+_rethreshold_cache = 8
+
+#-------------------------------------------------------------------------------
+
+
+def load_network(inputs, formatter=None, threshold=None, multiple_edges=False):
+    ''' read one or more ID1,ID2,distance files into a new network and compute its clusters '''
+    network = transmission_network(multiple_edges=multiple_edges)
+    for file_name in inputs:
+        network.read_from_csv_file(file_name, formatter, threshold, 'BULK')
+    network.compute_clusters()
+    return network
+
+
+class network_snapshot:
+    ''' an immutable, query-oriented copy of a transmission network '''
+
+    def __init__(self, network, threshold=None, inputs=None):
+        self.threshold = threshold
+        self.inputs = list(inputs or [])
+        self.loaded = datetime.datetime.now().isoformat(timespec='seconds')
+
+        neighbors = {}
+        for e in network.edge_iterator():
+            if e.visible:
+                d = network.distances[e]
+                for a, b in ((e.p1.id, e.p2.id), (e.p2.id, e.p1.id)):
+                    by_node = neighbors.setdefault(a, {})
+                    if b not in by_node or d < by_node[b]:
+                        by_node[b] = d
+
+        # neighbors sorted by distance, so that a stricter threshold is a prefix
+        self.neighbors = {}
+        for node in network.nodes:
+            by_node = neighbors.get(node.id, {})
+            self.neighbors[node.id] = tuple(sorted(by_node.items(), key=lambda p: (p[1], str(p[0]))))
+        self.neighbor_distances = {n: tuple(p[1] for p in pairs) for n, pairs in self.neighbors.items()}
+
+        self.cluster_of = {node.id: node.cluster_id for node in network.nodes}
+        members = {}
+        for node_id, cluster_id in self.cluster_of.items():
+            if cluster_id is not None:
+                members.setdefault(cluster_id, []).append(node_id)
+        self.members = {c: tuple(sorted(m, key=str)) for c, m in members.items()}
+
+        # every pair once, by increasing distance, for re-thresholding
+        self.pairs = tuple(sorted(((d, a, b) for a, by_node in neighbors.items() for b, d in by_node.items() if str(a) < str(b)),
+                                  key=lambda p: (p[0], str(p[1]), str(p[2]))))
+        self.pair_distances = tuple(p[0] for p in self.pairs)
+        # least recently used first; rethreshold runs on executor threads
+        self._rethresholded = OrderedDict()
+        self._rethresholded_lock = threading.Lock()
+
+    def _node(self, node_id):
+        if node_id not in self.cluster_of:
+            raise KeyError('No node with id %s' % node_id)
+        return node_id
+
+    def _within(self, node_id, threshold):
+        pairs = self.neighbors[self._node(node_id)]
+        if threshold is None:
+            return pairs
+        return pairs[:bisect_right(self.neighbor_distances[node_id], threshold)]
+
+    def status(self):
+        return {'nodes': len(self.cluster_of), 'edges': len(self.pairs), 'clusters': len(self.members),
+                'threshold': self.threshold, 'inputs': self.inputs, 'loaded': self.loaded}
+
+    def cluster(self, node_id, members=False):
+        cluster_id = self.cluster_of[self._node(node_id)]
+        result = {'id': node_id, 'cluster': cluster_id, 'size': len(self.members[cluster_id]) if cluster_id is not None else 1}
+        if members:
+            result['members'] = list(self.members[cluster_id]) if cluster_id is not None else [node_id]
+        return result
+
+    def neighborhood(self, node_id, threshold=None):
+        return {'id': node_id, 'threshold': threshold, 'neighbors': [list(p) for p in self._within(node_id, threshold)]}
+
+    def degree(self, node_id, threshold=None):
+        return {'id': node_id, 'threshold': threshold, 'degree': len(self._within(node_id, threshold))}
+
+    def summary(self, cluster_id):
+        if cluster_id not in self.members:
+            raise KeyError('No cluster with id %s' % cluster_id)
+        nodes = self.members[cluster_id]
+        distances = [d for n in nodes for m, d in self.neighbors[n] if str(n) < str(m)]
+        degrees = [len(self.neighbors[n]) for n in nodes]
+        return {'cluster': cluster_id, 'size': len(nodes), 'edges': len(distances),
+                'mean distance': sum(distances) / len(distances) if distances else None,
+                'max distance': max(distances) if distances else None,
+                'max degree': max(degrees), 'members': list(nodes)}
+
+    def rethreshold(self, threshold, node_id=None):
+        ''' clusters formed by the edges at or below a (stricter) threshold '''
+        with self._rethresholded_lock:
+            cached = self._rethresholded.get(threshold)
+            if cached is not None:
+                self._rethresholded.move_to_end(threshold)
+
+        if cached is None:
+            sets = _union_find()
+            for d, a, b in self.pairs[:bisect_right(self.pair_distances, threshold)]:
+                sets.union(a, b)
+            clusters = {}
+            for node in sets.parent:
+                clusters.setdefault(sets.find(node), []).append(node)
+            cached = (sets, sorted((len(c) for c in clusters.values()), reverse=True), clusters)
+            # snapshots never change, so a result stays valid for as long as it is cached
+            with self._rethresholded_lock:
+                self._rethresholded[threshold] = cached
+                while len(self._rethresholded) > _rethreshold_cache:
+                    self._rethresholded.popitem(last=False)
+
+        sets, sizes, clusters = cached
+        result = {'threshold': threshold, 'clusters': len(sizes), 'clustered nodes': sum(sizes), 'sizes': sizes}
+        if node_id is not None:
+            self._node(node_id)
+            result['id'] = node_id
+            result['members'] = sorted(clusters[sets.find(node_id)], key=str) if node_id in sets.parent else [node_id]
+        return result
+
+#-------------------------------------------------------------------------------
+
+
+class network_daemon:
+    ''' answer queries against the current snapshot; loader () returns a transmission_network
+        (loader (inputs) when a reload names new input files)
+    '''
+
+    def __init__(self, loader, inputs=None, threshold=None):
+        self.loader = loader
+        self.inputs = list(inputs or [])
+        self.threshold = threshold
+        self.snapshot = None
+        self._reloading = None
+
+    def _build(self, inputs):
+        return network_snapshot(self.loader(inputs), self.threshold, inputs)
+
+    async def _reload(self, inputs):
+        try:
+            self.snapshot = await asyncio.get_running_loop().run_in_executor(None, self._build, inputs)
+            self.inputs = inputs
+        finally:
+            self._reloading = None
+
+    async def reload(self, inputs=None):
+        ''' build a new snapshot off the event loop, then swap it in. A request made while
+            another reload is running shares it if it names the same inputs (or none);
+            otherwise it waits for that reload to finish and then runs its own
+        '''
+        if inputs is not None and (not isinstance(inputs, (list, tuple)) or not all(isinstance(k, str) for k in inputs)):
+            raise ValueError('inputs must be a list of file names')
+        inputs = list(inputs) if inputs else None
+        while self._reloading is not None:
+            running, running_inputs = self._reloading
+            if inputs is None or inputs == running_inputs:
+                await asyncio.shield(running)
+                return self.snapshot.status()
+            try:
+                await asyncio.shield(running)
+            except Exception:
+                pass  # reported to the requests that asked for that reload
+
+        inputs = inputs or self.inputs
+        self._reloading = (asyncio.ensure_future(self._reload(inputs)), inputs)
+        await asyncio.shield(self._reloading[0])
+        return self.snapshot.status()
+
+    async def answer(self, request):
+        ''' request is a dict with a 'query' key and its arguments; returns a JSON-able dict '''
+        if not isinstance(request, dict):
+            raise ValueError('A request must be a JSON object')
+        query = request.get('query')
+        if query == 'reload':
+            return await self.reload(request.get('inputs'))
+
+        snapshot = self.snapshot
+        if snapshot is None:
+            raise RuntimeError('The network has not been loaded yet')
+
+        def number(key):
+            return float(request[key]) if request.get(key) is not None else None
+
+        if query == 'status':
+            return snapshot.status()
+        if query == 'cluster':
+            return snapshot.cluster(request['id'], str(request.get('members', False)).lower() in ('1', 'true'))
+        if query == 'neighbors':
+            return snapshot.neighborhood(request['id'], number('threshold'))
+        if query == 'degree':
+            return snapshot.degree(request['id'], number('threshold'))
+        if query == 'summary':
+            return snapshot.summary(int(request['cluster']))
+        if query == 'rethreshold':
+            # a new threshold means a pass over the edges; keep the event loop responsive
+            return await asyncio.get_running_loop().run_in_executor(None, snapshot.rethreshold, number('threshold'), request.get('id'))
+        raise ValueError('Unknown query %s' % query)
+
+    async def _safe_answer(self, request):
+        try:
+            return 200, await self.answer(request)
+        except KeyError as e:
+            return 404, {'error': str(e.args[0]) if e.args else 'Missing argument'}
+        except (ValueError, TypeError, RuntimeError, IOError) as e:
+            return 400, {'error': str(e)}
+        except Exception as e:
+            # anything else is a fault of the daemon; answer instead of dropping the connection
+            print("Error answering %s: %r" % (request, e), file=sys.stderr)
+            return 500, {'error': '%s: %s' % (type(e).__name__, e)}
+
+    async def _serve_lines(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError as e:
+                    status, response = 400, {'error': 'Invalid JSON: %s' % e}
+                else:
+                    status, response = await self._safe_answer(request)
+                writer.write(json.dumps(response).encode('utf-8') + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def _serve_http(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                header = (await reader.readline()).decode('latin-1').strip()
+                if not header:
+                    break
+                key, value = header.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+
+            if len(request_line) < 2:
+                status, response = 400, {'error': 'Malformed request'}
+            else:
+                url = urllib.parse.urlsplit(request_line[1])
+                request = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+                request['query'] = url.path.strip('/') or 'status'
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                try:
+                    if body:
+                        request.update(json.loads(body))
+                except ValueError as e:
+                    status, response = 400, {'error': 'Invalid JSON: %s' % e}
+                else:
+                    status, response = await self._safe_answer(request)
+
+            payload = json.dumps(response).encode('utf-8')
+            writer.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: close\r\n\r\n' %
+                          (status, {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}[status], len(payload))).encode('latin-1') + payload)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, unix_socket=None, host='127.0.0.1', port=None, ready=None):
+        ''' load the network, then serve on a Unix socket and/or localhost HTTP until cancelled '''
+        await self.reload()
+        servers = []
+        if unix_socket is not None:
+            servers.append(await asyncio.start_unix_server(self._serve_lines, path=unix_socket))
+        if port is not None:
+            servers.append(await asyncio.start_server(self._serve_http, host=host, port=port))
+        if not servers:
+            raise ValueError('Specify a Unix socket path, an HTTP port, or both')
+
+        print("Serving %d nodes and %d edges" % (len(self.snapshot.cluster_of), len(self.snapshot.pairs)), file=sys.stderr)
+        if ready is not None:
+            ready.set_result(servers)
+        try:
+            await asyncio.gather(*[s.serve_forever() for s in servers])
+        finally:
+            for s in servers:
+                s.close()
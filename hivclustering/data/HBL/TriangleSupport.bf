@@ -93,7 +93,15 @@ for (k = 0; k < filteredData.species; k+=1) {
 //fprintf (stdout, "Getting frequencies...\n");
 
 COUNT_GAPS_IN_FREQUENCIES = 0;
-HarvestFrequencies          (globalFreqs, filteredData, 1,1,1);
+if (Type (_py_base_frequencies) == "Matrix") {
+    // supplied by the caller when _py_sequence_file holds only a subset of the alignment
+    globalFreqs = {4,1};
+    for (k = 0; k < 4; k+=1) {
+        globalFreqs[k] = _py_base_frequencies[k];
+    }
+} else {
+    HarvestFrequencies          (globalFreqs, filteredData, 1,1,1);
+}
 
 
 triangle_count = Abs(_py_triangle_sequences) $ 3;
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+''' Run independent work items serially, on threads or on worker processes.
+
+    Every parallel stage (triangle edge support tests, sequence simulation, parallel CSV
+    ingest, TN93 distances) goes through the shared executor returned by get_executor, so
+    worker processes are started once per run and their number is set in one place
+    (hivnetworkcsv --threads). Install a different one with set_executor:
+
+        set_executor(executor('thread', 4))
+
+    executor.map hands items out in chunks. Unless a chunk size is given, the first
+    chunks are small, and later ones are sized so that a chunk takes about target_seconds
+    given the per-item time measured so far. Chunks are collected as they complete and
+    new ones are submitted in their place, so one slow chunk does not hold up the others.
+
+    Work that needs per-process state (e.g. an alignment attached from shared memory)
+    names a setup function and its arguments; each worker calls setup once per map call
+    before running items. Setup arguments are sent to a worker process only when it first
+    runs a chunk of that map call (a chunk sent without them comes back unrun and is sent
+    again with them), so large arguments are pickled about once per worker, not once per
+    chunk. Arguments which cannot be pickled (closures, such as the parseRegExp formatters)
+    are handed to a temporary pool of workers forked (start method 'fork') after setup is
+    known, so they inherit the arguments; where fork is not available, such a map call runs
+    on threads instead. A teardown function, if given, is called once in every worker which
+    ran setup when the map call finishes (e.g. to release shared memory the setup attached).
+
+    In input order, results of chunks that finish before an earlier, slower one are held
+    back; at most 4 chunks per worker are held before submission pauses.
+'''
+
+import atexit
+import concurrent.futures
+import contextlib
+import itertools
+import multiprocessing
+import os
+import pickle
+import time
+
+__all__ = ['executor', 'get_executor', 'set_executor', 'executor_for']
+
+#-------------------------------------------------------------------------------
+# this part runs in the workers
+
+_setups = {}  # setup function -> the token of the map call it was last called for, in this process
+
+
+def _prepare(setup, token, setup_args):
+    ''' call setup for the map call with this token unless this process already has; False
+        if it has not, and the arguments were not sent '''
+    if setup is not None and _setups.get(setup) != token:
+        if setup_args is None:
+            return False
+        setup(*setup_args)
+        _setups[setup] = token
+    return True
+
+
+def _run_chunk(func, chunk, batch, setup, token, setup_args):
+    if not _prepare(setup, token, setup_args):
+        return None, 0., os.getpid()
+    started = time.perf_counter()
+    results = func(chunk) if batch else [func(item) for item in chunk]
+    return results, time.perf_counter() - started, os.getpid()
+
+
+def _finish(setup, token, teardown, processes, wait):
+    ''' call teardown if this process is one of processes and still set up for the map call
+        with this token; the process ID, or None after wait seconds for other processes, so
+        that the remaining calls go to the workers which are still left '''
+    if os.getpid() not in processes:
+        time.sleep(wait)
+        return None
+    if _setups.get(setup) == token:
+        del _setups[setup]
+        teardown()
+    return os.getpid()
+
+#-------------------------------------------------------------------------------
+
+
+class _inline_pool:
+    ''' runs submitted calls immediately, in the calling thread '''
+
+    def submit(self, call, *args):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(call(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        pass
+
+
+def _picklable(*objects):
+    try:
+        pickle.dumps(objects)
+        return True
+    except (pickle.PicklingError, AttributeError, TypeError):
+        return False
+
+
+class executor:
+    ''' kind is 'serial', 'thread' or 'process'; workers defaults to the number of CPUs.
+        The pool is started on first use and kept until close.
+    '''
+
+    kinds = ('serial', 'thread', 'process')
+
+    def __init__(self, kind='process', workers=None, target_seconds=0.25):
+        if kind not in executor.kinds:
+            raise ValueError('%s is not a valid executor kind (must be in %s)' % (kind, str(list(executor.kinds))))
+        if workers is not None and workers < 1:
+            raise ValueError('Need at least one worker')
+        self.kind = kind
+        self.workers = 1 if kind == 'serial' else (workers or os.cpu_count() or 1)
+        self.target_seconds = target_seconds
+        self._pool = None
+
+    def __repr__(self):
+        return 'executor(%r, %d)' % (self.kind, self.workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _new_pool(self, setup=None, token=None, setup_args=()):
+        ''' a pool of this kind; with setup, a pool of forked processes which run it as they start '''
+        if self.kind == 'serial':
+            return _inline_pool()
+        if self.kind == 'thread':
+            return concurrent.futures.ThreadPoolExecutor(self.workers)
+        if setup is not None:
+            return concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('fork'),
+                                                          initializer=_prepare, initargs=(setup, token, setup_args))
+        return concurrent.futures.ProcessPoolExecutor(self.workers)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+    def map(self, func, items, setup=None, setup_args=(), chunk_size=None, minimum_chunk=1, maximum_chunk=None, batch=False, ordered=True, teardown=None):
+        ''' yield func (item) for every item, in input order unless ordered is False;
+            with batch, func takes a list of items and returns a list with one result per item.
+            teardown () is called in every worker which ran setup once the map call is over.
+        '''
+        setup_args = tuple(setup_args)
+        token = (os.getpid(), next(_tokens))
+        pool = None
+        # setup arguments are sent to worker processes, but shared with threads
+        send_args = setup_args if self.kind != 'process' else None
+        if self.kind == 'process' and not _picklable(setup, setup_args):
+            if 'fork' in multiprocessing.get_all_start_methods():
+                # forked workers inherit the setup arguments, so they are never pickled
+                pool = self._new_pool(setup, token, setup_args)
+            else:
+                pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+                send_args = setup_args
+        elif self._pool is None:
+            self._pool = self._new_pool()
+
+        workers_set_up = set()  # IDs of the processes which ran setup
+        try:
+            yield from self._map(pool or self._pool, func, items, setup, token, setup_args, send_args, workers_set_up,
+                                 chunk_size, minimum_chunk, maximum_chunk, batch, ordered)
+        finally:
+            if teardown is not None and setup is not None:
+                self._tear_down(pool or self._pool, setup, token, teardown, workers_set_up)
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+
+    @staticmethod
+    def _tear_down(pool, setup, token, teardown, workers_set_up):
+        ''' call teardown in each of workers_set_up; a pool has no way to address a given worker,
+            so calls are submitted until every one of them has made one '''
+        left = set(workers_set_up)
+        try:
+            while left:
+                calls = [pool.submit(_finish, setup, token, teardown, frozenset(left), 0.01) for pid in left]
+                for call in calls:
+                    left.discard(call.result())
+        except concurrent.futures.BrokenExecutor:
+            pass  # the workers are gone, and their mappings with them
+
+    def _map(self, pool, func, items, setup, token, setup_args, send_args, workers_set_up, chunk_size, minimum_chunk, maximum_chunk, batch, ordered):
+        remaining = len(items) if hasattr(items, '__len__') else None
+        items = iter(items)
+        measured = [0., 0]  # seconds, items
+
+        def next_size():
+            if chunk_size is not None:
+                return chunk_size
+            size = minimum_chunk
+            if measured[1]:
+                per_item = measured[0] / measured[1]
+                size = int(self.target_seconds / per_item) if per_item > 0 else maximum_chunk or (1 << 20)
+            if maximum_chunk is not None:
+                size = min(size, maximum_chunk)
+            if remaining is not None:
+                # split the tail evenly instead of leaving it to one worker
+                size = min(size, -(-remaining // self.workers))
+            return max(size, minimum_chunk, 1)
+
+        pending = {}
+        completed = {}
+        submitted = 0
+        next_to_yield = 0
+        exhausted = False
+
+        try:
+            while True:
+                while not exhausted and len(pending) < 2 * self.workers and len(completed) < 4 * self.workers:
+                    size = next_size()
+                    chunk = list(itertools.islice(items, size))
+                    exhausted = len(chunk) < size
+                    if not chunk:
+                        break
+                    if remaining is not None:
+                        remaining -= len(chunk)
+                    pending[pool.submit(_run_chunk, func, chunk, batch, setup, token, send_args)] = (submitted, chunk)
+                    submitted += 1
+
+                if not pending:
+                    break
+
+                done = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)[0]
+                for future in done:
+                    index, chunk = pending.pop(future)
+                    results, seconds, pid = future.result()
+                    if results is None:
+                        # this worker has not run setup for this map call yet
+                        pending[pool.submit(_run_chunk, func, chunk, batch, setup, token, setup_args)] = (index, chunk)
+                        continue
+                    workers_set_up.add(pid)
+                    count = len(chunk)
+                    measured[0] += seconds
+                    measured[1] += count
+                    if ordered:
+                        completed[index] = results
+                    else:
+                        yield from results
+
+                while next_to_yield in completed:
+                    yield from completed.pop(next_to_yield)
+                    next_to_yield += 1
+        finally:
+            for future in pending:
+                future.cancel()
+
+#-------------------------------------------------------------------------------
+
+_tokens = itertools.count()
+_shared = None
+
+
+def get_executor():
+    ''' the executor shared by all parallel stages (a process pool with one worker per CPU unless set_executor was called) '''
+    global _shared
+    if _shared is None:
+        _shared = executor()
+    return _shared
+
+
+def set_executor(new_executor):
+    ''' replace the shared executor (closing the old one); returns new_executor '''
+    global _shared
+    if _shared is not None and _shared is not new_executor:
+        _shared.close()
+    _shared = new_executor
+    return new_executor
+
+
+@contextlib.contextmanager
+def executor_for(processes=None):
+    ''' the shared executor, or, for an explicit number of processes, a temporary one
+        (serial for a single process) which is closed on exit
+    '''
+    if processes is None:
+        yield get_executor()
+        return
+    with executor('serial' if processes <= 1 else 'process', processes) as temporary:
+        yield temporary
+
+
+@atexit.register
+def _close_shared():
+    if _shared is not None:
+        _shared.close()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import os
+
+from .ingest import open_input, decompressed_copy
+
+__all__ = ['read_fasta', 'fasta_index']
+
+
+def read_fasta(file_name):
+    ''' iterate over (name, sequence) records of a (possibly compressed) FASTA file '''
+    with open_input(file_name) as fh:
+        name = None
+        chunks = []
+        for line in fh:
+            if line[:1] == '>':
+                if name is not None:
+                    yield name, ''.join(chunks)
+                name = line[1:].strip()
+                chunks = []
+            elif name is not None:
+                chunks.append(line.strip())
+        if name is not None:
+            yield name, ''.join(chunks)
+
+
+#-------------------------------------------------------------------------------
+
+# how each IUPAC character splits between A, C, G and T when counting base frequencies;
+# gaps and fully ambiguous characters are not counted
+_iupac = {'A': 'A', 'C': 'C', 'G': 'G', 'T': 'T', 'U': 'T', 'R': 'AG', 'Y': 'CT', 'S': 'CG', 'W': 'AT',
+          'K': 'GT', 'M': 'AC', 'B': 'CGT', 'D': 'AGT', 'H': 'ACT', 'V': 'ACG'}
+
+
+class fasta_index:
+    ''' Byte offsets of the records in a FASTA file, keyed by sequence name, for O(1)
+        membership checks and random access. Compressed files are indexed through a
+        temporary decompressed copy, which close () (or leaving a with block) removes.
+        With index_file, the index is also kept in that file and reused while the size and
+        modification time of the FASTA file stay the same; failing to read or write it only
+        means that the index is built in memory.
+    '''
+
+    signature_tag = '#hivclustering-fasta-index'
+
+    def __init__(self, file_name, index_file=None):
+        self.file_name = file_name
+        self.index_file = index_file
+        self.path = decompressed_copy(file_name)
+        self.records = {}  # name -> (offset of the sequence data, length in bytes)
+
+        try:
+            if not self._load():
+                self.records = {}
+                self._build()
+                self._save()
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _signature(self):
+        stats = os.stat(self.file_name)
+        return '%s\t%d\t%d' % (self.signature_tag, stats.st_size, stats.st_mtime_ns)
+
+    def _load(self):
+        if self.index_file is None:
+            return False
+        try:
+            with open(self.index_file, 'r') as fh:
+                if fh.readline().rstrip('\n') != self._signature():
+                    return False
+                for line in fh:
+                    name, offset, length = line.rstrip('\n').rsplit('\t', 2)
+                    self.records[name] = (int(offset), int(length))
+        except (OSError, ValueError):
+            return False  # missing, unreadable or damaged
+        return True
+
+    def _build(self):
+        name = None
+        start = offset = 0
+        with open(self.path, 'rb') as fh:
+            for line in fh:
+                if line[:1] == b'>':
+                    if name is not None:
+                        self.records.setdefault(name, (start, offset - start))
+                    name = line[1:].strip().decode('utf-8')
+                    start = offset + len(line)
+                offset += len(line)
+        if name is not None:
+            self.records.setdefault(name, (start, offset - start))
+
+    def _save(self):
+        if self.index_file is None:
+            return
+        try:
+            with open(self.index_file, 'w') as fh:
+                print(self._signature(), file=fh)
+                for name, (offset, length) in self.records.items():
+                    print('%s\t%d\t%d' % (name, offset, length), file=fh)
+        except OSError:
+            pass  # e.g. a read-only directory; the index simply stays in memory
+
+    def __contains__(self, name):
+        return name in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def sequence(self, name, fh=None):
+        offset, length = self.records[name]
+        if fh is None:
+            with open(self.path, 'rb') as fh:
+                return self.sequence(name, fh)
+        fh.seek(offset)
+        return b''.join(fh.read(length).split()).decode('ascii')
+
+    def write_subset(self, names, file_name):
+        ''' write a FASTA file with only the named sequences '''
+        with open(self.path, 'rb') as source, open(file_name, 'w') as fh:
+            for name in names:
+                fh.write('>%s\n%s\n' % (name, self.sequence(name, source)))
+        return file_name
+
+    def base_frequencies(self):
+        ''' A, C, G, T frequencies over the entire alignment; ambiguous characters are split
+            evenly between the bases they stand for, gaps are ignored
+        '''
+        counts = dict((c, 0) for c in _iupac)
+        with open(self.path, 'rb') as fh:
+            for line in fh:
+                if line[:1] != b'>':
+                    line = line.upper()
+                    for c in counts:
+                        counts[c] += line.count(c.encode('ascii'))
+
+        frequencies = dict((c, 0.) for c in 'ACGT')
+        for c, n in counts.items():
+            for base in _iupac[c]:
+                frequencies[base] += n / len(_iupac[c])
+        total = sum(frequencies.values())
+        return [frequencies[c] / total if total > 0 else 0.25 for c in 'ACGT']
+
+    def close(self):
+        if self.path != self.file_name:
+            os.remove(self.path)
+            self.path = self.file_name
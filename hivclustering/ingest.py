@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+
+import bz2
+import csv
+import gzip
+import lzma
+import mmap
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+from array import array
+
+from .executor import executor_for
+
+__all__ = ['read_csv_in_parallel', 'open_input', 'compression_type', 'pipelined_reader', 'process_reader', 'decompressed_copy']
+
+#-------------------------------------------------------------------------------
+
+_openers = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+
+def compression_type(file_name):
+    ''' return the compressed file extension (.gz, .bz2 or .xz) of file_name, or None '''
+    if isinstance(file_name, str):
+        extension = os.path.splitext(file_name)[1].lower()
+        if extension in _openers:
+            return extension
+    return None
+
+
+class pipelined_reader:
+    ''' Iterate over the lines of a compressed text file (or of any text handle). Decompression
+        runs on a background thread, which feeds a bounded queue of line blocks, so that it
+        overlaps with whatever the consumer does with the lines.
+    '''
+
+    def __init__(self, file_name, block_size=1 << 20, queue_depth=16, handle=None):
+        self.name = file_name
+        self._handle = handle if handle is not None else _openers[compression_type(file_name)](file_name, 'rt')
+        self._queue = queue.Queue(maxsize=queue_depth)
+        self._stop = threading.Event()
+        self._block = []
+        self._position = 0
+        self._finished = False
+        self._thread = threading.Thread(target=self._decode, args=(block_size,), daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _decode(self, block_size):
+        try:
+            while True:
+                block = self._handle.readlines(block_size)
+                if not block or not self._put(block):
+                    break
+        except Exception as e:
+            self._put(e)
+        finally:
+            self._put(None)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while self._position >= len(self._block):
+            if self._finished:
+                raise StopIteration
+            block = self._queue.get()
+            if block is None or isinstance(block, Exception):
+                self._finished = True
+                if block is None:
+                    self._finish()
+                    raise StopIteration
+                raise block
+            self._block = block
+            self._position = 0
+
+        self._position += 1
+        return self._block[self._position - 1]
+
+    def _finish(self):
+        pass
+
+    def readline(self):
+        return next(self, '')
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self._handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class process_reader(pipelined_reader):
+    ''' Iterate over the lines a subprocess writes to its stdout while it is still running.
+        The queue between the pipe and the consumer is bounded, so a slow consumer
+        eventually blocks the subprocess on the pipe instead of buffering everything.
+        A non-zero exit status is raised as a RuntimeError carrying the process stderr
+        once the output is exhausted. If tee is given, the raw output is also copied to it.
+    '''
+
+    def __init__(self, command, block_size=1 << 16, queue_depth=16, tee=None):
+        self.command = command
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        self._tee = tee
+        self._stderr = []
+        self._stderr_thread = threading.Thread(target=self._drain_stderr, daemon=True)
+        self._stderr_thread.start()
+        pipelined_reader.__init__(self, ' '.join(command), block_size, queue_depth, handle=self.process.stdout)
+
+    def _drain_stderr(self):
+        for line in self.process.stderr:
+            self._stderr.append(line)
+
+    def _put(self, item):
+        if self._tee is not None and isinstance(item, list):
+            self._tee.writelines(item)
+        return pipelined_reader._put(self, item)
+
+    def _finish(self):
+        self.process.wait()
+        self._stderr_thread.join()
+        if self.process.returncode != 0:
+            raise RuntimeError("'%s' failed with exit code %d: %s" %
+                               (self.name, self.process.returncode, ''.join(self._stderr).strip()))
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        pipelined_reader.close(self)
+        self.process.wait()
+        self._stderr_thread.join()
+        self.process.stderr.close()
+
+
+def open_input(file_name):
+    ''' open a text file for reading; .gz, .bz2 and .xz files are decompressed on the fly '''
+    if compression_type(file_name):
+        return pipelined_reader(file_name)
+    return open(file_name, 'r')
+
+
+def decompressed_copy(file_name, directory=None):
+    ''' for tools which need a plain file on disk (e.g. HyPhy): return file_name itself if it
+        is not compressed, or the path to a temporary decompressed copy (which the caller removes)
+    '''
+    if not compression_type(file_name):
+        return file_name
+    fh, path = tempfile.mkstemp(suffix=os.path.splitext(os.path.splitext(file_name)[0])[1], dir=directory)
+    with os.fdopen(fh, 'wb') as out, _openers[compression_type(file_name)](file_name, 'rb') as source:
+        shutil.copyfileobj(source, out, 1 << 20)
+    return path
+
+#-------------------------------------------------------------------------------
+# record kinds produced by the workers; the parent replays them in file order
+
+_EDGE = 0    # first occurrence of an (ID1,ID2) pair
+_UPDATE = 1  # a later occurrence of the same pair with a strictly smaller distance
+_NODE = 2    # an ID seen on an above-threshold line (add the node only)
+_SKIP = 3    # an _UPDATE record superseded by an even smaller distance
+
+_worker_formatter = None
+_worker_distance_cut = None
+
+# bytes of CSV handed to a worker at a time
+default_block_size = 1 << 25
+
+
+def _initialize_worker(formatter, distance_cut):
+    global _worker_formatter, _worker_distance_cut
+    _worker_formatter = formatter
+    _worker_distance_cut = distance_cut
+
+
+def _parse_edge_lines(lines, formatter, distance_cut):
+    ''' parse CSV lines (without the header) into compact records which
+        transmission_network.read_from_csv_file would produce the same network from
+    '''
+    id_index = {}
+    descriptions = []
+
+    kinds = array('b')
+    firsts = array('l')
+    seconds = array('l')
+    distances = array('d')
+    counts = array('l')
+    annotations = {}
+
+    pairs = {}  # (ID1, ID2) -> [first record, smallest distance, live update record]
+    node_only = set()
+
+    def intern(raw_id):
+        if raw_id not in id_index:
+            id_index[raw_id] = len(descriptions)
+            descriptions.append(formatter(raw_id))
+        return id_index[raw_id]
+
+    def append(kind, i1, i2, distance):
+        kinds.append(kind)
+        firsts.append(i1)
+        seconds.append(i2)
+        distances.append(distance)
+        counts.append(1)
+
+    for line in csv.reader(lines):
+        distance = float(line[2])
+        if distance_cut is not None and distance > distance_cut:
+            for raw_id in line[:2]:
+                if raw_id not in node_only:
+                    node_only.add(raw_id)
+                    append(_NODE, intern(raw_id), -1, distance)
+            continue
+
+        if len(line) > 3:
+            # annotated lines are replayed verbatim
+            annotations[len(kinds)] = line[2:]
+            append(_EDGE, intern(line[0]), intern(line[1]), distance)
+            continue
+
+        key = (line[0], line[1])
+        if key not in pairs:
+            pairs[key] = [len(kinds), distance, None]
+            append(_EDGE, intern(line[0]), intern(line[1]), distance)
+        else:
+            record = pairs[key]
+            if distance < record[1]:
+                if record[2] is not None:
+                    kinds[record[2]] = _SKIP
+                    counts[record[0]] += 1
+                record[1] = distance
+                record[2] = len(kinds)
+                append(_UPDATE, firsts[record[0]], seconds[record[0]], distance)
+            else:
+                counts[record[0]] += 1
+
+    return descriptions, kinds, firsts, seconds, distances, counts, annotations
+
+
+def _parse_line_block(lines):
+    return _parse_edge_lines(lines, _worker_formatter, _worker_distance_cut)
+
+
+def _parse_byte_range(spec):
+    ''' parse the lines which start within [start, end) of a plain text file '''
+    path, start, end = spec
+    with open(path, 'rb') as fh:
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm)
+            if start > 0 and mm[start - 1] != 0x0A:
+                start = mm.find(b'\n', start)
+                start = size if start < 0 else start + 1
+            if end < size and mm[end - 1] != 0x0A:
+                end = mm.find(b'\n', end)
+                end = size if end < 0 else end + 1
+            if start >= end:
+                return _parse_edge_lines([], _worker_formatter, _worker_distance_cut)
+            lines = mm[start:end].decode('utf-8').splitlines()
+
+    return _parse_edge_lines(lines, _worker_formatter, _worker_distance_cut)
+
+
+def _check_header(header_line):
+    header = next(csv.reader([header_line]), [])
+    if len(header) < 3:
+        raise IOError('transmission_network.read_from_csv_file() : Expected a .csv file with at least 3 columns as input')
+
+
+def _byte_ranges(path, block_size):
+    with open(path, 'rb') as fh:
+        _check_header(fh.readline().decode('utf-8'))
+        offset = fh.tell()
+    size = os.path.getsize(path)
+    while offset < size:
+        yield (path, offset, min(size, offset + block_size))
+        offset += block_size
+
+
+def _line_blocks(fh, block_size):
+    _check_header(next(fh, ''))
+    block = []
+    block_bytes = 0
+    for line in fh:
+        block.append(line)
+        block_bytes += len(line)
+        if block_bytes >= block_size:
+            yield block
+            block = []
+            block_bytes = 0
+    if block:
+        yield block
+
+
+def _merge_records(network, parsed, default_attribute, bootstrap_mode, handled_ids, edge_annotations):
+    descriptions, kinds, firsts, seconds, distances, counts, annotations = parsed
+
+    for k, kind in enumerate(kinds):
+        if kind == _NODE:
+            patient1, attrib = descriptions[firsts[k]]
+            if patient1['rawid'] not in handled_ids:
+                handled_ids.add(patient1['rawid'])
+                network.insert_patient(patient1['id'], patient1['date'], False, attrib)
+        elif kind != _SKIP:
+            patient1 = descriptions[firsts[k]][0]
+            patient2, attrib = descriptions[seconds[k]]
+            edge = network.add_a_parsed_edge(patient1, patient2, attrib, distances[k], default_attribute, bootstrap_mode)
+            if edge is not None:
+                if counts[k] > 1:
+                    # duplicated lines only contribute degree
+                    edge.p1.degree += counts[k] - 1
+                    edge.p2.degree += counts[k] - 1
+                if k in annotations:
+                    edge_annotations[edge] = annotations[k]
+
+
+def read_csv_in_parallel(network, file_name, formatter, distance_cut=None, default_attribute=None, bootstrap_mode=False, processes=None, block_size=None):
+    ''' populate the network from an ID1,ID2,distance CSV using worker processes (the shared
+        executor, or a temporary pool if a number of processes is given).
+
+        Plain files on disk are split on line boundaries into byte ranges, which the
+        workers memory-map; anything else (compressed files, pipes, open handles) is read
+        sequentially by the parent and handed out in blocks of lines. The resulting
+        network is the same as the one built by transmission_network.read_from_csv_file
+    '''
+
+    if block_size is None:
+        block_size = default_block_size
+
+    to_close = None
+    path = file_name if isinstance(file_name, str) else getattr(file_name, 'name', None)
+
+    if isinstance(path, str) and os.path.isfile(path) and not compression_type(path):
+        tasks, parser = _byte_ranges(path, block_size), _parse_byte_range
+    else:
+        if isinstance(file_name, str):
+            to_close = file_name = open_input(file_name)
+        tasks, parser = _line_blocks(file_name, block_size), _parse_line_block
+
+    handled_ids = set()
+    edge_annotations = {}
+
+    try:
+        with executor_for(processes) as workers:
+            for parsed in workers.map(parser, tasks, setup=_initialize_worker, setup_args=(formatter, distance_cut), chunk_size=1):
+                _merge_records(network, parsed, default_attribute, bootstrap_mode, handled_ids, edge_annotations)
+    finally:
+        if to_close is not None:
+            to_close.close()
+
+    return edge_annotations
@@ -7,18 +7,124 @@ import itertools
 import operator
 import re
 import sys
-from math import log, exp, floor
+from math import log, exp
 from copy import copy, deepcopy
 from bisect import bisect_left
 from operator import itemgetter
-import hppy as hy
 import os
 import csv
-import multiprocessing
+import pickle
+import tempfile
 from functools import partial, lru_cache
 
 __all__ = ['edge', 'patient', 'transmission_network', 'parseAEH', 'parseLANL',
-           'parsePlain', 'parseRegExp', 'describe_vector', 'tm_to_datetime', 'datetime_to_tm', ]
+           'parsePlain', 'parseRegExp', 'describe_vector', 'tm_to_datetime', 'datetime_to_tm', 'load_network_snapshot', ]
+#-------------------------------------------------------------------------------
+
+
+_hyphy = None
+
+
+def hyphy():
+    ''' return the HyPhy bindings (the hppy module), importing them on first use. Only
+        fit_degree_distribution, the triangle tests for edge support and sequence
+        simulation need HyPhy; everything else works without it installed.
+    '''
+    global _hyphy
+    if _hyphy is None:
+        try:
+            import hppy
+        except ImportError as e:
+            raise ImportError('This operation needs HyPhy, but its Python bindings (hppy) could not be imported: %s' % e)
+        _hyphy = hppy
+    return _hyphy
+
+class _union_find:
+    ''' disjoint sets over hashable items, with path compression and union by size '''
+
+    def __init__(self):
+        self.parent = {}
+        self.size = {}
+
+    def find(self, x):
+        root = self.parent.setdefault(x, x)
+        if root != x:
+            while self.parent[root] != root:
+                root = self.parent[root]
+            while self.parent[x] != root:
+                self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, x, y):
+        x = self.find(x)
+        y = self.find(y)
+        if x != y:
+            if self.size.get(x, 1) < self.size.get(y, 1):
+                x, y = y, x
+            self.parent[y] = x
+            self.size[x] = self.size.get(x, 1) + self.size.pop(y, 1)
+        return x
+
+
+class _fenwick:
+    ''' prefix sums of non-negative weights (a Fenwick tree), with O(log n) point updates
+        and weighted draws '''
+
+    def __init__(self, weights):
+        self.size = len(weights)
+        self.tree = [0.] + [float(w) for w in weights]
+        for i in range(1, self.size + 1):
+            j = i + (i & -i)
+            if j <= self.size:
+                self.tree[j] += self.tree[i]
+        self.total = float(sum(weights))
+
+    def add(self, index, delta):
+        self.total += delta
+        index += 1
+        while index <= self.size:
+            self.tree[index] += delta
+            index += index & -index
+
+    def search(self, value):
+        ''' the first index at which the running sum of weights exceeds value (size if none does) '''
+        position = 0
+        step = 1 << self.size.bit_length()
+        while step:
+            if position + step <= self.size and self.tree[position + step] <= value:
+                position += step
+                value -= self.tree[position]
+            step >>= 1
+        return position
+
+# edge.direction () computes the direction itself unless it is given one
+_not_computed = object()
+
+
+class _buffered_sink:
+    ''' collect output strings and hand them to file.write in large chunks '''
+
+    def __init__(self, file, chunk_size=1 << 16):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.pending = []
+
+    def write(self, text):
+        self.pending.append(text)
+        if len(self.pending) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.file.write(''.join(self.pending))
+            self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
 #-------------------------------------------------------------------------------
 
 
@@ -102,13 +208,16 @@ def describe_vector(vector):
     return {'count': l, 'min': vector[0], 'max': vector[-1], 'mean': sum(vector) / l, 'median':  vector[l // 2] if l % 2 == 1 else 0.5 * (vector[l // 2 - 1] + vector[l // 2]), "IQR": [vector[l // 4], vector[(3 * l) // 4]]}
 
 
-def _test_edge_support(triangles, sequence_file_name, hy_instance, p_value_cutoff):
+def _test_edge_support(triangles, sequence_file_name, hy_instance, p_value_cutoff, base_frequencies=None):
+    hy = hyphy()
     if hy_instance is None:
         hy_instance = hy.HyphyInterface()
     script_path = os.path.realpath(__file__)
     hbl_path = os.path.join(os.path.dirname(script_path), "data", "HBL", "TriangleSupport.bf")
 
     hy_instance.queuevar('_py_sequence_file', sequence_file_name)
+    if base_frequencies is not None:
+        hy_instance.queuevar('_py_base_frequencies', base_frequencies)
 
     #print (sequence_file_name)
 
@@ -135,6 +244,27 @@ def _test_edge_support(triangles, sequence_file_name, hy_instance, p_value_cutof
     #print (return_object)
     return return_object
 
+# the fasta_index of the alignment whose triangles are being tested, in each worker
+_edge_support_index = [None]
+
+
+def _use_fasta_index(fasta_index):
+    _edge_support_index[0] = fasta_index
+
+
+def _test_edge_support_block(triangles, sequence_file_name, **kwargs):
+    # with a fasta_index, the triangles are tested against a file with only their sequences
+    fasta_index = _edge_support_index[0]
+    if fasta_index is None:
+        return _test_edge_support(triangles, sequence_file_name, **kwargs)
+    handle, subset = tempfile.mkstemp(suffix='.fas')
+    os.close(handle)
+    try:
+        fasta_index.write_subset(sorted(set([s for t in triangles for s in t[:3]])), subset)
+        return _test_edge_support(triangles, subset, **kwargs)
+    finally:
+        os.remove(subset)
+
 #[node.sequence,sim_matrix,hy_instance,index_to_node_id]
 
 
@@ -142,7 +272,16 @@ def _batch_sequence_sim(spec):
     return [_simulate_HIV_sequences(spec[0], spec[1], spec[2]), spec[3]]
 
 
+def _batch_sequence_sim_numpy(specs):
+    ''' the native counterpart of _batch_sequence_sim for a batch of chains; spec [2] is
+        the random seed of the chain '''
+    from .simulation import simulate_chains
+    results = simulate_chains([(spec[0], spec[1]) for spec in specs], [spec[2] for spec in specs])
+    return [[res, spec[3]] for res, spec in zip(results, specs)]
+
+
 def _simulate_HIV_sequences(sequence, tree_matrix, hy_instance):
+    hy = hyphy()
     if hy_instance is None:
         hy_instance = hy.HyphyInterface()
 
@@ -289,8 +428,10 @@ class edge:
                         return "Predates"
         return "Missing dates"
 
-    def direction(self, do_csv=False):
-        dir = self.compute_direction()
+    def direction(self, do_csv=False, dir=_not_computed):
+        # dir can pass in the result of an earlier compute_direction () call
+        if dir is _not_computed:
+            dir = self.compute_direction()
         if dir and self.p1 == dir:
             return ["%s,%s,1" % (self.p1.id, self.p2.id)] if do_csv else ['"%s" -> "%s"' % (self.p1.id, self.p2.id), 'normal']
         elif dir and self.p2 == dir:
@@ -574,6 +715,35 @@ class patient:
 #-------------------------------------------------------------------------------
 
 
+class _snapshot_unpickler(pickle.Unpickler):
+    ''' an unpickler that only builds the classes a saved network is made of, so that a
+        crafted snapshot cannot call arbitrary functions (e.g. os.system) while it is loaded
+    '''
+
+    allowed = {('hivclustering.mtnetwork', 'transmission_network'), ('hivclustering.mtnetwork', 'patient'),
+               ('hivclustering.mtnetwork', 'edge'), ('time', 'struct_time'),
+               ('builtins', 'set'), ('builtins', 'frozenset')}
+
+    def find_class(self, module, name):
+        if (module, name) not in self.allowed:
+            raise pickle.UnpicklingError('a network snapshot may not refer to %s.%s' % (module, name))
+        return super().find_class(module, name)
+
+
+def load_network_snapshot(file_name):
+    ''' load a network saved with transmission_network.save_snapshot. Snapshots are pickles:
+        only the network classes are allowed while loading, but a snapshot should still only be
+        loaded from a trusted source, as with any pickle
+    '''
+    with open(file_name, 'rb') as fh:
+        network = _snapshot_unpickler(fh).load()
+    if not isinstance(network, transmission_network):
+        raise IOError('%s does not contain a saved transmission_network' % file_name)
+    return network
+
+#-------------------------------------------------------------------------------
+
+
 class transmission_network:
 
     def __init__(self, multiple_edges=False):
@@ -584,19 +754,33 @@ class transmission_network:
         self.adjacency_list = None
         self.multiple_edges = multiple_edges
         self.sequence_ids = {}  # this will store unique sequence ids keyed by edge information (pid and date)
+        self.cluster_index = None  # cluster id -> set of nodes; kept up to date by append_pairs
 
     def read_from_csv_file(self, file_name, formatter=None, distance_cut=None, default_attribute=None, bootstrap_mode=False):
-        if formatter is None:
-            formatter = parseAEH
+        if isinstance(file_name, str):
+            # a path rather than an open file; .gz, .bz2 and .xz files are decompressed on the fly
+            from .ingest import open_input
+            with open_input(file_name) as fh:
+                return self.read_from_csv_file(fh, formatter, distance_cut, default_attribute, bootstrap_mode)
+
         edgeReader = csv.reader(file_name)
         header = next(edgeReader)
-        edgeAnnotations = {}
         if len(header) < 3:
             raise IOError('transmission_network.read_from_csv_file() : Expected a .csv file with at least 3 columns as input')
 
+        return self.read_from_pairs(edgeReader, formatter, distance_cut, default_attribute, bootstrap_mode)
+
+    def read_from_pairs(self, pairs, formatter=None, distance_cut=None, default_attribute=None, bootstrap_mode=False, added_edges=None):
+        ''' add links from an iterable of [ID1, ID2, distance, ...] records, e.g. the rows
+            of a CSV file or the pairs produced by tn93.tn93_pairs; the edges which were
+            added or updated are appended to added_edges if it is given
+        '''
+        if formatter is None:
+            formatter = parseAEH
+        edgeAnnotations = {}
         handled_ids = set()
 
-        for line in edgeReader:
+        for line in pairs:
             distance = float(line[2])
             if distance_cut is not None and distance > distance_cut:
                 self.ensure_node_is_added(line[0], formatter, default_attribute, bootstrap_mode, handled_ids)
@@ -605,9 +789,134 @@ class transmission_network:
             edge = self.add_an_edge(line[0], line[1], distance, formatter, default_attribute, bootstrap_mode)
             if edge is not None and len(line) > 3:
                 edgeAnnotations[edge] = line[2:]
+            if edge is not None and added_edges is not None:
+                added_edges.append(edge)
 
         return edgeAnnotations
 
+    def append_from_csv_file(self, file_name, formatter=None, distance_cut=None, default_attribute=None, bootstrap_mode=False):
+        ''' append_pairs for the rows of an ID1,ID2,distance CSV (a path or an open file) '''
+        if isinstance(file_name, str):
+            from .ingest import open_input
+            with open_input(file_name) as fh:
+                return self.append_from_csv_file(fh, formatter, distance_cut, default_attribute, bootstrap_mode)
+
+        edgeReader = csv.reader(file_name)
+        header = next(edgeReader)
+        if len(header) < 3:
+            raise IOError('transmission_network.append_from_csv_file() : Expected a .csv file with at least 3 columns as input')
+        return self.append_pairs(edgeReader, formatter, distance_cut, default_attribute, bootstrap_mode)
+
+    def append_pairs(self, pairs, formatter=None, distance_cut=None, default_attribute=None, bootstrap_mode=False):
+        ''' add links (e.g. those involving newly sequenced samples: new vs old and new vs new)
+            to a network whose clusters have already been computed, and update the clusters in
+            place instead of recomputing them. Clusters joined by the new links are merged
+            through union-find; only the nodes of the smaller clusters are relabeled, and the
+            largest cluster in each merged group keeps its ID. The adjacency list, if there is
+            one, is extended with the new links.
+
+            Returns a report {'edges': new links, 'nodes': new nodes, 'new': [...], 'grown': [...],
+            'merged': [...]}, where each entry describes one cluster: 'new' clusters contain
+            no previously clustered node, 'grown' clusters gained previously unclustered or new
+            nodes, and 'merged' clusters absorbed other existing clusters ('from' lists the IDs
+            of all the merged clusters and 'sizes before' their previous sizes).
+        '''
+        if self.cluster_index is None:
+            if all(n.cluster_id is None for n in self.nodes):
+                self.compute_clusters()
+            elif self.adjacency_list is None:
+                # keep the cluster IDs the network already has (e.g. a snapshot saved after
+                # clear_adjacency); reclustering would renumber them
+                self.compute_adjacency()
+            self.cluster_index = {}
+            for node in self.nodes:
+                if node.cluster_id is not None:
+                    self.cluster_index.setdefault(node.cluster_id, set()).add(node)
+
+        node_count = len(self.nodes)
+        edge_count = len(self.edges)
+        added_edges = []
+        self.read_from_pairs(pairs, formatter, distance_cut, default_attribute, bootstrap_mode, added_edges)
+
+        if self.adjacency_list is not None and self.type_of_adjacency_list() not in (None, 'patient'):
+            self.clear_adjacency(clear_filter=False)
+
+        # clusters, as ('cluster', ID), and unclustered nodes, as ('node', node), are the elements being merged
+        components = _union_find()
+        for an_edge in added_edges:
+            stored = self.edges.get(an_edge)
+            if stored is None or not stored.visible:
+                continue
+            if self.adjacency_list is not None:
+                self.adjacency_list.setdefault(stored.p1, set()).add(stored.p2)
+                self.adjacency_list.setdefault(stored.p2, set()).add(stored.p1)
+            components.union(('cluster', stored.p1.cluster_id) if stored.p1.cluster_id is not None else ('node', stored.p1),
+                             ('cluster', stored.p2.cluster_id) if stored.p2.cluster_id is not None else ('node', stored.p2))
+
+        groups = {}
+        for element in components.parent:
+            groups.setdefault(components.find(element), []).append(element)
+
+        report = {'edges': len(self.edges) - edge_count, 'nodes': len(self.nodes) - node_count, 'new': [], 'grown': [], 'merged': []}
+        next_id = max(self.cluster_index.keys(), default=0) + 1
+
+        for group in groups.values():
+            clusters = sorted([k[1] for k in group if k[0] == 'cluster'], key=lambda k: (-len(self.cluster_index[k]), k))
+            nodes = [k[1] for k in group if k[0] == 'node']
+            if not nodes and len(clusters) == 1:
+                continue
+
+            if clusters:
+                keep = clusters[0]
+                sizes_before = [len(self.cluster_index[k]) for k in clusters]
+            else:
+                keep = next_id
+                next_id += 1
+                self.cluster_index[keep] = set()
+
+            members = self.cluster_index[keep]
+            for k in clusters[1:]:
+                for node in self.cluster_index.pop(k):
+                    node.cluster_id = keep
+                    members.add(node)
+            for node in nodes:
+                node.cluster_id = keep
+                members.add(node)
+
+            if len(clusters) > 1:
+                report['merged'].append({'cluster': keep, 'from': clusters, 'sizes before': sizes_before, 'size': len(members)})
+            elif clusters:
+                report['grown'].append({'cluster': keep, 'size before': sizes_before[0], 'size': len(members)})
+            else:
+                report['new'].append({'cluster': keep, 'size': len(members)})
+
+        return report
+
+    def save_snapshot(self, file_name):
+        ''' save the whole network (nodes, edges, clusters and caches) for load_network_snapshot;
+            the file is a pickle, so only load snapshots that you (or someone you trust) wrote
+        '''
+        with open(file_name, 'wb') as fh:
+            pickle.dump(self, fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def read_from_csv_file_parallel(self, file_name, formatter=None, distance_cut=None, default_attribute=None, bootstrap_mode=False, processes=None):
+        ''' same as read_from_csv_file, but the lines are parsed, filtered and deduplicated by
+            a pool of worker processes; file_name can be a path or an open file
+        '''
+        from .ingest import read_csv_in_parallel
+        if formatter is None:
+            formatter = parseAEH
+        return read_csv_in_parallel(self, file_name, formatter, distance_cut, default_attribute, bootstrap_mode, processes)
+
+    def read_from_process(self, command, formatter=None, distance_cut=None, default_attribute=None, bootstrap_mode=False, tee=None):
+        ''' run command (e.g. tn93 writing to stdout), which must produce an ID1,ID2,distance CSV,
+            and add the pairs to the network while the command is still producing them;
+            raises RuntimeError if the command fails
+        '''
+        from .ingest import process_reader
+        with process_reader(command, tee=tee) as fh:
+            return self.read_from_csv_file(fh, formatter, distance_cut, default_attribute, bootstrap_mode)
+
     def make_network_edge(self, *args, **kwargs):
         return edge(*args, date_aware=self.multiple_edges, **kwargs)
 
@@ -623,14 +932,21 @@ class transmission_network:
             patient1, attrib = header_parser(id1)
             self.insert_patient(patient1['id'], patient1['date'], False, attrib)
 
-    def sample_from_network(self, how_many_nodes=100, how_many_edges=None, node_sampling_bias=0.0):
+    def sample_from_network(self, how_many_nodes=100, how_many_edges=None, node_sampling_bias=0.0, seed=None):
+        ''' a random subset network: how_many_edges edges, or how_many_nodes nodes and the edges
+            between them. With node_sampling_bias > 0, nodes are drawn one at a time, starting
+            from the last node of the network, and nodes linked to those already drawn have
+            weight 1 + node_sampling_bias instead of 1. seed makes the sample reproducible
+            (the random module is used if it is None) '''
+        rng = random if seed is None else random.Random(seed)
+
         if how_many_edges is not None:
             if how_many_edges >= len(self.edges):
                 return self
             subset_network = transmission_network()
-            sampled_edges = random.sample(list(self.edge_iterator()), how_many_edges)
+            sampled_edges = rng.sample(list(self.edge_iterator()), how_many_edges)
             for an_edge in sampled_edges:
-                subset_network.add_an_edge(an_edge.p1.id, an_edge.p2.id, self[an_edge], header_parser=parsePlain)
+                subset_network.add_an_edge(an_edge.p1.id, an_edge.p2.id, self.distances[an_edge], header_parser=parsePlain)
             return subset_network
 
         if how_many_nodes >= len(self.nodes):
@@ -639,65 +955,46 @@ class transmission_network:
         subset_network = transmission_network()
 
         if node_sampling_bias > 0.:
-            nodes = set()
-            left_over = set(list(self.nodes))
-            connected_to_existing = set()
-
-            node_neighbs = {}
-            sampling_probs = {}
-
             if self.adjacency_list is None:
                 self.compute_adjacency()
 
-            for a_node in self.nodes:
-                #node_neighbs [a_node]   = self.get_node_neighborhood (a_node.id,True,False)
-                node_neighbs[a_node] = self.adjacency_list[a_node] if a_node in self.adjacency_list else set()
-                sampling_probs[a_node] = 1.
-
-            nodes.add(a_node)
-            left_over.remove(a_node)
-            connected_to_existing.update(node_neighbs[a_node])
-            connected_to_existing.add(a_node)
-
-            for a_node in connected_to_existing:
-                sampling_probs[a_node] += node_sampling_bias
-
-            upper_bound = len(left_over) + (len(connected_to_existing) - 1) * node_sampling_bias
-
-            while len(nodes) < how_many_nodes:
-                up_to = random.random() * upper_bound
-                local_sum = 0.
-                for a_node in left_over:
-                    local_sum += sampling_probs[a_node]
-                    if local_sum >= up_to:
-                        break
-
-                if local_sum < up_to:
-                    raise Exception('Sampling fubar')
+            node_list = list(self.nodes)
+            index = {a_node: k for k, a_node in enumerate(node_list)}
+            weights = _fenwick([1.] * len(node_list))
+            weights_by_node = dict.fromkeys(node_list, 1.)
+            connected_to_existing = set()
+            nodes = []
 
-                nodes.add(a_node)
+            def draw(a_node):
+                nodes.append(a_node)
                 connected_to_existing.add(a_node)
-                new_connections = node_neighbs[a_node] - connected_to_existing
-                connected_to_existing.update(new_connections)
-                #print (a_node.id, len(new_connections), upper_bound, up_to, sum ([sampling_probs[k] for k in left_over]))
-                left_over.remove(a_node)
+                weights.add(index[a_node], -weights_by_node[a_node])
+                weights_by_node[a_node] = 0.
+                for neighbor in self.adjacency_list.get(a_node, ()):
+                    if neighbor not in connected_to_existing:
+                        connected_to_existing.add(neighbor)
+                        weights.add(index[neighbor], node_sampling_bias)
+                        weights_by_node[neighbor] += node_sampling_bias
 
-                upper_bound += len(new_connections) * node_sampling_bias - sampling_probs[a_node]
+            draw(node_list[-1])
 
-                for a_node in new_connections:
-                    sampling_probs[a_node] += node_sampling_bias
-
-            #print (sampling_probs.values())
+            while len(nodes) < how_many_nodes:
+                k = weights.search(rng.random() * weights.total)
+                # rounding can leave the running sums short of the total; draw again
+                if k < len(node_list) and weights_by_node[node_list[k]] > 0.:
+                    draw(node_list[k])
         else:
-            nodes = random.sample(list(self.nodes), how_many_nodes)
+            nodes = rng.sample(list(self.nodes), how_many_nodes)
 
         for a_node in nodes:
             this_node = self.nodes[a_node]
             subset_network.insert_patient(this_node.id, this_node.dates[0], False, None)
 
+        # one pass over the edges, with a set lookup per endpoint
+        sampled = set(nodes)
         for an_edge in self.edge_iterator():
-            if an_edge.p1 in subset_network.nodes and an_edge.p2 in subset_network.nodes:
-                subset_network.add_an_edge(an_edge.p1.id, an_edge.p2.id, self[an_edge], header_parser=parsePlain)
+            if an_edge.p1 in sampled and an_edge.p2 in sampled:
+                subset_network.add_an_edge(an_edge.p1.id, an_edge.p2.id, self.distances[an_edge], header_parser=parsePlain)
 
         return subset_network
 
@@ -790,9 +1087,80 @@ class transmission_network:
                 self.add_an_edge(str(node_id), str(k), 1, header_parser=parsePlain)
             attach_to.extend([k, node_id])
 
-        print(max(dates_by_chain), file = sys.stderr)
+        if start_date is not None:
+            print(max(dates_by_chain), file = sys.stderr)
         return simulation_start
 
+    def insert_forest(self, parents, dates=None):
+        ''' add nodes with IDs "1" ... "n" and a link (distance 1) from every node k to node
+            parents [k] (nodes with parents [k] < 0 are roots), in one pass; dates gives the
+            (struct_time) date of each node, and the raw sequence IDs are then AEH headers.
+            The result is that of add_an_edge for every link; returns the root patients '''
+        node_count = len(parents)
+        parents = [int(k) for k in parents]
+        if dates is None:
+            dates = [None] * node_count
+
+        formatted = {None: (None, None)}  # date -> (mmddyyyy, mm-dd-yyyy)
+        for date in set(dates):
+            if date not in formatted:
+                formatted[date] = (time.strftime("%m%d%Y", date), time.strftime("%m-%d-%Y", date))
+
+        patients = []
+        raw_ids = []
+        for k, date in enumerate(dates):
+            node_id = str(k + 1)
+            patients.append(self.insert_patient(node_id, date, False, None))
+            raw_ids.append(node_id if date is None else "|".join((node_id, formatted[date][0])))
+
+        degrees = [0] * node_count
+        roots = []
+        for k, parent in enumerate(parents):
+            if parent < 0:
+                roots.append(patients[k])
+                continue
+            degrees[k] += 1
+            degrees[parent] += 1
+            new_edge = self.make_network_edge(patients[k], patients[parent], dates[k], dates[parent], True, None, (raw_ids[k], raw_ids[parent]))
+            if new_edge not in self.edges:
+                self.edges[new_edge] = new_edge
+                self.distances[new_edge] = 1
+
+        for k, degree in enumerate(degrees):
+            if degree:
+                patients[k].degree += degree
+                key = patients[k].id if dates[k] is None else "|".join((patients[k].id, formatted[dates[k]][1]))
+                if key not in self.sequence_ids:
+                    self.sequence_ids[key] = raw_ids[k]
+
+        return roots
+
+    def generate_pref_attachment_network(self, network_size=100, start_with=1, random_attachment=0.0, start_new_tree=0.0, start_date=None, tick_rate=None, poisson_mean=None, seed=None):
+        ''' a faster create_a_pref_attachment_network for large simulations, with the same options
+            and a seed: the forest is drawn with NumPy (see simulation.pref_attachment_forest)
+            and added with insert_forest. Unlike create_a_pref_attachment_network, every node
+            takes the date of its own chain (the original uses the date of whichever chain last
+            advanced, so a node can predate its parent), and roots take the starting date of
+            their chain. Returns the roots. '''
+        from .simulation import pref_attachment_forest
+
+        if start_date is not None and tick_rate is None:
+            raise ValueError('Dated networks need a tick_rate')
+
+        forest = pref_attachment_forest(network_size, start_with, random_attachment, start_new_tree,
+                                        tick_rate if start_date is not None else None, poisson_mean, seed)
+        dates = None
+        if forest['days'] is not None:
+            # dates are kept to the day, as they are when written as AEH headers
+            start_of_day = getattr(start_date, 'hour', 0) / 24 + getattr(start_date, 'minute', 0) / 1440 + getattr(start_date, 'second', 0) / 86400
+            day_numbers = (forest['days'] + start_of_day).astype(int).tolist()
+            first_day = datetime.date(start_date.year, start_date.month, start_date.day)
+            by_day = dict((day, (first_day + datetime.timedelta(days=day)).timetuple()) for day in set(day_numbers))
+            dates = [by_day[day] for day in day_numbers]
+            print(first_day + datetime.timedelta(days=max(day_numbers)), file=sys.stderr)
+
+        return self.insert_forest(forest['parents'], dates)
+
     def dump_as_fasta(self, fh, add_dates=False, filter_on_set=None):
         for n in self.nodes:
             if filter_on_set is not None and n not in filter_on_set:
@@ -801,18 +1169,34 @@ class transmission_network:
                                  time.strftime("%m%d%Y", n.dates[0]) + "|" + str(n.dates[1]), n.sequence), file=fh)
 
     def construct_cluster_representation(self, root_node, already_simulated, the_cluster):
-        if root_node in self.adjacency_list:
-            for n in self.adjacency_list[root_node]:
+        ''' append to the_cluster the [parent, child] pairs of a depth-first walk from
+            root_node through the nodes not in already_simulated (which are added to it) '''
+        if root_node not in self.adjacency_list:
+            return
+        # the neighbours still to visit for every node on the current path
+        stack = [(root_node, iter(self.adjacency_list[root_node]))]
+        while stack:
+            parent, neighbours = stack[-1]
+            for n in neighbours:
                 if n not in already_simulated:
                     already_simulated.add(n)
-                    the_cluster.append([root_node, n])
-                    self.construct_cluster_representation(n, already_simulated, the_cluster)
+                    the_cluster.append([parent, n])
+                    if n in self.adjacency_list:
+                        stack.append((n, iter(self.adjacency_list[n])))
+                    break
+            else:
+                stack.pop()
+
+    def simulate_sequence_evolution(self, founders, founder_sequences, rate_per_year, sampling_delay=None, engine='numpy'):
+        ''' simulate the sequences of the transmission chain of every founder under the model
+            of SimulateSequence.bf; engine 'numpy' (simulation.simulate_chains, seeded from
+            the random module) or 'hyphy' (runs the batch file once per chain) '''
+        if engine not in ('numpy', 'hyphy'):
+            raise ValueError("Unknown sequence simulation engine '%s'" % engine)
 
-    def simulate_sequence_evolution(self, founders, founder_sequences, rate_per_year, sampling_delay=None):
         if self.adjacency_list is None:
             self.compute_adjacency()
 
-        hy_instance = hy.HyphyInterface()
         already_simulated = set()
 
         objects_to_send = []
@@ -824,52 +1208,57 @@ class transmission_network:
 
         #delay_dates = []
 
+        # the first position of every founder in founders
+        founder_index = {}
+        for k, founder in enumerate(founders):
+            founder_index.setdefault(founder, k)
+
         for node in self.nodes:
-            try:
-                in_founders = founders.index(node)
-                already_simulated.add(node)
-                node.sequence = founder_sequences[in_founders]
-                the_cluster = []
-                self.construct_cluster_representation(node, already_simulated, the_cluster)
+            if node not in founder_index:
+                continue
+            already_simulated.add(node)
+            node.sequence = founder_sequences[founder_index[node]]
+            the_cluster = []
+            self.construct_cluster_representation(node, already_simulated, the_cluster)
 
-                delay_date = 1 / beta_mean * sampling_delay * \
-                    random.betavariate(alpha, beta) if sampling_delay is not None else 0.0
-                #node.dates.append(delay_date)
-                #delay_dates.append(delay_date)
+            delay_date = 1 / beta_mean * sampling_delay * \
+                random.betavariate(alpha, beta) if sampling_delay is not None else 0.0
+            #node.dates.append(delay_date)
+            #delay_dates.append(delay_date)
 
-                sim_matrix = [[1, -1, 0, delay_date / 365 * rate_per_year]]
+            sim_matrix = [[1, -1, 0, delay_date / 365 * rate_per_year]]
 
-                node_id_to_index = {node.id: 1}
-                index_to_node_id = {1: node}
+            node_id_to_index = {node.id: 1}
+            index_to_node_id = {1: node}
 
-                for i, pair in enumerate(the_cluster):
-                    for n in pair:
-                        if n.id not in node_id_to_index:
-                            node_id_to_index[n.id] = len(node_id_to_index) + 1
-                            index_to_node_id[len(node_id_to_index)] = n
+            for i, pair in enumerate(the_cluster):
+                for n in pair:
+                    if n.id not in node_id_to_index:
+                        node_id_to_index[n.id] = len(node_id_to_index) + 1
+                        index_to_node_id[len(node_id_to_index)] = n
 
-                    delay_date = 1 / beta_mean * sampling_delay * \
-                        random.betavariate(alpha, beta) if sampling_delay is not None else 0.0
-                    #delay_dates.append(delay_date)
-                    #pair[1].dates.append(delay_date)
-                    sim_matrix.append([node_id_to_index[pair[1].id], node_id_to_index[pair[0].id], abs(tm_to_datetime(
-                        pair[1].dates[0]) - tm_to_datetime(pair[0].dates[0])).days * rate_per_year / 365, delay_date / 365 * rate_per_year])
+                delay_date = 1 / beta_mean * sampling_delay * \
+                    random.betavariate(alpha, beta) if sampling_delay is not None else 0.0
+                #delay_dates.append(delay_date)
+                #pair[1].dates.append(delay_date)
+                sim_matrix.append([node_id_to_index[pair[1].id], node_id_to_index[pair[0].id], abs(tm_to_datetime(
+                    pair[1].dates[0]) - tm_to_datetime(pair[0].dates[0])).days * rate_per_year / 365, delay_date / 365 * rate_per_year])
 
-                #seqs = _simulate_HIV_sequences (node.sequence, sim_matrix, hy_instance)
-                index_mapper.append(index_to_node_id)
-                objects_to_send.append([node.sequence, sim_matrix, None, len(objects_to_send)])
+            #seqs = _simulate_HIV_sequences (node.sequence, sim_matrix, hy_instance)
+            index_mapper.append(index_to_node_id)
+            objects_to_send.append([node.sequence, sim_matrix, random.getrandbits(64) if engine == 'numpy' else None,
+                                    len(objects_to_send)])
 
-                # for id, seq in seqs.items():
-                #    index_to_node_id[id].sequence = seq
+            # for id, seq in seqs.items():
+            #    index_to_node_id[id].sequence = seq
 
-                #print (sim_matrix)
-            except ValueError:
-                pass
+            #print (sim_matrix)
 
-        pool = multiprocessing.Pool()
-        processed_objects = pool.map(_batch_sequence_sim, objects_to_send)
-        pool.close()
-        pool.join()
+        from .executor import get_executor
+        if engine == 'numpy':
+            processed_objects = get_executor().map(_batch_sequence_sim_numpy, objects_to_send, batch=True, ordered=False)
+        else:
+            processed_objects = get_executor().map(_batch_sequence_sim, objects_to_send, ordered=False)
 
         #print (describe_vector (delay_dates), file = sys.stderr)
 
@@ -931,29 +1320,30 @@ class transmission_network:
                         
                     
 
-    def clustering_coefficients(self, node_list=None):
-        clustering_coefficiencts = {}
+    def triangle_statistics(self):
+        ''' {node: (number of triangles, local clustering coefficient)} for the nodes with
+            visible edges, and the transitivity of the network (3 * triangles / connected triples) '''
+        from .triangles import csr_from_adjacency, triangle_counts, clustering_values, transitivity
+        import numpy as np
 
         if self.adjacency_list is None:
             self.compute_adjacency()
 
+        nodes, indptr, indices = csr_from_adjacency(self.adjacency_list)
+        counts = triangle_counts(indptr, indices)
+        degrees = np.diff(indptr)
+        values = clustering_values(counts, degrees)
+        return dict(zip(nodes, zip(counts.tolist(), values.tolist()))), transitivity(counts, degrees)
+
+    def clustering_coefficients(self, node_list=None):
+        ''' local clustering coefficients of the nodes (in node_list) with at least two neighbors '''
+        by_node = self.triangle_statistics()[0]
+
         if node_list is None:
             node_list = self.adjacency_list.keys()
 
-        precompute_neighborhoods = {}
-        for a_node in node_list:
-            precompute_neighborhoods[a_node] = set(self.get_node_neighborhood(a_node.id))
-
-        for a_node in node_list:
-            if a_node in self.adjacency_list:
-                my_hbhd = precompute_neighborhoods[a_node]
-                nbhd_size = len(my_hbhd)
-                if nbhd_size > 1:
-                    edges_found = 0
-                    for nb_node in my_hbhd:
-                        edges_found += len(precompute_neighborhoods[nb_node].intersection(my_hbhd))
-                    clustering_coefficiencts[a_node] = float(edges_found) / nbhd_size / (nbhd_size - 1)
-        return clustering_coefficiencts
+        return {a_node: by_node[a_node][1] for a_node in node_list
+                if a_node in self.adjacency_list and len(self.adjacency_list[a_node]) > 1}
 
     def randomize_attribute(self, attribute_value, clusters=None):
         if clusters is None:
@@ -1045,6 +1435,11 @@ class transmission_network:
         patient1, attrib = header_parser(id1)
         patient2, attrib = header_parser(id2)
 
+        return self.add_a_parsed_edge(patient1, patient2, attrib, distance, edge_attribute, bootstrap_mode, node_only)
+
+    def add_a_parsed_edge(self, patient1, patient2, attrib, distance, edge_attribute=None, bootstrap_mode=False, node_only=False):
+        ''' same as add_an_edge, but the IDs have already been split by a header parser
+        '''
         loop = patient1['id'] == patient2['id']
 
         p1 = self.insert_patient(patient1['id'], patient1['date'], not loop and not node_only, attrib)
@@ -1146,60 +1541,60 @@ class transmission_network:
         for i in range(node_count):
             d = 0
             for j, p in enumerate(distances['distances'][i]):
-                if p is None:
-                    if j == i:
-                        continue
+                if j == i:
+                    continue
+                if p is None or p == float('inf'):
                     d = None
                     break
-                else:
-                    d += p
+                d += float(p)
 
-            result[distances['ordering'][i]] = d / (node_count - 1)
+            result[distances['ordering'][i]] = d / (node_count - 1) if d is not None else None
 
         return result
 
-    def compute_shortest_paths(self, subset=None, use_actual_distances=False):
+    def _subset_graph(self, subset, use_actual_distances=False):
+        ''' adjacency lists (positions in subset) over visible edges, and matching lists of
+            edge lengths (the shortest distance linking each pair) if use_actual_distances '''
+        index = {n: k for k, n in enumerate(subset)}
+        lengths = {}
+        for e in self.edge_iterator():
+            if e.visible and e.p1 in index and e.p2 in index and e.p1 != e.p2:
+                pair = (index[e.p1], index[e.p2])
+                d = self.distances[e] if use_actual_distances else 1
+                for key in (pair, pair[::-1]):
+                    if key not in lengths or d < lengths[key]:
+                        lengths[key] = d
+        adjacency = [[] for k in subset]
+        weights = [[] for k in subset]
+        for (i, j), d in lengths.items():
+            adjacency[i].append(j)
+            weights[i].append(d)
+        return adjacency, weights if use_actual_distances else None
+
+    def shortest_path_matrix(self, subset=None, use_actual_distances=False):
+        ''' shortest path lengths between the nodes of subset, in steps or, with use_actual_distances,
+            summed edge distances: 'distances' is a numpy matrix with inf for pairs without a path
+            (np.float32 for steps, np.float64 for summed distances) or, for subsets larger than
+            centrality.dense_limit, a centrality.path_length_rows, which computes each row (an
+            array of the same kind) when it is requested '''
+        from .centrality import shortest_path_lengths
         self.compute_adjacency()
 
         if subset is None:
-            subset = self.adjacency_list.keys()
+            subset = list(self.adjacency_list.keys())
 
-        node_count = len(subset)
-        distances = []
-
-        for a_node in (subset):
-            distances.append([None for k in range(node_count)])
-
-        for index, a_node in enumerate(subset):
-            for index2, second_node in enumerate(subset):
-                if second_node != a_node:
-                    if second_node in self.adjacency_list[a_node]:
-                        distances[index][index2] = 1
-                        distances[index2][index] = 1
+        return {'ordering': subset, 'distances': shortest_path_lengths(*self._subset_graph(subset, use_actual_distances))}
 
-        distances2 = deepcopy(distances)
-
-        for index_k, n_k in enumerate(subset):
-            for index_i, n_i in enumerate(subset):
-                for index_j, n_j in enumerate(subset):
-                    if n_i != n_j:
-                        d_ik = distances[index_k][index_i]
-                        d_jk = distances[index_k][index_j]
-                        d_ij = distances[index_i][index_j]
-                        if d_ik is not None and d_jk is not None:
-                            d_ik += d_jk
-                            if d_ij is None or d_ij > d_ik:
-                                distances2[index_i][index_j] = d_ik
-                                distances2[index_j][index_i] = d_ik
-                                continue
-                        distances2[index_j][index_i] = distances[index_j][index_i]
-                        distances2[index_i][index_j] = distances[index_i][index_j]
-
-            t = distances2
-            distances2 = distances
-            distances = t
-
-        return {'ordering': subset, 'distances': distances}
+    def compute_shortest_paths(self, subset=None, use_actual_distances=False):
+        ''' shortest path lengths between the nodes of subset, in steps or, with use_actual_distances,
+            summed edge distances: 'distances' is a list of lists with None on the diagonal and
+            for pairs without a path; shortest_path_matrix has the same lengths as a numpy matrix '''
+        paths = self.shortest_path_matrix(subset, use_actual_distances)
+        distances = []
+        for i, row in enumerate(paths['distances']):
+            distances.append([None if j == i or d == float('inf') else (d if use_actual_distances else int(d))
+                              for j, d in enumerate(row.tolist())])
+        return {'ordering': paths['ordering'], 'distances': distances}
 
     def compute_shortest_paths_with_reconstruction(self, subset=None, use_actual_distances=False):
         ''' Same as compute shortest paths, but with an additional next parameter for reconstruction'''
@@ -1216,12 +1611,10 @@ class transmission_network:
             distances.append([None for k in range(node_count)])
             next.append([None for k in range(node_count)])
 
-        for index, a_node in enumerate(subset):
-            for index2, second_node in enumerate(subset):
-                if second_node != a_node:
-                    if second_node in self.adjacency_list[a_node]:
-                        distances[index][index2] = 1
-                        distances[index2][index] = 1
+        adjacency, weights = self._subset_graph(subset, use_actual_distances)
+        for index, neighbors in enumerate(adjacency):
+            for k, index2 in enumerate(neighbors):
+                distances[index][index2] = weights[index][k] if weights is not None else 1
 
         for index_i, n_i in enumerate(subset):
             for index_j, n_j in enumerate(subset):
@@ -1293,11 +1686,18 @@ class transmission_network:
             return 0
         return sum([node in sublist for sublist in paths]) / len(paths)
 
-    def betweenness_centrality(self, node, paths=None, newsubset=None):
-        ''' Returns dictonary of nodes with betweenness centrality as the value'''
+    def betweenness_centrality(self, node, paths=None, newsubset=None, use_actual_distances=False):
+        ''' Returns the betweenness centrality of the node with this ID; without precomputed
+            paths, it is computed by Brandes' algorithm (see hivclustering.centrality) '''
 
         if paths == None:
-            paths = self.compute_shortest_paths_with_reconstruction(subset=newsubset)
+            from .centrality import path_centralities
+            self.compute_adjacency()
+            subset = list(newsubset if newsubset is not None else self.adjacency_list.keys())
+            for index, x in enumerate(subset):
+                if x.id == node:
+                    return path_centralities(*self._subset_graph(subset, use_actual_distances))[1][index]
+            return None
 
         # find id in ordering
         index = -1
@@ -1320,6 +1720,20 @@ class transmission_network:
         # Reconstruct each shortest path and check if node is in it
         return sum([self.paths_with_node(index, paths['next'], i, j) for i in range(length) for j in range(length)]) * scale
 
+    def closeness_centrality(self, subset=None, use_actual_distances=False, harmonic=False):
+        ''' node -> closeness among the nodes of subset (default: all linked nodes), as defined in
+            hivclustering.centrality (0 for nodes which reach no other node); harmonic
+            centrality instead if harmonic is True '''
+        from .centrality import subset_closeness
+        self.compute_adjacency()
+        if subset is None:
+            subset = list(self.adjacency_list.keys())
+        values = subset_closeness(*self._subset_graph(subset, use_actual_distances))[1 if harmonic else 0]
+        return dict(zip(subset, values))
+
+    def harmonic_centrality(self, subset=None, use_actual_distances=False):
+        return self.closeness_centrality(subset, use_actual_distances, harmonic=True)
+
     def get_all_treated_within_range(self, daterange, outside=False):
         selection = []
         for node in self.nodes:
@@ -1582,6 +1996,7 @@ class transmission_network:
             del self.nodes[delete_me]
 
     def compute_clusters(self, singletons=False, adjacency_matrix=None):
+        self.cluster_index = None
 
         if self.adjacency_list is None and adjacency_matrix is None:
             self.compute_adjacency()
@@ -1598,49 +2013,72 @@ class transmission_network:
                 self.breadth_first_traverse(node, cluster_id, use_this_am)
 
     def breadth_first_traverse(self, node, cluster_id, use_this_am):
+        ''' give node (a new cluster ID unless it has one) and every unassigned node it reaches
+            the same cluster ID; a loop over a stack, so long chains do not hit the recursion limit '''
         if node.cluster_id == None:
             cluster_id[0] += 1
             node.cluster_id = cluster_id[0]
-        if node in use_this_am:
-            for neighbor_node in use_this_am[node]:
+        to_visit = [node]
+        while to_visit:
+            current = to_visit.pop()
+            for neighbor_node in use_this_am.get(current, ()):
                 if neighbor_node.cluster_id == None:
                     neighbor_node.cluster_id = node.cluster_id
-                    self.breadth_first_traverse(neighbor_node, cluster_id, use_this_am)
+                    to_visit.append(neighbor_node)
 
     def generate_csv(self, file):
-        file.write("ID1,ID2,Distance")
-        for edge in self.edge_iterator():
-            if edge.visible:
-                file.write("%s,%s,%g\n" % (edge.p1.id, edge.p2.id, self.distances[edge]))
+        with _buffered_sink(file) as sink:
+            sink.write("ID1,ID2,Distance\n")
+            for edge in self.edge_iterator():
+                if edge.visible:
+                    sink.write("%s,%s,%g\n" % (edge.p1.id, edge.p2.id, self.distances[edge]))
 
     def write_clusters(self, file):
-        file.write("SequenceID,ClusterID\n")
-        for node in self.nodes:
-            if node.cluster_id is not None:
-                for d in node.dates:
-                    try:
-                        file.write("%s,%d\n" %
-                                   (self.sequence_ids[self.make_sequence_key(node.id, d)], node.cluster_id))
-                        break
-                    except KeyError:
-                        pass
+        with _buffered_sink(file) as sink:
+            sink.write("SequenceID,ClusterID\n")
+            for node in self.nodes:
+                if node.cluster_id is not None:
+                    for d in node.dates:
+                        sequence_id = self.sequence_ids.get(self.make_sequence_key(node.id, d))
+                        if sequence_id is not None:
+                            sink.write("%s,%d\n" % (sequence_id, node.cluster_id))
+                            break
+
+    def export_columnar(self, path):
+        ''' write node, edge and cluster tables to a binary columnar archive;
+            see hivclustering.columnar for the layout and load_columnar to read it back '''
+        from .columnar import export_columnar
+        export_columnar(self, path)
+
+    def export_shared(self):
+        ''' copy node IDs, clusters, dates and the CSR adjacency into shared memory for worker
+            processes; returns a sharednetwork.shared_network (close it when done) '''
+        from .sharednetwork import shared_network
+        return shared_network(self)
+
+    def write_centralities(self, file, progress=None, use_actual_distances=False):
+        ''' clusters are computed in parallel, largest first (see hivclustering.centrality),
+            and written in cluster order; progress is passed on to cluster_centralities.
+            With use_actual_distances, all path-based values are weighted by edge distances.
+            Triangle counts and clustering coefficients are those of triangle_statistics '''
+        from .centrality import cluster_centralities
 
-    def write_centralities(self, file):
         writer = csv.writer(file, delimiter='\t')
         writer.writerow(["ClusterID", "NodeID", "MeanPathLength",
-                         "RelativeToClusterMin", "Degrees", "Betweenness Centrality"])
+                         "RelativeToClusterMin", "Degrees", "Betweenness Centrality",
+                         "Closeness Centrality", "Harmonic Centrality", "Triangles", "Clustering Coefficient"])
 
         centralities = []
-
-        for cid, a_cluster in self.retrieve_clusters(singletons=False).items():
-            paths = self.compute_shortest_paths(subset=a_cluster)
-            paths = self.compute_path_stat(paths)
-            rpaths = self.compute_shortest_paths_with_reconstruction(subset=a_cluster)
-            min_d = min(paths.values())
-            for n, d in paths.items():
-                self.has_node_with_id(n.id).set_label("%2.3g" % d)
-                centralities.append([cid, n.id, d, d / min_d, n.degree,
-                                     self.betweenness_centrality(n.id, paths=rpaths)])
+        triangles = self.triangle_statistics()[0]
+
+        for cid, cluster_nodes, mean_paths, betweenness, closeness, harmonic in \
+                cluster_centralities(self, progress, use_actual_distances=use_actual_distances):
+            min_d = min([d for d in mean_paths if d is not None], default=None)
+            for n, d, b, c, h in zip(cluster_nodes, mean_paths, betweenness, closeness, harmonic):
+                if d is not None:
+                    n.set_label("%2.3g" % d)
+                t, cc = triangles.get(n, (0, 0.))
+                centralities.append([cid, n.id, d, d / min_d if d is not None else None, n.degree, b, c, h, t, cc])
                 writer.writerow([str(k) for k in centralities[-1]])
 
         return centralities
@@ -1702,44 +2140,45 @@ class transmission_network:
         if self.adjacency_list is None:
             self.compute_adjacency()
 
-        file.write('digraph G { overlap="voronoi";\n outputorder = edgesfirst;\nnode[style=filled];\n')
         nodes_drawn = set ()
 
         directed = {'undirected': 0, 'directed': 0}
-        
-        for edge in self.edge_iterator() if reduce_edges == False else self.reduce_edge_set():
-            if edge.visible:
-                distance = self.distances[edge]
 
-                if edge.p1 not in nodes_drawn:
-                    nodes_drawn.add (edge.p1)
-                    file.write(edge.p1.get_dot_string(year_vis))
-                if edge.p2 not in nodes_drawn:
-                    nodes_drawn.add (edge.p2)
-                    file.write(edge.p2.get_dot_string(year_vis))
+        with _buffered_sink(file) as sink:
+            sink.write('digraph G { overlap="voronoi";\n outputorder = edgesfirst;\nnode[style=filled];\n')
+
+            for edge in self.edge_iterator() if reduce_edges == False else self.reduce_edge_set():
+                if edge.visible:
+                    if edge.p1 not in nodes_drawn:
+                        nodes_drawn.add (edge.p1)
+                        sink.write(edge.p1.get_dot_string(year_vis))
+                    if edge.p2 not in nodes_drawn:
+                        nodes_drawn.add (edge.p2)
+                        sink.write(edge.p2.get_dot_string(year_vis))
+
+                    source = edge.compute_direction()
+                    if source is None:
+                        directed['undirected'] += 1
+                    else:
+                        directed['directed'] += 1
+                    edge_attr = edge.direction(dir=source)
 
-                if isinstance(edge.compute_direction(), type(None)):
-                    directed['undirected'] += 1
-                else:
-                    directed['directed'] += 1
-                edge_attr = edge.direction()
+                    if year_vis is not None:
+                        if edge.check_date(year_vis) == False:
+                            sink.write('%s [style="invis" arrowhead = "%s"];\n' % (edge_attr[0], edge_attr[1]))
+                            continue
 
-                if year_vis is not None:
-                    if edge.check_date(year_vis) == False:
-                        file.write('%s [style="invis" arrowhead = "%s"];\n' % (edge_attr[0], edge_attr[1]))
-                        continue
-                        
-                if attribute_color is not None:
-                    color = attribute_color (edge)
-                    if color is not None:
-                        file.write('%s [style="bold" label = "%s" arrowhead = "%s" color = "%s"];\n' %
-                           (edge_attr[0], edge.label(), edge_attr[1], color))
-                        continue
+                    if attribute_color is not None:
+                        color = attribute_color (edge)
+                        if color is not None:
+                            sink.write('%s [style="bold" label = "%s" arrowhead = "%s" color = "%s"];\n' %
+                               (edge_attr[0], edge.label(), edge_attr[1], color))
+                            continue
 
-                file.write('%s [style="bold" label = "%s" arrowhead = "%s"];\n' %
-                           (edge_attr[0], edge.label(), edge_attr[1]))
+                    sink.write('%s [style="bold" label = "%s" arrowhead = "%s"];\n' %
+                               (edge_attr[0], edge.label(), edge_attr[1]))
 
-        file.write("\n};")
+            sink.write("\n};")
         return directed
 
     def generate_delimited(self, file, year_vis=None, reduce_edges=True):
@@ -1747,28 +2186,24 @@ class transmission_network:
         if self.adjacency_list is None:
             self.compute_adjacency()
 
-        file.write("%s\n" % ','.join(['ID1', 'ID2', 'Linktype']))
-        for edge in self.edge_iterator() if reduce_edges == False else self.reduce_edge_set():
-            if edge.visible:
-                distance = self.distances[edge]
-
-                edge_attr = edge.direction(do_csv=True)
-
-                if year_vis is not None:
-                    if edge.check_date(year_vis) == False:
-                        continue
+        with _buffered_sink(file) as sink:
+            sink.write("%s\n" % ','.join(['ID1', 'ID2', 'Linktype']))
+            for edge in self.edge_iterator() if reduce_edges == False else self.reduce_edge_set():
+                if edge.visible:
+                    if year_vis is not None:
+                        if edge.check_date(year_vis) == False:
+                            continue
 
-                file.write('%s\n' % (edge_attr[0]))
+                    sink.write('%s\n' % (edge.direction(do_csv=True)[0]))
 
     def spool_pairwise_distances(self, file, baseline=False):
-        file.write(','.join(['Seq1', 'Seq2', 'Distance']))
-        file.write('\n')
-        for ext_edge in self.edge_iterator():
-            if baseline:
-                if ext_edge.p1.get_baseline_date(True) != ext_edge.date1 or ext_edge.p2.get_baseline_date(True) != ext_edge.date2:
-                    continue
-            file.write(','.join([ext_edge.p1.id, ext_edge.p2.id, str(self.distances[ext_edge])]))
-            file.write('\n')
+        with _buffered_sink(file) as sink:
+            sink.write('Seq1,Seq2,Distance\n')
+            for ext_edge in self.edge_iterator():
+                if baseline:
+                    if ext_edge.p1.get_baseline_date(True) != ext_edge.date1 or ext_edge.p2.get_baseline_date(True) != ext_edge.date2:
+                        continue
+                sink.write('%s,%s,%s\n' % (ext_edge.p1.id, ext_edge.p2.id, str(self.distances[ext_edge])))
 
     def get_node_degree_list(self, year_cap=None, do_direction=False, id_list=None, attribute_selector=None, clear_filters=True):
         degree_list = {}
@@ -1875,6 +2310,7 @@ class transmission_network:
         return None
 
     def find_all_triangles(self, edge_set, maximum_number=2**18):
+        from .triangles import csr_from_adjacency, triangles as triangles_of
         triangles = set()
         #sequences_involved_in_links =  set ()
         #sequence_pairs              =  set ()
@@ -1909,43 +2345,35 @@ class transmission_network:
                 node_neighborhood[n] = e
             adjacency_map[node] = node_neighborhood
 
+        # each triangle is enumerated once (see hivclustering.triangles)
+        nodes, indptr, indices = csr_from_adjacency(adjacency_map)
         triangle_nodes = set()
-        triangle_nodes_all = set()
-
         count_by_sequence = {}
 
         try:
-            for node, neighbors in adjacency_map.items():
-                if len(neighbors) > 1:  # something to do
-                    for node2 in neighbors:
-                        for node3 in adjacency_map[node2]:
-                            if node in adjacency_map[node3]:
-                                triad = sorted([node, node2, node3])
-                                triad = (triad[0], triad[1], triad[2])
-
-                                if triad not in triangle_nodes:
-                                    sequence_set = set()
-                                    for triangle_edge in [adjacency_map[triad[0]][triad[1]], adjacency_map[triad[0]][triad[2]], adjacency_map[triad[1]][triad[2]]]:
-                                        sequence_set.update(triangle_edge.sequences)
-
-                                    if len(sequence_set) == 3:
-                                        triangle_nodes.add(triad)
-                                        sequence_set = sorted(list(sequence_set))
-                                        sequence_set = (sequence_set[0], sequence_set[1], sequence_set[2])
-                                        triangles.add(sequence_set)
-                                        for s in sequence_set:
-                                            if s not in count_by_sequence:
-                                                count_by_sequence[s] = 1
-                                            else:
-                                                count_by_sequence[s] += 1
-                                    else:
-                                        pass
-                                        #print (sequence_set)
+            for corners in triangles_of(indptr, indices):
+                for a, b, c in zip(*[k.tolist() for k in corners]):
+                    triad = sorted([nodes[a], nodes[b], nodes[c]])
+                    triad = (triad[0], triad[1], triad[2])
+
+                    sequence_set = set()
+                    for triangle_edge in [adjacency_map[triad[0]][triad[1]], adjacency_map[triad[0]][triad[2]], adjacency_map[triad[1]][triad[2]]]:
+                        sequence_set.update(triangle_edge.sequences)
+
+                    if len(sequence_set) == 3:
+                        triangle_nodes.add(triad)
+                        sequence_set = sorted(list(sequence_set))
+                        sequence_set = (sequence_set[0], sequence_set[1], sequence_set[2])
+                        triangles.add(sequence_set)
+                        for s in sequence_set:
+                            if s not in count_by_sequence:
+                                count_by_sequence[s] = 1
+                            else:
+                                count_by_sequence[s] += 1
 
-                                    triangle_nodes_all.add(triad)
-                                    if len(triangle_nodes) >= maximum_number:
-                                        raise UserWarning(
-                                            'Too many triangles to attempt full filtering; stopped at %d' % maximum_number)
+                        if len(triangle_nodes) >= maximum_number:
+                            raise UserWarning(
+                                'Too many triangles to attempt full filtering; stopped at %d' % maximum_number)
         except UserWarning as e:
             print(e, file=sys.stderr)
 
@@ -1955,7 +2383,6 @@ class transmission_network:
                                 for t in triangles], key=lambda x: (x[3], x[0], x[1], x[2]), reverse=True)
 
         #del node_and_edge_am
-        #print ("Found %d triangles with sequences (total triangles %d) in the network" % (len (triangles), len (triangle_nodes_all)), file = sys.stderr)
 
         return sorted_result, node_and_edge_am
 
@@ -2016,31 +2443,34 @@ class transmission_network:
         helper(cluster[0])
         return len(visited) != len(cluster)
 
-    def test_edge_support(self, sequence_file_name, triangles, adjacency_set, hy_instance=None, p_value_cutoff=0.05):
+    def test_edge_support(self, sequence_file_name, triangles, adjacency_set, hy_instance=None, p_value_cutoff=0.05, fasta_index=None):
+        ''' if a fasta.fasta_index for the alignment is supplied, each block of triangles is tested
+            against a sub-alignment with only the sequences it needs (and the base frequencies of
+            the full alignment), instead of having every worker load the whole alignment
+        '''
 
         if len(triangles) == 0:
             return None
 
-        evaluator = partial(_test_edge_support, sequence_file_name=sequence_file_name,
-                            hy_instance=hy_instance, p_value_cutoff=p_value_cutoff)
-        #processed_objects = evaluator (triangles)
+        from .executor import get_executor
 
-        chunk = 2**(max(floor(log(len(triangles) / multiprocessing.cpu_count(), 2)), 8))
+        base_frequencies = fasta_index.base_frequencies() if fasta_index is not None else None
 
-        blocked = [triangles[k: k + chunk] for k in range(0, len(triangles), chunk)]
+        evaluator = partial(_test_edge_support_block, sequence_file_name=sequence_file_name,
+                            hy_instance=hy_instance, p_value_cutoff=p_value_cutoff, base_frequencies=base_frequencies)
 
-        pool = multiprocessing.Pool()
-        #print ()
-        processed_objects = pool.map(evaluator, blocked)
-        pool.close()
-        pool.join()
+        # blocks are sized from the measured time per triangle; each block is one HyPhy run (and a
+        # sub-alignment written to disk), so a block has at least 256 triangles to amortize that;
+        # the index goes to each worker once
+        processed_objects = list(get_executor().map(evaluator, triangles, setup=_use_fasta_index, setup_args=(fasta_index,),
+                                                    batch=True, ordered=False, minimum_chunk=256))
 
         seqs_to_edge = {}
         for e in self.edge_iterator():
             if e.sequences:
                 seqs_to_edge[e.sequences] = e
 
-        processed_objects = sorted([k for p in processed_objects for k in p], key=lambda x: x[0][3])
+        processed_objects = sorted(processed_objects, key=lambda x: x[0][3])
 
         edges_removed = set()
         must_keep = set()
@@ -2093,6 +2523,7 @@ class transmission_network:
         return stats
 
     def fit_degree_distribution(self, degree_option=None, hy_instance=None):
+        hy = hyphy()
         if hy_instance is None:
             hy_instance = hy.HyphyInterface()
         script_path = os.path.realpath(__file__)
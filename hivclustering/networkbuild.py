@@ -9,10 +9,13 @@ import time
 import random
 import os.path
 import json
-import hppy as hy
 import re
 from math import log10, floor
 from hivclustering import *
+from hivclustering.ingest import open_input
+from hivclustering.fasta import fasta_index
+from hivclustering import profiling
+from hivclustering.executor import executor, set_executor
 from functools import partial
 import multiprocessing
 
@@ -94,17 +97,24 @@ def describe_network(network, json_output=False, keep_singletons=False):
     else:
         print("%d edges on %d nodes" % (network_stats['edges'], network_stats['nodes']), file=sys.stderr)
 
-    network.compute_clusters(keep_singletons)
-    clusters = network.retrieve_clusters()
+    with profiling.stage('clustering') as counts:
+        network.compute_clusters(keep_singletons)
+        clusters = network.retrieve_clusters()
+        counts['clusters'] = len(clusters)
     #print (describe_vector([len(clusters[c]) for c in clusters]))
 
+    with profiling.stage('triangles'):
+        transitivity = network.triangle_statistics()[1]
+
     if json_output:
         return_json['Network Summary']['Clusters'] = len(clusters)
+        return_json['Network Summary']['Transitivity'] = transitivity
         return_json['Cluster sizes'] = [len(clusters[c]) for c in clusters if c is not None]
     else:
         print("Found %d clusters" % len(clusters), file=sys.stderr)
         print("Maximum cluster size = %d nodes" % max([len(clusters[c])
                                                        for c in clusters if c is not None]), file=sys.stderr)
+        print("Transitivity (3 x triangles / connected triples) = %g" % transitivity, file=sys.stderr)
 
     if json_output:
         return_json['HIV Stages'] = {}
@@ -135,7 +145,14 @@ def describe_network(network, json_output=False, keep_singletons=False):
         print(reasons, file=sys.stderr)
 
     print("Fitting the degree distribution to various densities", file=sys.stderr)
-    distro_fit = network.fit_degree_distribution()
+    try:
+        with profiling.stage('degree fitting'):
+            distro_fit = network.fit_degree_distribution()
+    except ImportError as e:
+        # clustering does not need HyPhy; report the degrees without a fitted model
+        print("%s. The degree distribution will not be fitted." % e, file=sys.stderr)
+        distro_fit = {'Best': None, 'rho': {None: None}, 'rho_ci': {None: None}, 'fitted': {None: None},
+                      'BIC': {}, 'p': {}, 'degrees': network.get_degree_distribution()}
     ci = distro_fit['rho_ci'][distro_fit['Best']]
     rho = distro_fit['rho'][distro_fit['Best']]
     rho = rho if rho is not None else 0.
@@ -146,7 +163,7 @@ def describe_network(network, json_output=False, keep_singletons=False):
                                   'rho': rho,
                                   'rho CI': ci,
                                   'fitted': distro_fit['fitted'][distro_fit['Best']]}
-    else:
+    elif distro_fit['Best'] is not None:
         if (distro_fit['Best'] != "Negative Binomial"):
             ci = distro_fit['rho_ci'][distro_fit['Best']]
             rho = distro_fit['rho'][distro_fit['Best']]
@@ -170,6 +187,90 @@ def describe_network(network, json_output=False, keep_singletons=False):
 #-------------------------------------------------------------------------------
 
 
+def network_json_node_index(clusters):
+    ''' map each node to the index of its JSON record; clusters is network.retrieve_clusters ().
+        Singletons get the index of the preceding clustered node.
+    '''
+    node_index = {}
+    count = 0
+    for idx, cluster in clusters.items():
+        for n in cluster:
+            if idx is not None:
+                count += 1
+            node_index[n] = count - 1
+    return node_index
+
+
+def network_json_nodes(clusters, triangles=None):
+    ''' yield the JSON records of clustered nodes; triangles is the first value of
+        network.triangle_statistics (), which adds 'triangles' and 'clustering' (the local
+        clustering coefficient) to the records '''
+    for idx, cluster in clusters.items():
+        if idx is not None:
+            for n in cluster:
+                record = {'id': n.id, 'cluster': idx, 'attributes': list(n.attributes),
+                          'edi': n.get_edi(), 'baseline': n.get_baseline_date(True)}
+                if triangles is not None:
+                    record['triangles'], record['clustering'] = triangles.get(n, (0, 0.))
+                yield record
+
+
+def network_json_edges(network, node_index):
+    ''' yield the JSON records of visible edges; node_index comes from network_json_node_index '''
+    for e in network.reduce_edge_set():
+        if e.visible:
+            edge_source = e.compute_direction()
+            if edge_source is not None:
+                src = node_index[edge_source]
+                rcp = node_index[e.p2 if edge_source != e.p2 else e.p1]
+                directed = True
+            else:
+                src = node_index[e.p1]
+                rcp = node_index[e.p2]
+                directed = False
+            yield {'source': src, 'target': rcp, 'directed': directed, 'length': network.distances[e],
+                   'support': e.edge_reject_p, 'removed': not e.has_support(), 'sequences': e.sequences, 'attributes': list(e.attribute)}
+
+
+def write_network_json(network, network_info, fh, compact=False):
+    ''' write network_info plus the 'Nodes' and 'Edges' of the network to fh as a JSON object.
+        Node and edge records are generated and written one at a time; the output is the
+        same as json.dumps (..., indent=4, sort_keys=True) of the fully assembled object,
+        or has no whitespace at all if compact is set.
+    '''
+    if compact:
+        dump = partial(json.dumps, sort_keys=True, separators=(',', ':'))
+        newline = ''
+        step = ''
+    else:
+        dump = partial(json.dumps, sort_keys=True, indent=4)
+        newline = '\n'
+        step = '    '
+
+    def indented(value, level):
+        return dump(value).replace('\n', '\n' + step * level)
+
+    clusters = network.retrieve_clusters()
+    streams = {'Nodes': network_json_nodes(clusters, network.triangle_statistics()[0]), 'Edges': network_json_edges(network, network_json_node_index(clusters))}
+    keys = sorted(set(network_info.keys()).union(streams.keys()))
+
+    fh.write('{')
+    for key_count, key in enumerate(keys):
+        fh.write('%s%s%s%s:%s' % (',' if key_count else '', newline, step, dump(key), ' ' if not compact else ''))
+        if key in streams:
+            fh.write('[')
+            record_count = 0
+            for record in streams[key]:
+                fh.write('%s%s%s%s' % (',' if record_count else '', newline, step * 2, indented(record, 2)))
+                record_count += 1
+            fh.write('%s%s]' % (newline, step) if record_count else ']')
+        else:
+            fh.write(indented(network_info[key], 1))
+    fh.write('%s}\n' % newline)
+
+#-------------------------------------------------------------------------------
+
+
 def import_attributes(file, network):
     attribute_reader = csv.reader(file)
     header = next(attribute_reader)
@@ -291,10 +392,10 @@ def get_sequence_ids(fn):
 #-------------------------------------------------------------------------------
 
 def get_fasta_ids(fn):
-    fh = open(fn)
-    for line in fh:
-        if line[0] == '>':
-            yield line[1:].strip()
+    with open_input(fn) as fh:
+        for line in fh:
+            if line[0] == '>':
+                yield line[1:].strip()
 
 
 
@@ -304,7 +405,7 @@ def build_a_network():
     random.seed()
     arguments = argparse.ArgumentParser(description='Read filenames.')
 
-    arguments.add_argument('-i', '--input',   help='Input CSV file with inferred genetic links (or stdin if omitted). Must be a CSV file with three columns: ID1,ID2,distance.')
+    arguments.add_argument('-i', '--input',   help='Input CSV file with inferred genetic links (or stdin if omitted). Must be a CSV file with three columns: ID1,ID2,distance. Files ending in .gz, .bz2 or .xz are decompressed on the fly.')
     arguments.add_argument('-u', '--uds',   help='Input CSV file with UDS data. Must be a CSV file with three columns: ID1,ID2,distance.')
     arguments.add_argument('-d', '--dot',   help='Output DOT file for GraphViz (or stdout if omitted)')
     arguments.add_argument('-c', '--cluster', help='Output a CSV file with cluster assignments for each sequence')
@@ -317,25 +418,42 @@ def build_a_network():
     arguments.add_argument('-p', '--parser', help='The reg.exp pattern to split up sequence ids; only used if format is regexp', required=False, type=str)
     arguments.add_argument('-a', '--attributes',help='Load a CSV file with optional node attributes', type=argparse.FileType('r'))
     arguments.add_argument('-j', '--json', help='Output the network report as a JSON object',required=False,  action='store_true', default=False)
+    arguments.add_argument('-J', '--compact-json', dest='compact_json', help='With -j, write the JSON object without indentation or line breaks',required=False,  action='store_true', default=False)
     arguments.add_argument('-o', '--singletons', help='Include singletons in JSON output',required=False,  action='store_true', default=False)
     arguments.add_argument('-k', '--filter', help='Only return clusters with ids listed by a newline separated supplied file. ', required=False)
-    arguments.add_argument('-s', '--sequences', help='Provide the MSA with sequences which were used to make the distance file. ', required=False)
+    arguments.add_argument('-s', '--sequences', help='Provide the MSA with sequences which were used to make the distance file (may be .gz, .bz2 or .xz compressed). ', required=False)
+    arguments.add_argument('--sequence-index', dest='sequence_index', help='Keep the index of the records of the -s alignment in this file, and reuse it on later runs while the alignment is unchanged [default is to index the alignment in memory on every run]', required=False)
     arguments.add_argument('-n', '--edge-filtering', dest='edge_filtering', choices=['remove', 'report'], help='Compute edge support and mark edges for removal using sequence-based triangle tests (requires the -s argument) and either only report them or remove the edges before doing other analyses ', required=False)
     arguments.add_argument('-y', '--centralities', help='Output a CSV file with node centralities')
+    arguments.add_argument('--columnar', help='Output the node, edge and cluster tables to this file as a binary columnar archive (read it with hivclustering.columnar.load_columnar)')
     arguments.add_argument('-g', '--triangles', help='Maximum number of triangles to consider in each filtering pass', type = int, default = 2**16)
     arguments.add_argument('-C', '--contaminants', help='Screen for contaminants by marking or removing sequences that cluster with any of the contaminant IDs (-F option) [default is not to screen]', choices=['report', 'remove'])
     arguments.add_argument('-F', '--contaminant-file', dest='contaminant_file',help='IDs of contaminant sequences', type=str)
     arguments.add_argument('-M', '--multiple-edges', dest='multiple_edges',help='Permit multiple edges (e.g. different dates) to link the same pair of nodes in the network [default is to choose the one with the shortest distance]', default=False, action='store_true')
+    arguments.add_argument('--profile', help='Write wall time, CPU time, peak memory and item counts for each pipeline stage to this file as JSON')
+    arguments.add_argument('--threads', help='Number of workers for the parallel stages (edge support tests, and parallel ingest with --ingest-processes 0) [default is one per CPU]', type=int, default=None)
+    arguments.add_argument('--executor', help='Run the parallel stages in worker processes, threads, or serially [default process]', choices=executor.kinds, default='process')
+    arguments.add_argument('--ingest-processes', dest='ingest_processes', help='Parse the input CSV file with this many worker processes, or 0 to use the --threads workers [default is to read it serially]', type=int, default=None)
 
     global run_settings
 
     run_settings = arguments.parse_args()
 
+    if run_settings.profile is not None:
+        try:
+            run_settings.profile = open(run_settings.profile, 'w')
+        except IOError:
+            print("Failed to open '%s' for writing" % (run_settings.profile), file=sys.stderr)
+            raise
+        profiling.set_profiler(profiling.stage_profiler())
+
+    set_executor(executor(run_settings.executor, run_settings.threads))
+
     if run_settings.input == None:
         run_settings.input = sys.stdin
     else:
         try:
-            run_settings.input = open(run_settings.input, 'r')
+            run_settings.input = open_input(run_settings.input)
         except IOError:
             print("Failed to open '%s' for reading" % (run_settings.input), file=sys.stderr)
             raise
@@ -405,7 +523,7 @@ def build_a_network():
 
     if run_settings.uds is not None:
         try:
-            run_settings.uds = open(run_settings.uds, 'r')
+            run_settings.uds = open_input(run_settings.uds)
         except IOError:
             print("Failed to open '%s' for reading" % (run_settings.uds), file=sys.stderr)
             raise
@@ -417,92 +535,123 @@ def build_a_network():
         raise ValueError('Two arguments (-n and -s) are needed for edge filtering options')
 
     network = transmission_network(multiple_edges=run_settings.multiple_edges)
-    network.read_from_csv_file(run_settings.input, formatter, run_settings.threshold, 'BULK')
+    with profiling.stage('ingest') as counts:
+        if run_settings.ingest_processes is not None:
+            network.read_from_csv_file_parallel(run_settings.input, formatter, run_settings.threshold, 'BULK', processes=run_settings.ingest_processes or None)
+        else:
+            network.read_from_csv_file(run_settings.input, formatter, run_settings.threshold, 'BULK')
+        counts.update(nodes=len(network.nodes), edges=len(network.edges))
 
     uds_settings = None
 
     if run_settings.uds:
-        uds_settings = network.read_from_csv_file(run_settings.uds, formatter, run_settings.threshold, 'UDS')
+        with profiling.stage('UDS ingest') as counts:
+            uds_settings = network.read_from_csv_file(run_settings.uds, formatter, run_settings.threshold, 'UDS')
+            counts.update(nodes=len(network.nodes), edges=len(network.edges))
 
     sys.setrecursionlimit(max(sys.getrecursionlimit(), len (network.nodes)))
 
     if edi is not None:
-        if old_edi:
-            network.add_edi(edi)
-        else:
-            network.add_edi_json(edi)
+        with profiling.stage('EDI merge') as counts:
+            if old_edi:
+                network.add_edi(edi)
+            else:
+                network.add_edi_json(edi)
+            counts['nodes with EDI'] = len([k for k in network.nodes if k.edi is not None])
         print("Added edi information to %d (of %d) nodes" %
               (len([k for k in network.nodes if k.edi is not None]), len (network.nodes)), file=sys.stderr)
         print("Added stage information to %d (of %d) nodes" %
               (len([k for k in network.nodes if k.stage is not None]), len (network.nodes)), file=sys.stderr)
 
     if run_settings.attributes is not None:
-        import_attributes(run_settings.attributes, network)
+        with profiling.stage('attributes'):
+            import_attributes(run_settings.attributes, network)
 
     if run_settings.contaminant_file:
-        run_settings.contaminant_file = get_sequence_ids(run_settings.contaminant_file)
-        network.apply_cluster_membership_filter(run_settings.contaminant_file,
-                                                filter_out=True, set_attribute='problematic')
+        with profiling.stage('contaminant screen') as counts:
+            run_settings.contaminant_file = get_sequence_ids(run_settings.contaminant_file)
+            network.apply_cluster_membership_filter(run_settings.contaminant_file,
+                                                    filter_out=True, set_attribute='problematic')
 
-        print("Marked %d nodes as being in the contaminant clusters" %
-              len([n for n in network.nodes if n.has_attribute('problematic')]), file=sys.stderr)
+            counts['marked nodes'] = len([n for n in network.nodes if n.has_attribute('problematic')])
+            print("Marked %d nodes as being in the contaminant clusters" % counts['marked nodes'], file=sys.stderr)
 
-        if run_settings.contaminants == 'remove':
-            print("Contaminant linkage filtering removed %d edges" % network.conditional_prune_edges(
-                condition=lambda x: x.p1.has_attribute('problematic') or x.p2.has_attribute('problematic')), file=sys.stderr)
+            if run_settings.contaminants == 'remove':
+                counts['removed edges'] = network.conditional_prune_edges(
+                    condition=lambda x: x.p1.has_attribute('problematic') or x.p2.has_attribute('problematic'))
+                print("Contaminant linkage filtering removed %d edges" % counts['removed edges'], file=sys.stderr)
 
     if run_settings.filter:
-        run_settings.filter = get_sequence_ids(run_settings.filter)
-        print("Included %d edges after applying node list filtering" %
-              network.apply_cluster_membership_filter(run_settings.filter), file=sys.stderr)
+        with profiling.stage('cluster filter') as counts:
+            run_settings.filter = get_sequence_ids(run_settings.filter)
+            counts['included edges'] = network.apply_cluster_membership_filter(run_settings.filter)
+            print("Included %d edges after applying node list filtering" % counts['included edges'], file=sys.stderr)
 
     edge_visibility = network.get_edge_visibility()
 
     if run_settings.sequences and run_settings.edge_filtering:
 
-        # Check that all sequences defined in distance file occur in source fasta file
-        distance_ids = network.sequence_set_for_edge_filtering()
-        source_fasta_ids = [id for id in get_fasta_ids(run_settings.sequences)]
-
-        #print (distance_ids)
-
-        if any(x not in source_fasta_ids for x in distance_ids):
-            missing_ids = [x for x in distance_ids if x not in source_fasta_ids]
-            raise Exception("Incorrect source file. Sequence ids referenced in input do not appear in source fasta ids. \n Missing ids in fasta file: %s " %  ', '.join(missing_ids))
-
-        network.apply_attribute_filter('problematic', filter_out=True, do_clear=False)
-        if run_settings.filter:
-            network.apply_id_filter(list=run_settings.filter, do_clear=False)
-
-        current_edge_set = network.reduce_edge_set()
-
-        maximum_number = run_settings.triangles
-
-        for filtering_pass in range (64):
-            edge_stats = network.test_edge_support(os.path.abspath(
-                run_settings.sequences), *network.find_all_triangles(current_edge_set, maximum_number = maximum_number))
-            if not edge_stats or edge_stats['removed edges'] == 0:
-                break
+        with profiling.stage('edge filtering') as filtering_counts:
+
+            # Check that all sequences defined in distance file occur in source fasta file
+            with profiling.stage('sequence check') as counts:
+                distance_ids = network.sequence_set_for_edge_filtering()
+                sequence_index = fasta_index(run_settings.sequences, run_settings.sequence_index)
+                counts.update(sequences=len(sequence_index), referenced=len(distance_ids))
+
+            # the index may hold a temporary decompressed copy of the alignment
+            try:
+                #print (distance_ids)
+
+                missing_ids = [x for x in distance_ids if x not in sequence_index]
+                if missing_ids:
+                    raise Exception("Incorrect source file. Sequence ids referenced in input do not appear in source fasta ids. \n Missing ids in fasta file: %s " %  ', '.join(missing_ids))
+
+                network.apply_attribute_filter('problematic', filter_out=True, do_clear=False)
+                if run_settings.filter:
+                    network.apply_id_filter(list=run_settings.filter, do_clear=False)
+
+                current_edge_set = network.reduce_edge_set()
+
+                maximum_number = run_settings.triangles
+
+                for filtering_pass in range (64):
+                    with profiling.stage('pass %d' % filtering_pass) as counts:
+                        with profiling.stage('triangle enumeration') as triangle_counts:
+                            triangles = network.find_all_triangles(current_edge_set, maximum_number = maximum_number)
+                            triangle_counts.update(edges=len(current_edge_set), triangles=len(triangles[0]))
+                        with profiling.stage('triangle tests'):
+                            edge_stats = network.test_edge_support(os.path.abspath(sequence_index.path), *triangles, fasta_index = sequence_index)
+                        if edge_stats:
+                            counts.update(edge_stats)
+                    if not edge_stats or edge_stats['removed edges'] == 0:
+                        break
+                    else:
+                        print("Edge filtering pass % d examined %d triangles, found %d poorly supported edges, and marked %d edges for removal" % (
+                            filtering_pass, edge_stats['triangles'], edge_stats['unsupported edges'], edge_stats['removed edges']), file=sys.stderr)
+
+                        maximum_number += run_settings.triangles
+                        current_edge_set = current_edge_set.difference (set ([edge for edge in current_edge_set if not edge.has_support()]))
+
+                filtering_counts['passes'] = filtering_pass + 1
+            finally:
+                sequence_index.close()
+
+            network.set_edge_visibility(edge_visibility)
+
+            if edge_stats:
+                print("Edge filtering examined %d triangles, found %d poorly supported edges, and marked %d edges for removal" % (
+                    edge_stats['triangles'], edge_stats['unsupported edges'], edge_stats['removed edges']), file=sys.stderr)
             else:
-                print("Edge filtering pass % d examined %d triangles, found %d poorly supported edges, and marked %d edges for removal" % (
-                    filtering_pass, edge_stats['triangles'], edge_stats['unsupported edges'], edge_stats['removed edges']), file=sys.stderr)
-
-                maximum_number += run_settings.triangles
-                current_edge_set = current_edge_set.difference (set ([edge for edge in current_edge_set if not edge.has_support()]))
-
-        network.set_edge_visibility(edge_visibility)
-
-        if edge_stats:
-            print("Edge filtering examined %d triangles, found %d poorly supported edges, and marked %d edges for removal" % (
-                edge_stats['triangles'], edge_stats['unsupported edges'], edge_stats['removed edges']), file=sys.stderr)
-        else:
-            print("Edge filtering examined %d triangles, found %d poorly supported edges, and marked %d edges for removal" % (
-                0, 0, 0), file=sys.stderr)
-
-        if run_settings.edge_filtering == 'remove':
-            #print (len ([e for e in network.edge_iterator() if not e.has_support()]))
-            print("Edge filtering removed %d edges" % network.conditional_prune_edges(), file=sys.stderr)
-            # network.find_all_bridges()
+                print("Edge filtering examined %d triangles, found %d poorly supported edges, and marked %d edges for removal" % (
+                    0, 0, 0), file=sys.stderr)
+
+            if run_settings.edge_filtering == 'remove':
+                #print (len ([e for e in network.edge_iterator() if not e.has_support()]))
+                with profiling.stage('pruning') as counts:
+                    counts['removed edges'] = network.conditional_prune_edges()
+                print("Edge filtering removed %d edges" % counts['removed edges'], file=sys.stderr)
+                # network.find_all_bridges()
     return network
 
 
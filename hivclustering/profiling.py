@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+''' Per-stage timing of network construction and analysis.
+
+    Code marks a stage with
+
+        with stage('triangle enumeration') as counts:
+            ...
+            counts['triangles'] = len(triangles)
+
+    which records wall time, CPU time (of this process and of the child processes it
+    waited for), memory and the item counts filled in by the caller,
+    provided a stage_profiler has been installed with set_profiler; otherwise stage
+    does nothing. Stages can be nested; the record of a nested stage is named by the
+    path of enclosing stages ('edge filtering/pass 1').
+
+    The operating system only reports the peak resident memory of the whole process so
+    far, so a stage records that ('process peak rss') and how much the stage raised it
+    ('peak rss increase'); a stage that allocates less than an earlier one has an
+    increase of 0.
+'''
+
+import contextlib
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+__all__ = ['stage_profiler', 'set_profiler', 'get_profiler', 'stage']
+
+#-------------------------------------------------------------------------------
+
+
+def _peak_rss():
+    ''' peak resident set size of this process in bytes, or None if unknown '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _children_cpu():
+    times = os.times()
+    return times.children_user + times.children_system
+
+
+class stage_profiler:
+    ''' collect one record per stage, in the order the stages were entered '''
+
+    def __init__(self):
+        self.stages = []
+        self._path = []
+        self._started = time.perf_counter()
+        self._started_cpu = time.process_time()
+
+    @contextlib.contextmanager
+    def stage(self, name, **counts):
+        self._path.append(str(name))
+        record = {'stage': '/'.join(self._path), 'depth': len(self._path) - 1, 'counts': dict(counts)}
+        self.stages.append(record)
+
+        wall, cpu, children_cpu, peak = time.perf_counter(), time.process_time(), _children_cpu(), _peak_rss()
+        record['start'] = wall - self._started
+        try:
+            yield record['counts']
+        finally:
+            self._path.pop()
+            record['wall'] = time.perf_counter() - wall
+            record['cpu'] = time.process_time() - cpu
+            record['children cpu'] = _children_cpu() - children_cpu
+            record['process peak rss'] = _peak_rss()
+            record['peak rss increase'] = record['process peak rss'] - peak if peak is not None else None
+
+    def report(self):
+        return {'command': sys.argv,
+                'wall': time.perf_counter() - self._started,
+                'cpu': time.process_time() - self._started_cpu,
+                'process peak rss': _peak_rss(),
+                'stages': self.stages}
+
+    def write(self, file):
+        json.dump(self.report(), file, indent=1)
+        file.write('\n')
+
+#-------------------------------------------------------------------------------
+
+_profiler = None
+
+
+def set_profiler(profiler):
+    ''' install profiler (a stage_profiler, or None to stop profiling); returns the previous one '''
+    global _profiler
+    previous = _profiler
+    _profiler = profiler
+    return previous
+
+
+def get_profiler():
+    return _profiler
+
+
+@contextlib.contextmanager
+def _untimed(counts):
+    yield counts
+
+
+def stage(name, **counts):
+    ''' time a stage with the installed profiler (if any); yields a dict for item counts '''
+    if _profiler is None:
+        return _untimed(dict(counts))
+    return _profiler.stage(name, **counts)
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+''' Hand a transmission network to worker processes through shared memory.
+
+    Pickling patient and edge objects for every worker costs more than most per-cluster
+    work, so shared_network copies the core of the network into NumPy arrays in a
+    single multiprocessing.shared_memory block, once. Workers attach to it by name
+    (network_view (handle)) and get read-only arrays which point into the block, with no
+    copying; they send back only their (small) results. Pass teardown=detach_worker, so
+    that workers which outlive the map call do not keep the block mapped once it is freed.
+
+        with network.export_shared() as shared:
+            for result in get_executor().map(work, cluster_ids, setup=attach_worker, setup_args=(shared.handle,),
+                                             teardown=detach_worker):
+                ...
+
+        def work(cluster_id):
+            rows, adjacency = worker_view().cluster_adjacency(cluster_id)
+            ...
+
+    Arrays (n nodes, m distinct linked pairs)
+
+        id_offsets, id_data:   node IDs, as in hivclustering.columnar (string_column)
+        cluster_id:            int32 [n], -1 for nodes outside clusters
+        degree:                int32 [n], patient.degree
+        dates:                 datetime64[D] [n], the baseline (earliest) date, NaT if unknown
+        indptr, indices:       int64 [n + 1], int32 [2m]: CSR adjacency, both directions,
+                               neighbors of each node in increasing row order
+        distances:             float64 [2m], the shortest distance linking the pair
+                               (among visible edges, if any are visible)
+        visible:               bool [2m], whether any edge linking the pair is visible
+        clusters, cluster_indptr, cluster_rows:
+                               the cluster IDs in increasing order, and the rows of the
+                               nodes in each (in network order), CSR style
+
+    Rows follow the iteration order of network.nodes.
+'''
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .columnar import _aligned, _dates, _strings, string_column
+
+__all__ = ['shared_network', 'network_view', 'attach_worker', 'detach_worker', 'worker_view']
+
+#-------------------------------------------------------------------------------
+
+
+def _network_arrays(network):
+    nodes = list(network.nodes)
+    node_row = {n: k for k, n in enumerate(nodes)}
+
+    pairs = {}  # (row, row) -> (hidden, distance), smallest first
+    for e in network.edge_iterator():
+        a, b = node_row[e.p1], node_row[e.p2]
+        if a != b:
+            key = (a, b) if a < b else (b, a)
+            rank = (not e.visible, network.distances[e])
+            if key not in pairs or rank < pairs[key]:
+                pairs[key] = rank
+
+    count = len(pairs)
+    first = np.fromiter((k[0] for k in pairs), dtype=np.int32, count=count)
+    second = np.fromiter((k[1] for k in pairs), dtype=np.int32, count=count)
+    distance = np.fromiter((r[1] for r in pairs.values()), dtype=np.float64, count=count)
+    visible = np.fromiter((not r[0] for r in pairs.values()), dtype=np.bool_, count=count)
+
+    sources = np.concatenate((first, second))
+    targets = np.concatenate((second, first))
+    order = np.lexsort((targets, sources))
+
+    indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=len(nodes)), out=indptr[1:])
+
+    cluster_id = np.array([n.cluster_id if n.cluster_id is not None else -1 for n in nodes], dtype=np.int32)
+    clustered = np.flatnonzero(cluster_id >= 0)
+    cluster_rows = clustered[np.argsort(cluster_id[clustered], kind='stable')].astype(np.int32)
+    clusters, sizes = np.unique(cluster_id[clustered], return_counts=True)
+    cluster_indptr = np.zeros(len(clusters) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=cluster_indptr[1:])
+
+    id_offsets, id_data = _strings([n.id for n in nodes])
+
+    return {'id_offsets': id_offsets, 'id_data': id_data,
+            'cluster_id': cluster_id,
+            'degree': np.array([n.degree for n in nodes], dtype=np.int32),
+            'dates': _dates([n.get_baseline_date(True) for n in nodes]),
+            'indptr': indptr,
+            'indices': targets[order].astype(np.int32),
+            'distances': np.concatenate((distance, distance))[order],
+            'visible': np.concatenate((visible, visible))[order],
+            'clusters': clusters.astype(np.int32),
+            'cluster_indptr': cluster_indptr,
+            'cluster_rows': cluster_rows}
+
+
+class shared_network:
+    ''' the arrays of a network in one shared memory block, owned by the exporting process;
+        handle is the (small, picklable) description workers attach with. close () releases
+        the block; views of it must have been closed (or dropped) first.
+    '''
+
+    def __init__(self, network):
+        arrays = _network_arrays(network)
+        layout = {}
+        offset = 0
+        for name, values in arrays.items():
+            offset = _aligned(offset)
+            layout[name] = (offset, values.dtype.str, values.shape)
+            offset += values.nbytes
+
+        self.block = shared_memory.SharedMemory(create=True, size=max(1, offset))
+        for name, values in arrays.items():
+            start, dtype, shape = layout[name]
+            np.ndarray(shape, dtype=dtype, buffer=self.block.buf, offset=start)[...] = values
+
+        self.handle = (self.block.name, layout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def view(self):
+        ''' a network_view in this process '''
+        return network_view(self.handle)
+
+    def close(self):
+        if self.block is not None:
+            if _worker.get('handle') == self.handle:
+                detach_worker()
+            self.block.close()
+            self.block.unlink()
+            self.block = None
+
+
+class network_view:
+    ''' read-only, zero-copy access to a shared_network from any process '''
+
+    def __init__(self, handle):
+        name, layout = handle
+        self.block = shared_memory.SharedMemory(name=name)
+        for array_name, (start, dtype, shape) in layout.items():
+            values = np.ndarray(shape, dtype=dtype, buffer=self.block.buf, offset=start)
+            values.flags.writeable = False
+            setattr(self, array_name, values)
+        self.ids = string_column(self.id_offsets, self.id_data)
+        self._index = None
+
+    def __len__(self):
+        return len(self.cluster_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        ''' release the arrays and detach from the block '''
+        if self.block is not None:
+            for name in list(self.__dict__):
+                if isinstance(self.__dict__[name], np.ndarray):
+                    delattr(self, name)
+            self.ids = None
+            self.block.close()
+            self.block = None
+
+    def id(self, row):
+        return self.ids[row]
+
+    def index(self, node_id):
+        ''' the row of the node with this ID '''
+        if self._index is None:
+            self._index = {v: k for k, v in enumerate(self.ids)}
+        return self._index[node_id]
+
+    def neighbors(self, row, visible_only=True):
+        ''' rows linked to row, in increasing order '''
+        start, end = self.indptr[row], self.indptr[row + 1]
+        if visible_only:
+            return self.indices[start:end][self.visible[start:end]]
+        return self.indices[start:end]
+
+    def cluster(self, cluster_id):
+        ''' rows of the nodes in this cluster, in network order '''
+        k = np.searchsorted(self.clusters, cluster_id)
+        if k == len(self.clusters) or self.clusters[k] != cluster_id:
+            raise KeyError('No cluster with id %s' % cluster_id)
+        return self.cluster_rows[self.cluster_indptr[k]:self.cluster_indptr[k + 1]]
+
+    def cluster_sizes(self):
+        return dict(zip(self.clusters.tolist(), np.diff(self.cluster_indptr).tolist()))
+
+    def subgraph(self, rows, visible_only=True, weighted=False):
+        ''' adjacency lists of the subgraph induced by rows, in local indices (positions in rows);
+            with weighted, (adjacency lists, matching lists of distances) '''
+        rows = np.asarray(rows)
+        local = {r: k for k, r in enumerate(rows.tolist())}
+        adjacency = []
+        weights = []
+        for row in rows.tolist():
+            start, end = self.indptr[row], self.indptr[row + 1]
+            neighbors = self.indices[start:end].tolist()
+            keep = self.visible[start:end].tolist() if visible_only else [True] * len(neighbors)
+            adjacency.append([local[n] for n, k in zip(neighbors, keep) if k and n in local])
+            if weighted:
+                weights.append([d for n, k, d in zip(neighbors, keep, self.distances[start:end].tolist()) if k and n in local])
+        return (adjacency, weights) if weighted else adjacency
+
+    def cluster_adjacency(self, cluster_id, weighted=False):
+        ''' (rows, local adjacency lists) for a cluster, or (rows, adjacency lists, distances) with weighted '''
+        rows = self.cluster(cluster_id)
+        if weighted:
+            return (rows,) + self.subgraph(rows, weighted=True)
+        return rows, self.subgraph(rows)
+
+#-------------------------------------------------------------------------------
+# a view per worker process, for use with executor.map (setup=attach_worker, teardown=detach_worker)
+
+_worker = {}
+
+
+def attach_worker(handle):
+    ''' attach this process to the shared network described by handle '''
+    if _worker.get('handle') != handle:
+        detach_worker()
+        _worker.update({'handle': handle, 'view': network_view(handle)})
+
+
+def detach_worker():
+    ''' close the view attach_worker set up in this process, if any '''
+    if 'view' in _worker:
+        _worker.pop('view').close()
+        _worker.pop('handle')
+
+
+def worker_view():
+    ''' the view attach_worker set up in this process '''
+    return _worker['view']
@@ -0,0 +1,492 @@
+#!/usr/bin/env python3
+
+''' Random transmission networks for simulation studies, generated with NumPy in bulk,
+    and a runner for replicated simulations.
+
+    pref_attachment_forest draws the same kind of forest as
+    transmission_network.create_a_pref_attachment_network, but all at once: every random
+    choice for all nodes is drawn up front, and the dependencies between them (a
+    preferential attachment picks an earlier entry of the attach_to list, which may itself
+    be a pick) are resolved by pointer jumping, in O(n log n) array operations instead of
+    n steps of Python.
+
+    run_replicates hands independent jobs (dicts of parameters, e.g. network size, sampling
+    bias and replicate number) to the shared executor. Each job gets a seed derived from
+    a master seed and its own parameters, so a sweep gives the same results however it is
+    split between workers, interrupted or resumed. Results are appended to a JSON lines
+    checkpoint as they arrive; run again with the same checkpoint, completed jobs are read
+    back instead of being run.
+
+        table = replicate_table(('size', 'bias'))
+        jobs = [{'size': s, 'bias': 0.5, 'sample': 648, 'replicate': r} for s in sizes for r in range(100)]
+        for job, result in run_replicates(jobs, master_seed=1, checkpoint='sweep.jsonl'):
+            table.add(job, result)
+
+    simulate_chains evolves sequences down transmission chains (the trees built by
+    transmission_network.simulate_sequence_evolution) under the model of
+    data/HBL/SimulateSequence.bf, which it reads: GTR exchangeabilities, base frequencies and
+    a rate class for every site. Transition matrices come from one eigendecomposition of the
+    rate matrix and are cached per branch length; sequences are uint8 arrays, and the nodes
+    at the same depth of all the chains in a batch are evolved together.
+'''
+
+import json
+import os
+import random
+import re
+from collections import Counter, OrderedDict
+from functools import partial
+
+import numpy as np
+
+__all__ = ['pref_attachment_forest', 'job_seed', 'sampled_network_statistics', 'run_replicates', 'replicate_table',
+           'gtr_model', 'default_model', 'simulate_chains']
+
+#-------------------------------------------------------------------------------
+
+
+def _resolve(pointers):
+    ''' follow pointers (each to itself or to a smaller index) to their ends '''
+    while True:
+        jumped = pointers[pointers]
+        if np.array_equal(jumped, pointers):
+            return pointers
+        pointers = jumped
+
+
+def pref_attachment_forest(network_size=100, start_with=1, random_attachment=0.0, start_new_tree=0.0, tick_rate=None, poisson_mean=None, seed=None):
+    ''' a random forest of network_size nodes (node k has ID str (k + 1)), as a dict of arrays
+
+        parents: the parent of each node, -1 for the roots
+        chains:  the transmission chain (tree) of each node; chains are numbered in the order
+                 of their roots
+        days:    with tick_rate, the date of each node in days since the start (None otherwise)
+
+        The first start_with nodes are roots; every later node starts a new chain with
+        probability start_new_tree, links to a uniformly chosen earlier node with
+        probability random_attachment, and otherwise picks an entry of the attach_to list
+        (each root once, and both ends of every link) uniformly.
+
+        Dates are kept per chain: every chain starts with a burst of 1, and when a node
+        attaches to a chain whose current burst is used up, the chain's date advances by an
+        exponential wait with mean tick_rate days and a new burst of 1 + Poisson (poisson_mean)
+        nodes (1 if poisson_mean is None) starts. Nodes take the date of their chain after
+        their own attachment; new chains start at the current date of a uniformly chosen
+        earlier chain. seed is passed to numpy.random.default_rng.
+    '''
+    if start_with < 1:
+        raise ValueError('Need at least one starting node')
+    rng = np.random.default_rng(seed)
+    n = max(network_size, start_with)
+    index = np.arange(n, dtype=np.int64)
+
+    roots = index < start_with
+    if start_new_tree > 0.:
+        roots |= rng.random(n) < start_new_tree
+    uniform = ~roots & (rng.random(n) < random_attachment) if random_attachment > 0. else np.zeros(n, dtype=np.bool_)
+    preferential = ~roots & ~uniform
+
+    # the attach_to list: one entry (the node itself) per root; two (the parent, then the
+    # node) for every other node
+    entries = np.where(roots, 1, 2)
+    first_entry = np.cumsum(entries) - entries
+    values = np.zeros(int(entries.sum()), dtype=np.int64)
+    pointers = np.arange(len(values), dtype=np.int64)
+    values[first_entry + ~roots] = index
+
+    picked = np.flatnonzero(uniform)
+    values[first_entry[picked]] = np.floor(rng.random(len(picked)) * picked).astype(np.int64)
+    picked = np.flatnonzero(preferential)
+    pointers[first_entry[picked]] = np.floor(rng.random(len(picked)) * first_entry[picked]).astype(np.int64)
+    values = values[_resolve(pointers)]
+
+    attached = np.flatnonzero(~roots)
+    parents = np.full(n, -1, dtype=np.int64)
+    parents[attached] = values[first_entry[attached]]
+
+    root_chain = np.cumsum(roots) - 1
+    chains = root_chain[_resolve(np.where(roots, index, parents))]
+
+    forest = {'parents': parents, 'chains': chains, 'days': None}
+    if tick_rate is None:
+        return forest
+
+    # attachments grouped by chain, in node order
+    chain_count = int(roots.sum())
+    events = attached[np.lexsort((attached, chains[attached]))]
+    event_chain = chains[events]
+    counts = np.bincount(event_chain, minlength=chain_count)
+    starts = np.cumsum(counts) - counts
+    event_count = len(events)
+    segment_start = np.repeat(starts, counts)
+    position = np.arange(event_count) - segment_start + 1  # within the chain, from 1
+
+    bursts = np.ones(event_count, dtype=np.int64) if poisson_mean is None else 1 + rng.poisson(poisson_mean, event_count)
+    bursts[starts[counts > 0]] = 1
+    waits = rng.exponential(tick_rate, event_count)
+
+    # a chain ticks at its attachments number 1, 1 + b1, 1 + b1 + b2, ...
+    ticks_at = np.cumsum(bursts)
+    ticks_at -= np.repeat((ticks_at - bursts)[starts[counts > 0]], counts[counts > 0])
+    ticks_at = np.minimum(ticks_at, np.repeat(counts, counts) + 1)
+    stride = event_count + 2
+    ticks = np.searchsorted(event_chain * stride + ticks_at, event_chain * stride + position, side='right') - segment_start
+    elapsed = np.cumsum(waits)
+    elapsed -= np.repeat((elapsed - waits)[starts[counts > 0]], counts[counts > 0])
+    after_event = elapsed[segment_start + ticks - 1]
+
+    # new chains start at the date of an earlier chain, as of their first node
+    chain_roots = np.flatnonzero(roots)
+    source = np.arange(chain_count, dtype=np.int64)
+    offset = np.zeros(chain_count)
+    later = np.arange(start_with, chain_count)
+    if len(later):
+        source[later] = np.floor(rng.random(len(later)) * later).astype(np.int64)
+        stride = n + 1
+        found = np.searchsorted(event_chain * stride + events, source[later] * stride + chain_roots[later])
+        offset[later] = np.where(found > starts[source[later]], after_event[np.maximum(found - 1, 0)], 0.)
+    # chain_start [c] = offset [c] + chain_start [source [c]], with source [c] < c; the first
+    # start_with chains are their own sources, at offset 0
+    while True:
+        jumped = source[source]
+        offset = offset + offset[source]
+        if np.array_equal(jumped, source):
+            break
+        source = jumped
+    chain_start = offset
+
+    days = chain_start[chains]
+    days[events] += after_event
+    forest['days'] = days
+    return forest
+
+#-------------------------------------------------------------------------------
+
+
+def _job_key(job):
+    return json.dumps(job, sort_keys=True)
+
+
+def job_seed(master_seed, job):
+    ''' a 64 bit seed for job (a dict of JSON values, without 'seed') derived from
+        master_seed; different jobs get independent streams '''
+    job = dict((k, v) for k, v in job.items() if k != 'seed')
+    entropy = [int(master_seed)] + list(_job_key(job).encode('utf-8'))
+    low, high = np.random.SeedSequence(entropy).generate_state(2)
+    return (int(high) << 32) | int(low)
+
+
+def sampled_network_statistics(job):
+    ''' the job of SimulateRandom.py: a preferential attachment network of job ['size'] nodes
+        (with the 'start with', 'random attachment' and 'start new tree' options of
+        generate_pref_attachment_network, if given), sampled down to job ['sample'] nodes
+        with job ['bias'] (sample_from_network). Returns the edges, nodes and clusters of the
+        sample (counted as describe_network counts them) and, with job ['fit degrees'], the best fitting degree distribution and its
+        rho (this needs HyPhy) '''
+    from .mtnetwork import transmission_network
+
+    network = transmission_network()
+    network.generate_pref_attachment_network(job['size'], start_with=job.get('start with', 1),
+                                             random_attachment=job.get('random attachment', 0.),
+                                             start_new_tree=job.get('start new tree', 0.), seed=job['seed'])
+    sample = network.sample_from_network(job.get('sample', job['size']), node_sampling_bias=job.get('bias', 0.), seed=job['seed'])
+
+    counts = sample.get_edge_node_count()
+    sample.compute_clusters()
+    result = {'edges': counts['edges'], 'nodes': counts['nodes'], 'clusters': len(sample.retrieve_clusters())}
+    if job.get('fit degrees'):
+        fit = sample.fit_degree_distribution()
+        result['model'] = fit['Best']
+        result['rho'] = fit['rho'][fit['Best']] if fit['Best'] is not None else None
+    return result
+
+
+def _seeded_call(function, job):
+    # work which draws from the random module gets the job's stream as well (each worker is
+    # a process of its own, see run_replicates)
+    random.seed(job['seed'])
+    return job, function(job)
+
+
+def run_replicates(jobs, function=sampled_network_statistics, master_seed=0, checkpoint=None, executor=None):
+    ''' yield (job, function (job)) for every job (a dict of JSON values, to which 'seed' is
+        added), in the order they complete. function must be picklable (defined at module
+        level) and return a dict of JSON values. With checkpoint (a path), the results
+        recorded there are yielded first instead of being computed again, and new ones are
+        appended to it as they arrive. executor defaults to the shared one.
+
+        function may draw from the random module: it is seeded with the job's seed before
+        each job. Threads would share that one stream, so a thread executor is replaced by a
+        process pool with as many workers. '''
+    from .executor import get_executor, executor as new_executor
+
+    done = {}
+    if checkpoint is not None and os.path.exists(checkpoint):
+        with open(checkpoint, 'rb+') as fh:
+            recorded = fh.read()
+            # the last line of an interrupted run may be cut short; drop it, so that the next
+            # record starts on a line of its own
+            complete = recorded.rfind(b'\n') + 1
+            if complete < len(recorded):
+                fh.truncate(complete)
+        for line in recorded[:complete].decode('utf-8').splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            done[_job_key(record['job'])] = record['result']
+
+    pending = []
+    for job in jobs:
+        job = dict(job)
+        job['seed'] = job_seed(master_seed, job)
+        if _job_key(job) in done:
+            yield job, done[_job_key(job)]
+        else:
+            pending.append(job)
+
+    if not pending:
+        return
+    workers = executor or get_executor()
+    processes = new_executor('process', workers.workers) if workers.kind == 'thread' else None
+    out = open(checkpoint, 'a') if checkpoint is not None else None
+    try:
+        for job, result in (processes or workers).map(partial(_seeded_call, function), pending, chunk_size=1, ordered=False):
+            if out is not None:
+                out.write(json.dumps({'job': job, 'result': result}, sort_keys=True) + '\n')
+                out.flush()
+            yield job, result
+    finally:
+        if out is not None:
+            out.close()
+        if processes is not None:
+            processes.close()
+
+
+class replicate_table:
+    ''' results of replicated jobs, grouped by the values of the job parameters in group_by:
+        the values of each result field are kept per group, in arrival order '''
+
+    def __init__(self, group_by):
+        self.group_by = tuple(group_by)
+        self.groups = OrderedDict()
+
+    def add(self, job, result):
+        group = self.groups.setdefault(tuple(job[k] for k in self.group_by), {})
+        for field, value in result.items():
+            group.setdefault(field, []).append(value)
+
+    def values(self, group, field):
+        return self.groups[group].get(field, [])
+
+    def rows(self, order=None):
+        ''' yield a summary dict per group (sorted by group values unless order is False):
+            the group parameters, 'replicates', and for each result field, its mean and
+            standard deviation ('field mean', 'field sd') if its values are numbers, or the
+            most common value ('field mode') otherwise '''
+        groups = sorted(self.groups) if order is not False else list(self.groups)
+        for group in groups:
+            fields = self.groups[group]
+            row = OrderedDict(zip(self.group_by, group))
+            row['replicates'] = max((len(v) for v in fields.values()), default=0)
+            for field, values in fields.items():
+                numbers = [v for v in values if isinstance(v, (int, float)) and not isinstance(v, bool)]
+                if numbers and len(numbers) == len(values):
+                    row[field + ' mean'] = float(np.mean(numbers))
+                    row[field + ' sd'] = float(np.std(numbers, ddof=1)) if len(numbers) > 1 else 0.
+                else:
+                    row[field + ' mode'] = Counter(values).most_common(1)[0][0]
+            yield row
+
+#-------------------------------------------------------------------------------
+# sequence evolution
+
+
+class gtr_model:
+    ''' the substitution model of a HyPhy simulation batch file (SimulateSequence.bf by
+        default): GTR exchangeabilities, base frequencies, the rate class of each site and
+        the relative rate of each class. As in HyPhy, rates are multiplied by the target
+        base frequencies and branch lengths are expected substitutions per site. '''
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data", "HBL", "SimulateSequence.bf")
+        with open(path, 'r') as fh:
+            text = fh.read()
+
+        def matrix(name):
+            found = re.search(r'\b%s\s*=\s*\{((?:\s*\{[^{}]*\})+)\s*\}' % name, text)
+            if found is None:
+                raise ValueError('%s : could not find the %s matrix' % (path, name))
+            return [float(k) for k in re.findall(r'[-+]?[\d.]+(?:[eE][-+]?\d+)?', found.group(1))]
+
+        self.site_classes = np.array(matrix('site_rates'), dtype=np.int64)
+        self.class_rates = np.array(matrix('rate_values'))
+        self.frequencies = np.array(matrix('vectorOfFrequencies'))
+
+        parameters = dict((k, float(v)) for k, v in re.findall(r'global\s+(\w+)\s*:=\s*([-+\d.eE]+)\s*;', text))
+        self.exchangeabilities = np.zeros((4, 4))
+        for i, j, name in re.findall(r'GRM\[(\d)\]\[(\d)\]\s*:=\s*(?:(\w+)\s*\*\s*)?mu\s*;', text):
+            self.exchangeabilities[int(i), int(j)] = parameters[name] if name else 1.
+        if len(self.frequencies) != 4 or not self.exchangeabilities.any():
+            raise ValueError('%s : could not read a nucleotide rate matrix' % path)
+
+        rates = self.exchangeabilities * self.frequencies[np.newaxis, :]
+        np.fill_diagonal(rates, 0.)
+        np.fill_diagonal(rates, -rates.sum(axis=1))
+        rates /= -(self.frequencies * np.diag(rates)).sum()
+        self.rate_matrix = rates
+
+        # a reversible rate matrix is similar to a symmetric one
+        root = np.sqrt(self.frequencies)
+        symmetric = root[:, np.newaxis] * rates / root[np.newaxis, :]
+        self._eigenvalues, vectors = np.linalg.eigh((symmetric + symmetric.T) / 2)
+        self._left = vectors / root[:, np.newaxis]
+        self._right = vectors.T * root[np.newaxis, :]
+        self._cumulative = {}
+
+    def transition(self, lengths):
+        ''' transition probability matrices [length, from, to] for branches of these many
+            expected substitutions per site '''
+        lengths = np.asarray(lengths, dtype=float)
+        scaled = np.exp(lengths[..., np.newaxis] * self._eigenvalues)
+        probabilities = np.maximum(np.einsum('ik,...k,kj->...ij', self._left, scaled, self._right), 0.)
+        return probabilities / probabilities.sum(axis=-1)[..., np.newaxis]
+
+    def cumulative(self, lengths):
+        ''' cumulative transition probabilities [length, site class, from, to] for these
+            branch lengths; tables are cached per length '''
+        # the tables for this call are collected locally, so that another thread emptying the
+        # cache (a model is shared by the threads of a thread executor) cannot remove them
+        found = {}
+        missing = []
+        for length in set(lengths):
+            table = self._cumulative.get(length)
+            if table is None:
+                missing.append(length)
+            else:
+                found[length] = table
+        if missing:
+            tables = np.cumsum(self.transition(np.multiply.outer(missing, self.class_rates)), axis=-1)
+            tables[..., -1] = 1.
+            computed = dict(zip(missing, tables))
+            found.update(computed)
+            if len(self._cumulative) + len(computed) > _cached_lengths:
+                self._cumulative.clear()
+            self._cumulative.update(computed)
+        return np.stack([found[length] for length in lengths])
+
+    def classes_for(self, length):
+        ''' the rate classes of the first length sites (sites past the end of the model's
+            list are in the first class) '''
+        classes = np.zeros(length, dtype=np.int64)
+        known = min(length, len(self.site_classes))
+        classes[:known] = self.site_classes[:known]
+        return classes
+
+
+# branch lengths with cached transition tables (sampling delays are continuous, so the
+# cache is emptied when it grows past this)
+_cached_lengths = 1 << 16
+
+_model = []
+
+
+def default_model():
+    ''' the gtr_model of SimulateSequence.bf, read once per process '''
+    if not _model:
+        _model.append(gtr_model())
+    return _model[0]
+
+
+_codes = np.full(256, 255, dtype=np.uint8)
+for _k, _c in enumerate('ACGT'):
+    _codes[ord(_c)] = _codes[ord(_c.lower())] = _k
+_letters = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+# rows evolved at a time (bounds the size of the temporary arrays)
+_block_rows = 256
+
+
+def _evolve(model, states, classes, lengths, streams, owners):
+    ''' new states for the rows of states, each evolved for its length; the random numbers
+        of a row come from streams [owners [row]] '''
+    evolved = states.copy()
+    moving = np.flatnonzero(lengths > 0)
+    if len(moving):
+        unique, which = np.unique(lengths[moving], return_inverse=True)
+        # thresholds [k] [(length, class, from)]: the chance of moving to one of the first k + 1 states
+        thresholds = np.ascontiguousarray(model.cumulative(unique.tolist())[..., :3].reshape(-1, 3).T)
+        uniform = np.empty((min(_block_rows, len(moving)), states.shape[1]))
+        for start in range(0, len(moving), _block_rows):
+            rows = moving[start:start + _block_rows]
+            for k, row in enumerate(rows.tolist()):
+                streams[owners[row]].random(out=uniform[k])
+            draws = uniform[:len(rows)]
+            index = (which[start:start + _block_rows, np.newaxis] * len(model.class_rates) + classes[np.newaxis, :]) * 4 + states[rows]
+            state = (draws >= np.take(thresholds[0], index)).view(np.uint8)
+            state += draws >= np.take(thresholds[1], index)
+            state += draws >= np.take(thresholds[2], index)
+            evolved[rows] = state
+    return evolved
+
+
+def simulate_chains(chains, seeds=None, model=None):
+    ''' evolve sequences down transmission chains; chains is a list of (founder sequence,
+        tree matrix), where the tree matrix has the rows [node, parent node (-1 for the
+        founder), branch length, sampling delay] that simulate_sequence_evolution passes to
+        SimulateSequence.bf, with parents before their children. As there, every row is a
+        hidden node, which evolves from its parent's hidden node (the founder sequence for
+        the founder) along the branch, and the node's sampled sequence, which evolves from
+        the hidden node for the sampling delay (both in expected substitutions per site).
+        Returns a {node: sequence} dict per chain. Chain k draws its random numbers from
+        numpy.random.default_rng (seeds [k]), so its result does not depend on the other
+        chains simulated with it. '''
+    model = model or default_model()
+    if seeds is None:
+        seeds = [None] * len(chains)
+    results = [None] * len(chains)
+
+    by_length = {}
+    for k, (sequence, tree_matrix) in enumerate(chains):
+        by_length.setdefault(len(sequence), []).append(k)
+
+    for length, members in by_length.items():
+        classes = model.classes_for(length)
+        streams = [np.random.default_rng(seeds[k]) for k in members]
+
+        founders = np.empty((len(members), length), dtype=np.uint8)
+        names, owners, parents, branches, delays, depths = [], [], [], [], [], []
+        for m, k in enumerate(members):
+            sequence, tree_matrix = chains[k]
+            founders[m] = _codes[np.frombuffer(sequence.encode('ascii'), dtype=np.uint8)]
+            rows = {}
+            for node, parent, branch, delay in ((int(r[0]), int(r[1]), float(r[2]), float(r[3])) for r in tree_matrix):
+                rows[node] = len(names)
+                names.append(node)
+                owners.append(m)
+                parents.append(rows[parent] if parent >= 0 else -1 - m)
+                depths.append(depths[rows[parent]] + 1 if parent >= 0 else 0)
+                branches.append(branch)
+                delays.append(delay)
+        if (founders == 255).any():
+            raise ValueError('Founder sequences must consist of A, C, G and T')
+
+        parents = np.array(parents, dtype=np.int64)
+        branches = np.array(branches)
+        owners = np.array(owners, dtype=np.int64)
+        depths = np.array(depths, dtype=np.int64)
+
+        hidden = np.empty((len(names), length), dtype=np.uint8)
+        for depth in range(int(depths.max()) + 1 if len(names) else 0):
+            level = np.flatnonzero(depths == depth)
+            ancestors = founders[-1 - parents[level]] if depth == 0 else hidden[parents[level]]
+            hidden[level] = _evolve(model, ancestors, classes, branches[level], streams, owners[level])
+        sampled = _evolve(model, hidden, classes, np.array(delays), streams, owners)
+
+        for m, k in enumerate(members):
+            results[k] = {}
+        for row, (name, m) in enumerate(zip(names, owners.tolist())):
+            results[members[m]][name] = _letters[sampled[row]].tobytes().decode('ascii')
+
+    return results
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+''' Tamura-Nei (TN93) pairwise distances between aligned nucleotide sequences.
+
+    Sequences are encoded as uint8 arrays (A, C, G, T = 0, 1, 2, 3) after the same
+    ambiguity resolution network_sequence_simulator applies, and each sequence is
+    compared to the rest of the alignment in blocks with NumPy. Sites are visited in
+    slabs, and a pair is dropped as soon as its mismatch count puts its p-distance
+    (which bounds the TN93 distance from below) over the threshold.
+'''
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .executor import executor_for
+from .fasta import read_fasta
+
+__all__ = ['resolve_ambiguities', 'encode_alignment', 'tn93_distance', 'tn93_pairs', 'tn93_pairs_from_fasta']
+
+resolve_ambiguities = str.maketrans("RYSWKMBDHVN-", "ACCAGACAAAAA")
+
+_nucleotide_codes = np.full(256, 255, dtype=np.uint8)
+for k, c in enumerate('ACGT'):
+    _nucleotide_codes[ord(c)] = k
+_nucleotide_codes[ord('U')] = 3
+
+# the kind of difference encoded by (4 * base1 + base2): match, A<->G, C<->T or transversion
+_MATCH, _AG, _CT, _TRANSVERSION = 0, 1, 2, 3
+_pair_class = np.full(16, _TRANSVERSION, dtype=np.uint8)
+for k in range(4):
+    _pair_class[5 * k] = _MATCH
+_pair_class[0 * 4 + 2] = _pair_class[2 * 4 + 0] = _AG
+_pair_class[1 * 4 + 3] = _pair_class[3 * 4 + 1] = _CT
+
+#-------------------------------------------------------------------------------
+
+
+def encode_alignment(sequences):
+    ''' encode equal length sequences as an (N, L) uint8 array '''
+    encoded = []
+    for index, sequence in enumerate(sequences):
+        row = _nucleotide_codes[np.frombuffer(sequence.upper().translate(resolve_ambiguities).encode('ascii'), dtype=np.uint8)]
+        if (row == 255).any():
+            raise ValueError('Sequence %d contains characters which are not nucleotides or IUPAC ambiguities' % (index + 1))
+        if encoded and len(row) != len(encoded[0]):
+            raise ValueError('Sequence %d has length %d; expected an alignment with sequences of length %d' %
+                             (index + 1, len(row), len(encoded[0])))
+        encoded.append(row)
+
+    if not encoded:
+        return np.zeros((0, 0), dtype=np.uint8)
+    return np.vstack(encoded)
+
+
+def tn93_distance(p1, p2, q, frequencies):
+    ''' TN93 distance from the proportions of A<->G transitions (p1), C<->T transitions (p2)
+        and transversions (q); frequencies is (..., 4) in ACGT order. Saturated pairs are inf.
+    '''
+    pi_a, pi_c, pi_g, pi_t = (frequencies[..., k] for k in range(4))
+    pi_r = pi_a + pi_g
+    pi_y = pi_c + pi_t
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        k_ag = 2. * pi_a * pi_g / pi_r
+        k_ct = 2. * pi_c * pi_t / pi_y
+        k_ry = 2. * (pi_r * pi_y - pi_a * pi_g * pi_y / pi_r - pi_c * pi_t * pi_r / pi_y)
+
+        arg_ag = 1. - p1 / k_ag - q / (2. * pi_r)
+        arg_ct = 1. - p2 / k_ct - q / (2. * pi_y)
+        arg_ry = 1. - q / (2. * pi_r * pi_y)
+
+        distance = (np.where(k_ag > 0., -k_ag * np.log(arg_ag), 0.) +
+                    np.where(k_ct > 0., -k_ct * np.log(arg_ct), 0.) +
+                    np.where(k_ry > 0., -k_ry * np.log(arg_ry), 0.))
+
+    saturated = ((k_ag > 0.) & (arg_ag <= 0.)) | ((k_ct > 0.) & (arg_ct <= 0.)) | ((k_ry > 0.) & (arg_ry <= 0.))
+    distance = np.where(saturated | np.isnan(distance), np.inf, distance)
+    return np.where(p1 + p2 + q == 0., 0., distance)
+
+
+def _compare_rows(alignment, base_counts, rows, threshold, block_size=2048, slab=128):
+    ''' compare each sequence in rows with every later sequence; return the (i, j, distance)
+        arrays for pairs within the threshold (all pairs if threshold is None)
+    '''
+    count, length = alignment.shape
+    max_mismatches = np.inf if threshold is None else threshold * length
+
+    found_i, found_j, found_d = [], [], []
+
+    for i in rows:
+        reference = alignment[i] << 2
+        for start in range(i + 1, count, block_size):
+            others = np.arange(start, min(count, start + block_size))
+            differences = np.zeros((len(others), 3), dtype=np.int64)
+
+            for site in range(0, length, slab):
+                classes = _pair_class[reference[site:site + slab] | alignment[others, site:site + slab]]
+                for k, kind in enumerate((_AG, _CT, _TRANSVERSION)):
+                    differences[:, k] += np.count_nonzero(classes == kind, axis=1)
+
+                keep = differences.sum(axis=1) <= max_mismatches
+                if not keep.all():
+                    others = others[keep]
+                    differences = differences[keep]
+                    if len(others) == 0:
+                        break
+
+            if len(others):
+                frequencies = (base_counts[i] + base_counts[others]) / (2. * length)
+                proportions = differences / float(length)
+                distances = tn93_distance(proportions[:, 0], proportions[:, 1], proportions[:, 2], frequencies)
+                if threshold is not None:
+                    keep = distances <= threshold
+                    others = others[keep]
+                    distances = distances[keep]
+                found_i.append(np.full(len(others), i, dtype=np.int32))
+                found_j.append(others.astype(np.int32))
+                found_d.append(distances)
+
+    if not found_i:
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), np.zeros(0)
+    return np.concatenate(found_i), np.concatenate(found_j), np.concatenate(found_d)
+
+
+def _base_counts(alignment):
+    return np.stack([np.count_nonzero(alignment == k, axis=1) for k in range(4)], axis=1).astype(np.float64)
+
+#-------------------------------------------------------------------------------
+# worker processes attach to the encoded alignment in shared memory
+
+_shared = {}
+
+
+def _attach_alignment(name, shape, threshold):
+    block = shared_memory.SharedMemory(name=name)
+    alignment = np.ndarray(shape, dtype=np.uint8, buffer=block.buf)
+    _shared.update({'block': block, 'alignment': alignment, 'counts': _base_counts(alignment), 'threshold': threshold})
+
+
+def _detach_alignment():
+    ''' release the alignment; the array has to go before its block can be closed '''
+    _shared.pop('alignment', None)
+    if 'block' in _shared:
+        _shared.pop('block').close()
+
+
+def _compare_row_range(row_range):
+    return _compare_rows(_shared['alignment'], _shared['counts'], range(*row_range), _shared['threshold'])
+
+
+def _row_ranges(count, tasks):
+    ''' split rows into ranges with about the same number of comparisons each '''
+    total = count * (count - 1) // 2
+    per_task = max(1, total // max(1, tasks))
+    start = 0
+    done = 0
+    for i in range(count):
+        done += count - i - 1
+        if done >= per_task:
+            yield (start, i + 1)
+            start = i + 1
+            done = 0
+    if start < count:
+        yield (start, count)
+
+
+def tn93_pairs(names, sequences, threshold=0.015, processes=None):
+    ''' yield [name1, name2, distance] for every pair of aligned sequences with TN93
+        distance at or below threshold (every pair if threshold is None); the records
+        can be passed to transmission_network.read_from_pairs directly
+    '''
+    alignment = encode_alignment(sequences)
+    names = list(names)
+    if len(names) != alignment.shape[0]:
+        raise ValueError('Expected one name per sequence')
+
+    if processes == 1 or alignment.shape[0] < 64:
+        i, j, d = _compare_rows(alignment, _base_counts(alignment), range(alignment.shape[0]), threshold)
+        for k in range(len(i)):
+            yield [names[i[k]], names[j[k]], float(d[k])]
+        return
+
+    block = shared_memory.SharedMemory(create=True, size=max(1, alignment.nbytes))
+    try:
+        np.ndarray(alignment.shape, dtype=np.uint8, buffer=block.buf)[:] = alignment
+        with executor_for(processes) as workers:
+            row_ranges = _row_ranges(alignment.shape[0], workers.workers * 16)
+            for i, j, d in workers.map(_compare_row_range, row_ranges, setup=_attach_alignment,
+                                       setup_args=(block.name, alignment.shape, threshold), teardown=_detach_alignment, chunk_size=1):
+                for k in range(len(i)):
+                    yield [names[i[k]], names[j[k]], float(d[k])]
+    finally:
+        block.close()
+        block.unlink()
+
+
+def tn93_pairs_from_fasta(file_name, threshold=0.015, processes=None):
+    ''' tn93_pairs for the sequences in a FASTA file '''
+    records = list(read_fasta(file_name))
+    return tn93_pairs([r[0] for r in records], [r[1] for r in records], threshold, processes)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+''' Triangles, local clustering coefficients and transitivity of an undirected graph in
+    CSR form (indptr, indices; both directions, no self loops, no repeated pairs).
+
+    Every link is oriented from the endpoint of lower rank (degree, then index) to the
+    other one, so that each triangle u < v < w (by rank) is found exactly once, from its
+    link u -> v, as a w which follows both u and v. No node has more than sqrt(2 * links)
+    neighbors of higher rank, which keeps the work at O(links ^ 1.5) however skewed the
+    degrees are.
+
+    The neighbors of higher rank of each node are kept sorted, and the intersections are
+    done in bulk: the candidates w of a batch of links u -> v (the sorted list for v) are
+    looked up in the sorted keys u * n + x of all oriented links with numpy.searchsorted.
+'''
+
+import numpy as np
+
+__all__ = ['adjacency_csr', 'csr_from_adjacency', 'oriented_csr', 'triangles', 'triangle_counts', 'clustering_values', 'transitivity']
+
+# candidate (u, v, w) triples looked up at a time
+_batch = 1 << 20
+
+#-------------------------------------------------------------------------------
+
+
+def adjacency_csr(node_count, first, second):
+    ''' (indptr, indices) from the distinct undirected pairs first [k] - second [k];
+        neighbors of each node are in increasing order '''
+    first = np.asarray(first, dtype=np.int64)
+    second = np.asarray(second, dtype=np.int64)
+    sources = np.concatenate((first, second))
+    targets = np.concatenate((second, first))
+    order = np.lexsort((targets, sources))
+    indptr = np.zeros(node_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=node_count), out=indptr[1:])
+    return indptr, targets[order]
+
+
+def csr_from_adjacency(adjacency):
+    ''' (nodes, indptr, indices) of a dict node -> linked nodes (either direction may be
+        listed; links of a node to itself are dropped); rows follow the order of the dict '''
+    nodes = list(adjacency)
+    index = {n: k for k, n in enumerate(nodes)}
+    pairs = set()
+    for a, linked in adjacency.items():
+        for b in linked:
+            i, j = index[a], index[b]
+            if i != j:
+                pairs.add((i, j) if i < j else (j, i))
+    return (nodes,) + adjacency_csr(len(nodes), [p[0] for p in pairs], [p[1] for p in pairs])
+
+
+def oriented_csr(indptr, indices):
+    ''' (indptr, indices) of the links from each node to its neighbors of higher rank,
+        in increasing order '''
+    node_count = len(indptr) - 1
+    degrees = np.diff(indptr)
+    rank = np.empty(node_count, dtype=np.int64)
+    rank[np.lexsort((np.arange(node_count), degrees))] = np.arange(node_count)
+
+    sources = np.repeat(np.arange(node_count), degrees)
+    forward = rank[sources] < rank[indices]
+    out_indptr = np.zeros(node_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources[forward], minlength=node_count), out=out_indptr[1:])
+    # indices are sorted within each row already, and selecting keeps that order
+    return out_indptr, np.asarray(indices)[forward].astype(np.int64)
+
+
+def triangles(indptr, indices, batch=None):
+    ''' yield (a, b, c) arrays of node indices, each triangle of the graph once '''
+    batch = batch or _batch
+    node_count = len(indptr) - 1
+    out_indptr, out_indices = oriented_csr(indptr, indices)
+    out_degrees = np.diff(out_indptr)
+    sources = np.repeat(np.arange(node_count, dtype=np.int64), out_degrees)
+    keys = sources * node_count + out_indices  # sorted, since rows and their entries are
+
+    wedges = out_degrees[out_indices]  # candidates for each oriented link
+    ends = np.cumsum(wedges)
+    start = 0
+    while start < len(out_indices):
+        # the links whose candidates fit in this batch (at least one link)
+        stop = max(int(np.searchsorted(ends, (ends[start - 1] if start else 0) + batch, side='right')), start + 1)
+        lengths = wedges[start:stop]
+        total = int(lengths.sum())
+        if total:
+            offsets = np.cumsum(lengths) - lengths
+            positions = np.repeat(out_indptr[out_indices[start:stop]] - offsets, lengths) + np.arange(total)
+            u = np.repeat(sources[start:stop], lengths)
+            v = np.repeat(out_indices[start:stop], lengths)
+            w = out_indices[positions]
+            wanted = u * node_count + w
+            found = np.minimum(np.searchsorted(keys, wanted), len(keys) - 1)
+            hit = keys[found] == wanted
+            if hit.any():
+                yield u[hit], v[hit], w[hit]
+        start = stop
+
+
+def triangle_counts(indptr, indices):
+    ''' the number of triangles each node is in '''
+    node_count = len(indptr) - 1
+    counts = np.zeros(node_count, dtype=np.int64)
+    for found in triangles(indptr, indices):
+        for corner in found:
+            counts += np.bincount(corner, minlength=node_count)
+    return counts
+
+
+def clustering_values(counts, degrees):
+    ''' local clustering coefficients, 2 * triangles / (degree * (degree - 1)); 0 for nodes
+        with fewer than two neighbors '''
+    counts = np.asarray(counts, dtype=np.float64)
+    pairs = np.asarray(degrees, dtype=np.float64)
+    pairs = pairs * (pairs - 1) / 2
+    return np.divide(counts, pairs, out=np.zeros_like(counts), where=pairs > 0)
+
+
+def transitivity(counts, degrees):
+    ''' 3 * triangles / connected triples (paths of length two), or 0 without any triples '''
+    degrees = np.asarray(degrees, dtype=np.int64)
+    triples = int((degrees * (degrees - 1) // 2).sum())
+    # each triangle is counted at its three corners
+    return float(np.asarray(counts).sum()) / triples if triples else 0.
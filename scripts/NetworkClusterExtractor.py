@@ -1,5 +1,4 @@
 import csv, argparse, sys, os.path
-import hypy as hy
 
 #-------------------------------------------------------------------------------
 
@@ -69,6 +68,7 @@ for cluster in clusters:
 		
 if settings.alignment != None:
 	print ("Processing the alignment through HyPhy")
+	import hypy as hy
 	hy_instance = hy.HyphyInterface ();
 	
 	script_path = os.path.realpath(__file__)
@@ -3,6 +3,8 @@
 import csv, argparse, sys, datetime, time, random, os, math
 #from scipy import stats
 from hivclustering import *
+from hivclustering.executor import executor, set_executor
+from hivclustering.simulation import run_replicates, replicate_table
 
 N          = 648
 replicates = 100
@@ -20,40 +22,40 @@ def describe_network (network):
 def crude_density_estimate (vector, min, max, step, value):
     dim = math.ceil((max-min)/step)
     density = [0.5 for k in range (dim)]
-    
+
     for k in vector:
         bin = int ((k - min) // step)
         density[bin] += 1
 
     norm = sum (density)
     density = [k / norm  for k in density]
-    
+
     return density [int ((value - min) // step)]
 
+arguments = argparse.ArgumentParser(description='Compare sampled preferential attachment networks of various sizes with the expected network statistics.')
+arguments.add_argument('-s', '--seed', help = 'Master random seed; every (size, bias, replicate) job derives its own from it', type = int, default = 0)
+arguments.add_argument('-r', '--replicates', help = 'Replicates for each size and bias', type = int, default = replicates)
+arguments.add_argument('-c', '--checkpoint', help = 'Record finished replicates in this file (JSON lines), and skip those already recorded there', default = None)
+arguments.add_argument('-t', '--threads', help = 'Worker processes (default: one per CPU)', type = int, default = None)
+settings = arguments.parse_args()
+
+set_executor (executor ('process', settings.threads))
+
+biases = [int_bias/100. for int_bias in range (50,51,5)]
+sizes  = list (range (1000,10001,250))
+jobs   = [{'size' : size, 'bias' : bias, 'sample' : N, 'replicate' : rep} for bias in biases for size in sizes for rep in range (settings.replicates)]
+
 print ("\t".join(["Size","Bias","MeanEdges","MeanNodes","MeanClusters","P"]))
 
-bias = 0
-
-random.seed()
-
-for int_bias in range (50,51,5):
-    bias = int_bias/100.
-    for size in range (1000,10001,250):
-        edges    = []
-        clusters = []
-        nodes    = []
-        
-        for rep in range (replicates):
-            sfn = transmission_network ()
-            sfn = sfn.create_a_pref_attachment_network (size).sample_from_network (N,node_sampling_bias=bias)
-            network_stats = sfn.get_edge_node_count ()
-            sfn.compute_clusters()
-            sfn_clusters = sfn.retrieve_clusters()
-            edges += [network_stats['edges']]
-            nodes += [network_stats['nodes']]
-            clusters += [len (sfn_clusters)]
-            #print (edges)
-        
+# a row is printed as soon as all replicates of its size and bias are in
+table = replicate_table (('bias', 'size'))
+for job, result in run_replicates (jobs, master_seed = settings.seed, checkpoint = settings.checkpoint):
+    table.add (job, result)
+    group = (job['bias'], job['size'])
+    edges    = table.values (group, 'edges')
+    if len (edges) == settings.replicates:
+        nodes    = table.values (group, 'nodes')
+        clusters = table.values (group, 'clusters')
         prob = math.log(crude_density_estimate(edges,0,2000,10,expected_stats['edges'])*crude_density_estimate(nodes,0,650,5,expected_stats['nodes'])*crude_density_estimate(clusters,0,200,5,expected_stats['clusters']));
-        
-        print ("\t".join([str(k) for k in [size,bias,sum(edges)/replicates,sum(nodes)/replicates,sum(clusters)/replicates, prob]]))
\ No newline at end of file
+        print ("\t".join([str(k) for k in [job['size'],job['bias'],sum(edges)/len(edges),sum(nodes)/len(nodes),sum(clusters)/len(clusters), prob]]))
+        sys.stdout.flush ()
@@ -19,12 +19,15 @@ setup(name='hivclustering',
             'data/HBL/*.bf',
     ]},
     scripts=[
+        'scripts/hivclusterdiff',
         'scripts/hivnetworkcsv',
+        'scripts/hivnetworkdaemon',
         'scripts/TNS'
     ],
     install_requires=[
         'biopython-extensions >= 0.18.0',
         'HyPhy >= 0.1.3',
         'hyphy-helper >= 0.9.6',
+        'numpy >= 1.13',
         ],
      )
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+import os
+import pickle
+import random
+import tempfile
+
+from hivclustering import *
+
+
+def random_pairs(node_count=400, pair_count=700):
+    random.seed(23)
+    ids = ["S%d" % k for k in range(node_count)]
+    return [[a, b, round(random.random() * 0.02, 5)] for a, b in (random.sample(ids, 2) for k in range(pair_count))]
+
+
+def partition(network):
+    clusters = {}
+    for node in network.nodes:
+        if node.cluster_id is not None:
+            clusters.setdefault(node.cluster_id, set()).add(node.id)
+    return set(frozenset(c) for c in clusters.values())
+
+
+def test_append_matches_rebuild():
+    ''' Appending the pairs of new sequences gives the clusters and degrees of a full rebuild '''
+    pairs = random_pairs()
+    new_ids = set("S%d" % k for k in range(350, 400))
+    old_pairs = [p for p in pairs if p[0] not in new_ids and p[1] not in new_ids]
+    new_pairs = [p for p in pairs if p[0] in new_ids or p[1] in new_ids]
+
+    rebuilt = transmission_network()
+    rebuilt.read_from_pairs(pairs, parsePlain, 0.015)
+    rebuilt.compute_clusters()
+
+    network = transmission_network()
+    network.read_from_pairs(old_pairs, parsePlain, 0.015)
+    network.compute_clusters()
+    network.compute_adjacency()
+    before = {node.id: node.cluster_id for node in network.nodes}
+    sizes_before = {}
+    for cluster_id in before.values():
+        sizes_before[cluster_id] = sizes_before.get(cluster_id, 0) + 1
+
+    edge_count = len(network.edges)
+    report = network.append_pairs(new_pairs, parsePlain, 0.015)
+
+    assert partition(network) == partition(rebuilt)
+    assert sorted((n.id, n.degree) for n in network.nodes) == sorted((n.id, n.degree) for n in rebuilt.nodes)
+    assert report['edges'] == len(network.edges) - edge_count == len(rebuilt.edges) - edge_count
+    assert report['nodes'] == len(rebuilt.nodes) - len(before)
+    network_adjacency = {n.id: set(m.id for m in v) for n, v in network.adjacency_list.items()}
+    rebuilt.compute_adjacency()
+    assert network_adjacency == {n.id: set(m.id for m in v) for n, v in rebuilt.adjacency_list.items()}
+
+    for merged in report['merged']:
+        assert merged['sizes before'] == [sizes_before[k] for k in merged['from']]
+        assert merged['cluster'] == merged['from'][0]
+    for grown in report['grown']:
+        assert grown['size before'] == sizes_before[grown['cluster']] < grown['size']
+    # clusters nobody touched keep their IDs and members
+    touched = set(k for m in report['merged'] for k in m['from']) | set(g['cluster'] for g in report['grown'])
+    for node in network.nodes:
+        if before.get(node.id) is not None and before[node.id] not in touched:
+            assert node.cluster_id == before[node.id]
+
+
+def test_snapshot_round_trip():
+    ''' A saved network can be loaded and appended to '''
+    pairs = random_pairs(100, 150)
+    network = transmission_network()
+    network.read_from_pairs(pairs[:100], parsePlain, 0.015)
+    network.compute_clusters()
+
+    fh, path = tempfile.mkstemp(suffix='.pickle')
+    os.close(fh)
+    try:
+        network.save_snapshot(path)
+        loaded = load_network_snapshot(path)
+    finally:
+        os.remove(path)
+
+    assert partition(loaded) == partition(network)
+    loaded.append_pairs(pairs[100:], parsePlain, 0.015)
+    network.read_from_pairs(pairs[100:], parsePlain, 0.015)
+    network.clear_adjacency()
+    network.compute_clusters()
+    assert partition(loaded) == partition(network)
+
+
+
+class _call_on_load:
+    def __reduce__(self):
+        return (os.getpid, ())
+
+
+def test_snapshot_rejects_other_objects():
+    ''' Snapshots with dated nodes load, pickles which would call a function do not '''
+    network = transmission_network()
+    network.read_from_pairs([["P1|01012005", "P2|02012006", 0.01]], parseAEH, 0.015)
+    fh, path = tempfile.mkstemp(suffix='.pickle')
+    os.close(fh)
+    try:
+        network.save_snapshot(path)
+        loaded = load_network_snapshot(path)
+        assert sorted(n.id for n in loaded.nodes) == ['P1', 'P2']
+        with open(path, 'wb') as out:
+            pickle.dump(_call_on_load(), out)
+        try:
+            load_network_snapshot(path)
+            assert False, 'an arbitrary pickle was loaded'
+        except pickle.UnpicklingError:
+            pass
+    finally:
+        os.remove(path)
+
+def test_append_keeps_cluster_ids_without_adjacency():
+    ''' Cluster IDs are kept when the network has no adjacency list, e.g. a snapshot saved
+        after clear_adjacency '''
+    pairs = random_pairs(100, 150)
+    network = transmission_network()
+    network.read_from_pairs(pairs[:100], parsePlain, 0.015)
+    network.compute_clusters()
+    # IDs that compute_clusters would not reproduce
+    for node in network.nodes:
+        if node.cluster_id is not None:
+            node.cluster_id = 1000 - node.cluster_id
+    network.clear_adjacency()
+    before = dict((node.id, node.cluster_id) for node in network.nodes)
+
+    report = network.append_pairs(pairs[100:], parsePlain, 0.015)
+    assert network.adjacency_list is not None
+    touched = set(k for m in report['merged'] for k in m['from']) | set(g['cluster'] for g in report['grown'])
+    assert all(c >= 1000 - len(before) for c in touched)
+    for node in network.nodes:
+        if before.get(node.id) is not None:
+            assert node.cluster_id == before[node.id] or before[node.id] in touched
@@ -62,3 +62,122 @@ def test_degrees():
     expected = [('Carol', 9), ('Ed', 9), ('Diane', 18), ('Jane', 3), ('Fernando', 15), ('Andre', 12), ('Ike', 6), ('Beverly', 12), ('Heather', 9), ('Garth', 15)]
     assert set(patients) == set(expected)
 
+
+def kite():
+    kite_network = transmission_network()
+    for a, b in [('Andre', 'Beverly'), ('Andre', 'Carol'), ('Andre', 'Diane'), ('Andre', 'Fernando'), ('Beverly', 'Diane'),
+                 ('Beverly', 'Ed'), ('Beverly', 'Garth'), ('Carol', 'Diane'), ('Carol', 'Fernando'), ('Diane', 'Ed'),
+                 ('Diane', 'Fernando'), ('Diane', 'Garth'), ('Ed', 'Garth'), ('Fernando', 'Garth'), ('Fernando', 'Heather'),
+                 ('Garth', 'Heather'), ('Heather', 'Ike'), ('Ike', 'Jane')]:
+        kite_network.add_an_edge(a, b, 1, parsePlain)
+    kite_network.compute_clusters()
+    return kite_network
+
+
+def test_write_centralities():
+    ''' Parallel per-cluster centralities match the Floyd-Warshall path lengths and known betweenness '''
+    import io
+    from hivclustering.executor import executor, set_executor
+
+    expected_betweenness = {'Andre': .0231, 'Beverly': .0231, 'Carol': 0, 'Diane': .1019, 'Ed': 0,
+                            'Fernando': .2315, 'Garth': .2315, 'Heather': .3889, 'Ike': .2222, 'Jane': 0}
+    for kind in ('serial', 'process'):
+        set_executor(executor(kind, 2))
+        network = kite()
+        reference = network.compute_path_stat(network.compute_shortest_paths(subset=network.retrieve_clusters()[1]))
+        rows = network.write_centralities(io.StringIO())
+        assert [r[1] for r in rows] == [n.id for n in network.retrieve_clusters()[1]]
+        for cluster_id, node_id, mean_path, relative, degree, betweenness, closeness, harmonic, triangles, clustering in rows:
+            assert abs(mean_path - reference[network.has_node_with_id(node_id)]) < 1e-9
+            assert abs(betweenness - expected_betweenness[node_id]) < 1e-4
+    set_executor(None)
+
+
+def test_weighted_paths():
+    ''' Dijkstra path lengths and weighted betweenness agree with Floyd-Warshall on distances '''
+    import io
+    import random
+    import numpy as np
+    from hivclustering import centrality
+    from hivclustering.executor import executor, set_executor
+
+    random.seed(3)
+    ids = ["N%d" % k for k in range(40)]
+    network = transmission_network()
+    network.read_from_pairs([[a, b, round(random.uniform(0.001, 0.015), 6)] for a, b in (random.sample(ids, 2) for k in range(90))],
+                            parsePlain, 0.015)
+    network.compute_clusters()
+    cluster = max(network.retrieve_clusters(singletons=False).values(), key=len)
+
+    dijkstra = network.shortest_path_matrix(subset=cluster, use_actual_distances=True)['distances']
+    floyd = network.compute_shortest_paths_with_reconstruction(subset=cluster, use_actual_distances=True)['distances']
+    n = len(cluster)
+    for i in range(n):
+        for j in range(n):
+            if i != j:
+                assert abs(dijkstra[i][j] - floyd[i][j]) < 1e-12
+    # summed distances keep double precision; hop counts are exact in single precision
+    assert dijkstra.dtype == np.float64
+    assert network.shortest_path_matrix(subset=cluster)['distances'].dtype == np.float32
+    # compute_shortest_paths keeps its lists, with None where there is no path
+    listed = network.compute_shortest_paths(subset=cluster, use_actual_distances=True)['distances']
+    assert all(listed[i][j] == dijkstra[i][j] for i in range(n) for j in range(n) if i != j)
+    pairs = transmission_network()
+    pairs.read_from_pairs([['A', 'B', 0.01], ['C', 'D', 0.002]], parsePlain, 0.015)
+    subset = [pairs.has_node_with_id(k) for k in 'ABCD']
+    assert np.isinf(pairs.shortest_path_matrix(subset=subset, use_actual_distances=True)['distances'][0][2])
+    assert pairs.compute_shortest_paths(subset=subset)['distances'] == [[None, 1, None, None], [1, None, None, None],
+                                                                       [None, None, None, 1], [None, None, 1, None]]
+
+    # random distances make shortest paths unique: v is on the s-t path iff d(s,v) + d(v,t) = d(s,t)
+    expected = {}
+    for v in range(n):
+        on_path = sum(1 for s in range(n) for t in range(n) if len(set((s, t, v))) == 3 and abs(floyd[s][v] + floyd[v][t] - floyd[s][t]) < 1e-9)
+        expected[cluster[v].id] = on_path / ((n - 1) * (n - 2))
+
+    position = {node.id: k for k, node in enumerate(cluster)}
+    split_above = centrality._split_above
+    centrality._split_above = 4  # exercise splitting clusters into blocks of sources
+    try:
+        for kind in ('serial', 'process'):
+            set_executor(executor(kind, 2))
+            rows = [r for r in network.write_centralities(io.StringIO(), use_actual_distances=True) if r[0] == cluster[0].cluster_id]
+            assert len(rows) == n
+            for cluster_id, node_id, mean_path, relative, degree, betweenness, closeness, harmonic, triangles, clustering in rows:
+                i = position[node_id]
+                assert abs(mean_path - sum(floyd[i][j] for j in range(n) if j != i) / (n - 1)) < 1e-9
+                assert abs(betweenness - expected[node_id]) < 1e-9
+            assert abs(network.betweenness_centrality(cluster[0].id, newsubset=cluster, use_actual_distances=True) - expected[cluster[0].id]) < 1e-9
+    finally:
+        centrality._split_above = split_above
+        set_executor(None)
+
+
+def test_closeness():
+    ''' Bitset sweeps and per-node searches give the same closeness and harmonic centrality,
+        including on disconnected subsets '''
+    import io
+    from hivclustering import centrality
+
+    network = kite()
+    network.add_an_edge('X', 'Y', 1, parsePlain)
+    network.compute_clusters()
+    subset = list(network.nodes)
+    adjacency, weights = network._subset_graph(subset)
+
+    swept = centrality.closeness_sums(adjacency, range(len(subset)), bitsets=True)
+    searched = centrality.closeness_sums(adjacency, range(len(subset)), bitsets=False)
+    assert swept[0] == searched[0] and swept[2] == searched[2]
+    assert all(abs(a - b) < 1e-12 for a, b in zip(swept[1], searched[1]))
+
+    closeness = network.closeness_centrality()
+    harmonic = network.harmonic_centrality()
+    by_id = dict((n.id, n) for n in subset)
+    # Jane reaches the 9 other kite nodes in 1 + 2 + 3 + 3 + 4 + 4 + 4 + 4 + 4 = 29 steps
+    assert abs(closeness[by_id['Jane']] - (9 / 11) * (9 / 29)) < 1e-12
+    assert abs(closeness[by_id['X']] - (1 / 11) * (1 / 1)) < 1e-12
+    assert abs(harmonic[by_id['X']] - 1 / 11) < 1e-12
+
+    for row in network.write_centralities(io.StringIO()):
+        if row[0] == by_id['Jane'].cluster_id:
+            assert abs(row[6] - 1 / row[2]) < 1e-12
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import os
+import random
+import tempfile
+
+from hivclustering import *
+from hivclustering.clusterdiff import cluster_assignments, diff_clusters, diff_networks
+
+
+def test_diff_categories():
+    ''' Each kind of change is recognised, with its node deltas '''
+    old = {'a1': 1, 'a2': 1, 'a3': 1,            # grows by a4, a5
+           'b1': 2, 'b2': 2, 'c1': 3, 'c2': 3,   # merge
+           'd1': 4, 'd2': 4, 'd3': 4, 'd4': 4,   # splits, loses d5
+           'd5': 4,
+           'e1': 5, 'e2': 5,                     # dissolves
+           'f1': 6, 'f2': 6, 'f3': 6,            # loses f3
+           'g1': 7, 'g2': 7}                     # unchanged
+    new = {'a1': 10, 'a2': 10, 'a3': 10, 'a4': 10, 'a5': 10,
+           'b1': 11, 'b2': 11, 'c1': 11, 'c2': 11, 'x1': 11,
+           'd1': 12, 'd2': 12, 'd3': 13, 'd4': 13,
+           'f1': 14, 'f2': 14,
+           'g1': 15, 'g2': 15,
+           'n1': 16, 'n2': 16}
+
+    report = diff_clusters(old, new)
+    assert report['grown'] == [{'cluster': 10, 'from': 1, 'size before': 3, 'size': 5, 'added': 2, 'lost': 0}]
+    assert report['merged'] == [{'cluster': 11, 'from': [2, 3], 'sizes before': [2, 2], 'shared': [2, 2], 'size': 5, 'added': 1}]
+    assert report['split'] == [{'cluster': 4, 'into': [12, 13], 'sizes': [2, 2], 'shared': [2, 2], 'size before': 5, 'lost': 1}]
+    assert report['dissolved'] == [{'cluster': 5, 'size before': 2}]
+    assert report['shrunk'] == [{'cluster': 14, 'from': 6, 'size before': 3, 'size': 2, 'added': 0, 'lost': 1}]
+    assert report['unchanged'] == [{'cluster': 15, 'from': 7, 'size before': 2, 'size': 2, 'added': 0, 'lost': 0}]
+    assert report['new'] == [{'cluster': 16, 'size': 2}]
+    assert report['summary']['old clusters'] == 7 and report['summary']['new clusters'] == 7
+
+
+def test_diff_sources_agree():
+    ''' Networks, cluster CSVs and snapshots give the same report '''
+    random.seed(5)
+    ids = ["S%d" % k for k in range(300)]
+    pairs = [[a, b, round(random.random() * 0.02, 5)] for a, b in (random.sample(ids, 2) for k in range(400))]
+
+    old = transmission_network()
+    old.read_from_pairs(pairs[:300], parsePlain, 0.015)
+    new = transmission_network()
+    new.read_from_pairs(pairs, parsePlain, 0.015)
+    new.compute_clusters()
+
+    fh, csv_path = tempfile.mkstemp(suffix='.csv')
+    os.close(fh)
+    fh, snapshot_path = tempfile.mkstemp(suffix='.pickle')
+    os.close(fh)
+    try:
+        report = diff_networks(old, new)
+        with open(csv_path, 'w') as out:
+            old.write_clusters(out)
+        new.save_snapshot(snapshot_path)
+        assert cluster_assignments(csv_path) == cluster_assignments(old)
+        assert diff_networks(csv_path, snapshot_path) == report
+    finally:
+        os.remove(csv_path)
+        os.remove(snapshot_path)
+
+    # every new cluster is accounted for exactly once, unless it is the product of a split
+    listed = [r['cluster'] for k in ('new', 'grown', 'shrunk', 'unchanged', 'merged') for r in report[k]]
+    split_into = set(c for r in report['split'] for c in r['into'])
+    assert len(listed) == len(set(listed))
+    assert set(listed) | split_into == set(n.cluster_id for n in new.nodes if n.cluster_id is not None)
+
+
+def test_diff_aeh_sources():
+    ''' A cluster CSV of AEH sequence IDs matches a network, with or without an ID parser '''
+    random.seed(8)
+    headers = ["P%d|%02d01%d" % (k, 1 + k % 12, 2000 + k % 5) for k in range(200)]
+    pairs = [[a, b, round(random.random() * 0.02, 5)] for a, b in (random.sample(headers, 2) for k in range(260))]
+
+    old = transmission_network()
+    old.read_from_pairs(pairs[:200], parseAEH, 0.015)
+    old.compute_clusters()
+    new = transmission_network()
+    new.read_from_pairs(pairs, parseAEH, 0.015)
+
+    fh, csv_path = tempfile.mkstemp(suffix='.csv')
+    os.close(fh)
+    try:
+        with open(csv_path, 'w') as out:
+            old.write_clusters(out)
+        assert set(cluster_assignments(csv_path)) <= set(headers)
+        for id_parser in (None, parseAEH):
+            assert cluster_assignments(csv_path, id_parser) == cluster_assignments(old, id_parser)
+            report = diff_networks(csv_path, new, id_parser)
+            assert report == diff_networks(old, new, id_parser)
+            assert report['summary']['dissolved'] == 0 and report['summary']['new'] < report['summary']['new clusters']
+    finally:
+        os.remove(csv_path)
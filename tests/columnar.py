@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import random
+import tempfile
+
+import numpy as np
+
+from hivclustering import *
+from hivclustering.columnar import load_columnar
+
+
+def test_columnar_round_trip():
+    ''' The columnar archive maps back to the tables of the network it was written from '''
+    random.seed(5)
+    network = transmission_network()
+    for k in range(400):
+        p1, p2 = random.sample(range(150), 2)
+        network.add_an_edge("S%d|%02d01%d" % (p1, 1 + p1 % 12, 2000 + p1 % 3), "S%d|%02d01%d" % (p2, 1 + p2 % 12, 2000 + p2 % 3),
+                            round(random.random() * 0.02, 5), parseAEH)
+    network.insert_patient("lonely", time.strptime("01012001", "%m%d%Y"), False, None)
+    network.has_node_with_id("S1").add_stage("Acute")
+    network.compute_clusters()
+
+    fh, path = tempfile.mkstemp(suffix='.hivcol')
+    os.close(fh)
+    try:
+        network.export_columnar(path)
+        archive = load_columnar(path)
+
+        nodes = archive['nodes']
+        assert nodes['id'].tolist() == [n.id for n in network.nodes]
+        assert not nodes['degree'].flags.writeable
+        row = nodes['id'].tolist().index('S1')
+        assert archive['dictionaries']['stage'][nodes['stage'][row]] == 'Acute'
+        assert str(nodes['baseline'][row]) == '2001-02-01'
+        assert np.isnat(nodes['edi'][row])
+        assert nodes['cluster_id'][nodes['id'].tolist().index('lonely')] == -1
+
+        edges = archive['edges']
+        assert len(edges['distance']) == len([e for e in network.reduce_edge_set() if e.visible])
+        ids = nodes['id'].tolist()
+        distances = {frozenset((e.p1.id, e.p2.id)): network.distances[e] for e in network.edges if e.visible}
+        for k in range(len(edges['distance'])):
+            assert distances[frozenset((ids[edges['source'][k]], ids[edges['target'][k]]))] == edges['distance'][k]
+
+        clusters = archive['clusters']
+        assert clusters['size'].sum() == (nodes['cluster_id'] >= 0).sum()
+        assert clusters['edges'].sum() == len(edges['distance'])
+    finally:
+        os.remove(path)
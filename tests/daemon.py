@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+import asyncio
+import json
+import os
+import tempfile
+
+from hivclustering import *
+from hivclustering.daemon import network_daemon, network_snapshot, load_network
+
+
+def write_csv(rows):
+    fh, path = tempfile.mkstemp(suffix='.csv')
+    with os.fdopen(fh, 'w') as out:
+        print("ID1,ID2,Distance", file=out)
+        for row in rows:
+            print("%s,%s,%g" % row, file=out)
+    return path
+
+
+first = [('A', 'B', 0.004), ('B', 'C', 0.012), ('D', 'E', 0.002), ('E', 'F', 0.02)]
+second = [('C', 'D', 0.01)]
+
+
+def test_snapshot_queries():
+    ''' Lookups against a frozen snapshot '''
+    path = write_csv(first)
+    try:
+        snapshot = network_snapshot(load_network([path], parsePlain, 0.015), 0.015, [path])
+    finally:
+        os.remove(path)
+
+    assert snapshot.status()['edges'] == 3 and snapshot.status()['clusters'] == 2
+    assert snapshot.cluster('A', members=True)['members'] == ['A', 'B', 'C']
+    assert snapshot.cluster('F')['cluster'] is None
+    assert snapshot.neighborhood('B')['neighbors'] == [['A', 0.004], ['C', 0.012]]
+    assert snapshot.degree('B', 0.005)['degree'] == 1
+    assert snapshot.summary(snapshot.cluster('D')['cluster'])['edges'] == 1
+    assert snapshot.rethreshold(0.005)['sizes'] == [2, 2]
+    assert snapshot.rethreshold(0.005, 'C')['members'] == ['C']
+    try:
+        snapshot.cluster('Z')
+        assert False, 'unknown IDs must raise'
+    except KeyError:
+        pass
+
+
+def test_daemon_over_unix_socket():
+    ''' Concurrent queries over a Unix socket; a reload swaps in a new snapshot '''
+    paths = [write_csv(first), write_csv(first + second)]
+    directory = tempfile.mkdtemp()
+    socket_path = os.path.join(directory, 'network.sock')
+
+    async def ask(request):
+        reader, writer = await asyncio.open_unix_connection(socket_path)
+        writer.write(json.dumps(request).encode('utf-8') + b'\n')
+        response = json.loads(await reader.readline())
+        writer.close()
+        return response
+
+    async def session():
+        daemon = network_daemon(lambda inputs: load_network(inputs, parsePlain, 0.015), [paths[0]], 0.015)
+        ready = asyncio.get_running_loop().create_future()
+        server = asyncio.ensure_future(daemon.serve(unix_socket=socket_path, ready=ready))
+        await ready
+
+        answers = await asyncio.gather(*[ask({'query': 'cluster', 'id': n}) for n in 'ABCDE'] + [ask({'query': 'cluster', 'id': 'Q'})])
+        assert [a['size'] for a in answers[:5]] == [3, 3, 3, 2, 2]
+        assert 'error' in answers[5]
+
+        old_snapshot = daemon.snapshot
+        reloaded, during = await asyncio.gather(ask({'query': 'reload', 'inputs': [paths[1]]}), ask({'query': 'degree', 'id': 'C'}))
+        assert reloaded['clusters'] == 1 and reloaded['inputs'] == [paths[1]]
+        assert during['degree'] in (1, 2)
+        assert daemon.snapshot is not old_snapshot
+        assert (await ask({'query': 'cluster', 'id': 'A'}))['size'] == 5
+
+        server.cancel()
+        try:
+            await server
+        except asyncio.CancelledError:
+            pass
+
+    try:
+        asyncio.run(session())
+    finally:
+        for path in paths:
+            os.remove(path)
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        os.rmdir(directory)
+
+
+def test_rethreshold_cache_and_queued_reloads():
+    ''' Re-thresholded clusterings are cached up to a bound; a reload of other inputs made
+        during a reload runs after it instead of sharing its result '''
+    import time
+    from hivclustering import daemon as daemon_module
+
+    paths = [write_csv(first), write_csv(first + second)]
+    try:
+        snapshot = network_snapshot(load_network([paths[1]], parsePlain, 0.015), 0.015, [paths[1]])
+        expected = snapshot.rethreshold(0.005)
+        for k in range(3 * daemon_module._rethreshold_cache):
+            snapshot.rethreshold(0.001 * k)
+        assert len(snapshot._rethresholded) == daemon_module._rethreshold_cache
+        assert snapshot.rethreshold(0.005) == expected
+
+        loaded = []
+
+        def loader(inputs):
+            loaded.append(inputs)
+            time.sleep(0.1)
+            return load_network(inputs, parsePlain, 0.015)
+
+        async def session():
+            daemon = network_daemon(loader, [paths[0]], 0.015)
+            return await asyncio.gather(daemon.reload(), daemon.reload([paths[1]]), daemon.reload([paths[1]]), daemon.reload())
+
+        statuses = asyncio.run(session())
+        assert loaded == [[paths[0]], [paths[1]]]
+        assert [s['inputs'] for s in statuses] == [[paths[0]], [paths[1]], [paths[1]], [paths[0]]]
+        assert [s['clusters'] for s in statuses] == [2, 1, 1, 2]
+    finally:
+        for path in paths:
+            os.remove(path)
+
+
+def test_bad_requests():
+    ''' Malformed reload inputs are rejected with a 400; unexpected errors become a 500 '''
+    path = write_csv(first)
+    try:
+        async def session():
+            daemon = network_daemon(lambda inputs: load_network(inputs, parsePlain, 0.015), [path], 0.015)
+            await daemon.reload()
+            answers = [await daemon._safe_answer({'query': 'reload', 'inputs': 'new.csv'}),
+                       await daemon._safe_answer({'query': 'reload', 'inputs': [path, 3]}),
+                       await daemon._safe_answer(['status'])]
+            daemon.snapshot.status = lambda: 1 / 0
+            answers.append(await daemon._safe_answer({'query': 'status'}))
+            return answers
+
+        answers = asyncio.run(session())
+    finally:
+        os.remove(path)
+    assert [status for status, response in answers] == [400, 400, 400, 500]
+    assert 'list of file names' in answers[0][1]['error']
+    assert answers[3][1]['error'].startswith('ZeroDivisionError')
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+import multiprocessing
+import time
+
+from hivclustering.executor import executor, executor_for
+
+_offset = None
+
+
+def _set_offset(offset):
+    global _offset
+    _offset = offset
+
+
+def _shifted(value):
+    return value + _offset(value) if callable(_offset) else value + _offset
+
+
+def _square(value):
+    if value == 3:
+        time.sleep(0.2)  # one slow item must not hold up the rest
+    return value * value
+
+
+def _sizes(values):
+    return [len(values)] * len(values)
+
+
+_pickled = [0]
+
+
+class _counted_pickles:
+    ''' setup arguments that count how often they are pickled '''
+
+    def __init__(self, offset):
+        self.offset = offset
+
+    def __getstate__(self):
+        _pickled[0] += 1
+        return self.__dict__
+
+    def __call__(self, value):
+        return self.offset
+
+
+_started = []
+
+
+def _slow_first(value):
+    _started.append(value)
+    if value == 0:
+        time.sleep(0.5)
+    return value
+
+
+def test_executor_kinds_agree():
+    ''' Serial, thread and process executors return the same results, in input order '''
+    expected = [k * k for k in range(200)]
+    for kind in executor.kinds:
+        with executor(kind, 2) as workers:
+            assert list(workers.map(_square, range(200))) == expected
+            assert sorted(workers.map(_square, list(range(200)), ordered=False)) == expected
+            # the pool is reused
+            assert list(workers.map(_square, [5, 6], chunk_size=1)) == [25, 36]
+
+
+def test_executor_setup():
+    ''' Setup runs in each worker before its items, including setups which cannot be pickled '''
+    with executor('process', 2) as workers:
+        assert list(workers.map(_shifted, range(10), setup=_set_offset, setup_args=(100,))) == list(range(100, 110))
+        assert list(workers.map(_shifted, range(10), setup=_set_offset, setup_args=(lambda v: v,))) == list(range(0, 20, 2))
+        assert list(workers.map(_shifted, range(10), setup=_set_offset, setup_args=(7,))) == list(range(7, 17))
+
+
+def test_adaptive_chunks():
+    ''' Chunks start small and grow when items are cheap; the tail is split between workers '''
+    with executor('thread', 2, target_seconds=10.) as workers:
+        sizes = list(workers.map(_sizes, range(10000), batch=True, minimum_chunk=4))
+    assert sizes[0] == 4
+    assert max(sizes) > 4
+    assert len(sizes) == 10000
+
+    with executor_for(1) as workers:
+        assert workers.kind == 'serial'
+        assert list(workers.map(_sizes, range(10), batch=True, chunk_size=3)) == [3] * 9 + [1]
+
+
+def test_setup_sent_once_per_worker():
+    ''' Setup arguments go to each worker process about once per map call, not with every
+        chunk; arguments are never compared (numpy arrays could not be) '''
+    import numpy as np
+
+    with executor('process', 2) as workers:
+        assert list(workers.map(_shifted, range(100), setup=_set_offset, setup_args=(_counted_pickles(3),), chunk_size=1)) == list(range(3, 103))
+        # a chunk which reaches a worker before its setup is sent again with the arguments, so
+        # the count depends on scheduling; it must stay far below one per chunk (100)
+        assert _pickled[0] <= 25
+        shifted = list(workers.map(_shifted, range(5), setup=_set_offset, setup_args=(np.arange(5),), chunk_size=1))
+        assert [list(v) for v in shifted] == [list(k + np.arange(5)) for k in range(5)]
+
+
+def test_ordered_buffer_is_bounded():
+    ''' In input order, chunks that finish behind a slow one are held back only up to a bound '''
+    del _started[:]
+    with executor('thread', 2) as workers:
+        results = workers.map(_slow_first, range(200), chunk_size=1)
+        assert next(results) == 0
+        # the slow item blocked further submissions once 4 chunks per worker were waiting
+        assert len(_started) <= 4 * 2 + 2 * 2 + 1
+        assert list(results) == list(range(1, 200))
+
+
+def test_unpicklable_setup_without_default_fork():
+    ''' Setup arguments which cannot be pickled reach the workers whatever the default start method '''
+    default = multiprocessing.get_start_method(allow_none=True)
+    multiprocessing.set_start_method('spawn', force=True)
+    try:
+        with executor('process', 2) as workers:
+            assert list(workers.map(_shifted, range(10), setup=_set_offset, setup_args=(lambda v: v,))) == list(range(0, 20, 2))
+    finally:
+        multiprocessing.set_start_method(default, force=True)
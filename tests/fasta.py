@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import time
+
+from hivclustering.fasta import fasta_index, read_fasta
+
+
+def write_alignment(path, records, width=7):
+    with open(path, 'w') as fh:
+        for name, sequence in records:
+            print('>%s' % name, file=fh)
+            for k in range(0, len(sequence), width):
+                print(sequence[k:k + width], file=fh)
+
+
+def test_fasta_index():
+    ''' Random access, sidecar reuse, rebuilds and sub-alignments '''
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'alignment.fas')
+    records = [('seq%d|01012001' % k, ('ACGTRN-' * 5)[k:k + 20]) for k in range(5)]
+    write_alignment(path, records)
+
+    index = fasta_index(path)
+    # nothing is written next to the data unless an index file is asked for
+    assert os.listdir(directory) == ['alignment.fas']
+    assert len(index) == 5 and 'seq3|01012001' in index and 'seq9' not in index
+    assert all(index.sequence(name) == sequence for name, sequence in records)
+
+    sidecar = os.path.join(directory, 'alignment.idx')
+    assert fasta_index(path, sidecar).records == index.records
+    assert os.path.exists(sidecar)
+    assert fasta_index(path, sidecar)._load()
+    # an index file that cannot be written leaves the index in memory
+    assert fasta_index(path, os.path.join(directory, 'missing', 'alignment.idx')).records == index.records
+
+    records.append(('extra', 'ACGTACGT'))
+    time.sleep(0.01)
+    write_alignment(path, records)
+    index = fasta_index(path, sidecar)
+    assert 'extra' in index
+
+    subset = index.write_subset(['extra', 'seq1|01012001'], os.path.join(directory, 'subset.fas'))
+    assert list(read_fasta(subset)) == [records[-1], records[1]]
+
+    frequencies = fasta_index(subset).base_frequencies()
+    assert abs(sum(frequencies) - 1.) < 1e-12
+
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+
+
+def test_compressed_index_is_removed():
+    ''' The decompressed copy of a compressed alignment goes away when the index is closed '''
+    import gzip
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'alignment.fas.gz')
+    with gzip.open(path, 'wt') as fh:
+        fh.write('>a\nACGT\n>b\nACGA\n')
+
+    with fasta_index(path) as index:
+        copy = index.path
+        assert copy != path and os.path.exists(copy)
+        assert index.sequence('b') == 'ACGA'
+    assert not os.path.exists(copy)
+
+    os.remove(path)
+    os.rmdir(directory)
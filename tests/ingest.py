@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import os
+import random
+import tempfile
+
+from hivclustering import *
+from hivclustering.ingest import read_csv_in_parallel
+
+
+def make_distance_file(line_count=5000, id_count=200):
+    ''' Random AEH-style pairs with repeats, reversed pairs and annotated lines '''
+    random.seed(17)
+    ids = ["P%d|%02d01%d" % (random.randint(1, id_count // 3), random.randint(1, 12), random.choice([2000, 2001]))
+           for k in range(id_count)]
+    fh, path = tempfile.mkstemp(suffix='.csv')
+    with os.fdopen(fh, 'w') as out:
+        print("ID1,ID2,Distance", file=out)
+        for k in range(line_count):
+            extra = ",note" if random.random() < 0.01 else ""
+            print("%s,%s,%g%s" % (random.choice(ids), random.choice(ids), round(random.random() * 0.03, 4), extra), file=out)
+    return path
+
+
+def network_state(network, annotations):
+    nodes = [(n.id, n.degree, tuple(n.dates), tuple(sorted(n.attributes))) for n in network.nodes]
+    edges = [(repr(e), e.sequences, network.distances[e], tuple(sorted(e.attribute))) for e in network.edges]
+    return nodes, edges, list(network.sequence_ids.items()), sorted((repr(k), v) for k, v in annotations.items())
+
+
+def test_parallel_ingest_matches_serial():
+    ''' The parallel reader must build exactly the same network as the serial one '''
+    path = make_distance_file()
+    try:
+        for multiple_edges in (False, True):
+            serial = transmission_network(multiple_edges=multiple_edges)
+            with open(path) as fh:
+                serial_annotations = serial.read_from_csv_file(fh, parseAEH, 0.015, 'BULK')
+
+            parallel = transmission_network(multiple_edges=multiple_edges)
+            parallel_annotations = read_csv_in_parallel(parallel, path, parseAEH, 0.015, 'BULK', processes=2, block_size=2048)
+
+            assert network_state(serial, serial_annotations) == network_state(parallel, parallel_annotations)
+    finally:
+        os.remove(path)
+
+
+def test_compressed_input_matches_plain():
+    ''' .gz, .bz2 and .xz inputs are decompressed transparently '''
+    import shutil
+    from hivclustering.ingest import _openers
+
+    path = make_distance_file()
+    try:
+        plain = transmission_network()
+        plain.read_from_csv_file(path, parseAEH, 0.015)
+        for extension, opener in _openers.items():
+            with open(path, 'rb') as source, opener(path + extension, 'wb') as target:
+                shutil.copyfileobj(source, target)
+            compressed = transmission_network()
+            compressed.read_from_csv_file(path + extension, parseAEH, 0.015)
+            os.remove(path + extension)
+            assert network_state(plain, {}) == network_state(compressed, {})
+    finally:
+        os.remove(path)
+
+
+def test_read_from_process():
+    ''' Pairs are consumed from a running process; failures are reported '''
+    import sys
+
+    producer = "print('ID1,ID2,Distance')\nfor k in range(1, 2001): print('S%d,S%d,0.01' % (k, k + 1))"
+    network = transmission_network()
+    network.read_from_process([sys.executable, '-c', producer], parsePlain, 0.015)
+    assert len(network.edges) == 2000 and len(network.nodes) == 2001
+
+    failing = "import sys\nprint('ID1,ID2,Distance')\nprint('Bad sequence', file=sys.stderr)\nsys.exit(3)"
+    try:
+        transmission_network().read_from_process([sys.executable, '-c', failing], parsePlain)
+        assert False, 'a failing process must raise'
+    except RuntimeError as e:
+        assert 'Bad sequence' in str(e)
+
+
+def test_import_does_not_load_hyphy():
+    ''' HyPhy is only imported by the operations which need it '''
+    import subprocess
+    import sys
+
+    check = "import sys, hivclustering, hivclustering.networkbuild, hivclustering.ingest; sys.exit('hppy' in sys.modules)"
+    assert subprocess.run([sys.executable, '-c', check], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).returncode == 0
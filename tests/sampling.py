@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+import random
+
+from hivclustering import *
+from hivclustering.mtnetwork import _fenwick
+
+
+def test_fenwick_search():
+    ''' Fenwick tree searches find the item under a running sum, skipping zero weights '''
+    weights = [2., 0., 1., 3., 0., 0.5]
+    tree = _fenwick(weights)
+    running = 0.
+    for k, w in enumerate(weights):
+        if w > 0:
+            assert tree.search(running) == k
+            assert tree.search(running + w * 0.99) == k
+        running += w
+    assert tree.search(tree.total) == len(weights)
+
+    tree.add(1, 4.)
+    tree.add(3, -3.)
+    assert tree.total == sum(weights) + 1.
+    assert [tree.search(v) for v in (0., 1.9, 2., 5.9, 6., 6.9, 7.)] == [0, 0, 1, 1, 2, 2, 5]
+
+
+def test_biased_sample():
+    ''' Biased samples have the requested size, keep every edge between sampled nodes
+        and are reproducible with a seed '''
+    random.seed(2)
+    network = transmission_network()
+    network.create_a_pref_attachment_network(500)
+
+    subsets = [network.sample_from_network(120, node_sampling_bias=1.5, seed=9) for k in range(2)]
+    ids = [set(n.id for n in s.nodes) for s in subsets]
+    assert len(ids[0]) == 120 and ids[0] == ids[1]
+    # the sample starts from the last node of the network
+    assert list(network.nodes)[-1].id in ids[0]
+
+    expected = set((e.p1.id, e.p2.id) for e in network.edge_iterator() if e.p1.id in ids[0] and e.p2.id in ids[0])
+    assert set((e.p1.id, e.p2.id) for e in subsets[0].edge_iterator()) == expected
+
+    assert set(n.id for n in network.sample_from_network(120, seed=9).nodes) == \
+        set(n.id for n in network.sample_from_network(120, seed=9).nodes)
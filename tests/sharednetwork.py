@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import random
+import time
+
+from hivclustering import *
+from hivclustering.executor import executor
+from hivclustering.sharednetwork import _worker, attach_worker, detach_worker, worker_view
+
+
+def random_network():
+    random.seed(11)
+    ids = ["S%d" % k for k in range(200)]
+    network = transmission_network()
+    network.read_from_pairs([[a, b, round(random.random() * 0.02, 5)] for a, b in (random.sample(ids, 2) for k in range(250))], parsePlain, 0.015)
+    network.compute_clusters()
+    return network
+
+
+def _cluster_summary(cluster_id):
+    view = worker_view()
+    rows, adjacency = view.cluster_adjacency(cluster_id)
+    return cluster_id, sorted(view.id(r) for r in rows.tolist()), sum(len(a) for a in adjacency) // 2
+
+
+def _attached(value):
+    time.sleep(0.01)
+    return 'view' in _worker
+
+
+def test_shared_network_matches():
+    ''' Worker processes see the clusters, members and edges of the exported network '''
+    network = random_network()
+    clusters = network.retrieve_clusters(singletons=False)
+    expected = []
+    for cluster_id in sorted(clusters):
+        members = set(clusters[cluster_id])
+        edges = set((e.p1, e.p2) for e in network.edge_iterator() if e.visible and e.p1 in members)
+        expected.append((cluster_id, sorted(n.id for n in members), len(edges)))
+
+    with network.export_shared() as shared:
+        with executor('process', 2) as workers:
+            assert list(workers.map(_cluster_summary, list(sorted(clusters)), setup=attach_worker, setup_args=(shared.handle,))) == expected
+
+        view = shared.view()
+        nodes = list(network.nodes)
+        assert [view.id(k) for k in range(len(view))] == [n.id for n in nodes]
+        node = nodes[0]
+        assert set(view.id(r) for r in view.neighbors(view.index(node.id)).tolist()) == set(n.id for n in network.get_node_neighborhood(node.id))
+        try:
+            view.distances[0] = 1.
+            assert False, 'views must be read-only'
+        except ValueError:
+            pass
+        view.close()
+
+
+def test_workers_detach():
+    ''' Workers close their view of the block when the map call is over '''
+    network = random_network()
+    clusters = sorted(network.retrieve_clusters(singletons=False))
+    with executor('process', 2) as workers:
+        with network.export_shared() as shared:
+            assert len(list(workers.map(_cluster_summary, clusters, setup=attach_worker, setup_args=(shared.handle,),
+                                        teardown=detach_worker, chunk_size=1))) == len(clusters)
+        assert not any(workers.map(_attached, range(40), chunk_size=1))
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+import datetime
+import random
+import time
+
+import numpy as np
+
+from hivclustering import *
+from hivclustering.simulation import pref_attachment_forest
+
+
+def test_forest():
+    ''' Generated forests are reproducible, link nodes to earlier nodes of the same chain,
+        and never date a node before its parent '''
+    forest = pref_attachment_forest(5000, start_with=5, random_attachment=0.2, start_new_tree=0.02, tick_rate=7, poisson_mean=2, seed=3)
+    again = pref_attachment_forest(5000, start_with=5, random_attachment=0.2, start_new_tree=0.02, tick_rate=7, poisson_mean=2, seed=3)
+    for key in ('parents', 'chains', 'days'):
+        assert np.array_equal(forest[key], again[key])
+
+    parents, chains, days = forest['parents'], forest['chains'], forest['days']
+    linked = np.flatnonzero(parents >= 0)
+    roots = np.flatnonzero(parents < 0)
+    assert roots[:5].tolist() == list(range(5))
+    assert (parents[linked] < linked).all()
+    assert (chains[linked] == chains[parents[linked]]).all()
+    assert chains[roots].tolist() == list(range(len(roots)))
+    assert (days[linked] >= days[parents[linked]]).all()
+    assert (days[:5] == 0).all()
+
+
+def test_bulk_insert():
+    ''' insert_forest builds the network add_an_edge builds from AEH headers '''
+    start = datetime.datetime(1996, 1, 1)
+    network = transmission_network()
+    roots = network.generate_pref_attachment_network(400, start_with=3, random_attachment=0.1, start_new_tree=0.05,
+                                                     start_date=start, tick_rate=5, seed=8)
+
+    forest = pref_attachment_forest(400, 3, 0.1, 0.05, 5, None, seed=8)
+    header = dict((n.id, "%s|%s" % (n.id, time.strftime("%m%d%Y", n.dates[0]))) for n in network.nodes)
+    reference = transmission_network()
+    for k, parent in enumerate(forest['parents'].tolist()):
+        if parent < 0:
+            node_id = str(k + 1)
+            reference.insert_patient(node_id, network.has_node_with_id(node_id).dates[0], False, None)
+        else:
+            reference.add_an_edge(header[str(k + 1)], header[str(parent + 1)], 1, header_parser=parseAEH)
+
+    assert sorted(n.id for n in roots) == sorted(str(k + 1) for k in np.flatnonzero(forest['parents'] < 0).tolist())
+    assert sorted((n.id, n.dates, n.degree) for n in network.nodes) == sorted((n.id, n.dates, n.degree) for n in reference.nodes)
+    describe = lambda nw: sorted((e.p1.id, e.p2.id, e.date1, e.date2, e.sequences, nw.distances[e]) for e in nw.edge_iterator())
+    assert describe(network) == describe(reference)
+    assert network.sequence_ids == reference.sequence_ids
+
+
+def _random_draws(job):
+    return {'draws': [random.random() for k in range(20)]}
+
+
+def test_replicates_resume():
+    ''' Replicates give the same results serially and on threads, and an interrupted sweep
+        resumes from its checkpoint '''
+    import os
+    import tempfile
+    from hivclustering.executor import executor
+    from hivclustering.simulation import job_seed, run_replicates, replicate_table
+
+    jobs = [{'size': size, 'bias': 0.5, 'sample': 60, 'replicate': r} for size in (100, 150) for r in range(4)]
+    with executor('serial') as serial:
+        expected = dict((job['seed'], result) for job, result in run_replicates(jobs, master_seed=7, executor=serial))
+    assert len(set(expected)) == len(jobs)
+
+    fh, checkpoint = tempfile.mkstemp(suffix='.jsonl')
+    os.close(fh)
+    os.remove(checkpoint)
+    try:
+        with executor('thread', 2) as threads:
+            for count, (job, result) in enumerate(run_replicates(jobs, master_seed=7, checkpoint=checkpoint, executor=threads)):
+                if count == 2:
+                    break
+            with open(checkpoint) as fh:
+                recorded = len(fh.readlines())
+            assert 3 <= recorded < len(jobs)
+
+            table = replicate_table(('size', 'bias'))
+            for job, result in run_replicates(jobs, master_seed=7, checkpoint=checkpoint, executor=threads):
+                assert expected[job['seed']] == result
+                table.add(job, result)
+        with open(checkpoint) as fh:
+            assert len(fh.readlines()) == len(jobs)
+    finally:
+        os.remove(checkpoint)
+
+    rows = list(table.rows())
+    assert [(row['size'], row['replicates']) for row in rows] == [(100, 4), (150, 4)]
+    edges = [expected[job_seed(7, job)]['edges'] for job in jobs[:4]]
+    assert abs(rows[0]['edges mean'] - sum(edges) / 4) < 1e-12
+
+
+def test_replicates_torn_checkpoint_and_threads():
+    ''' A checkpoint line cut short by an interruption is dropped on resume, and jobs drawing
+        from the random module get the same draws serially and with a thread executor '''
+    import os
+    import json
+    import tempfile
+    from hivclustering.executor import executor
+    from hivclustering.simulation import run_replicates
+
+    jobs = [{'replicate': r} for r in range(12)]
+    with executor('serial') as serial:
+        expected = dict((job['replicate'], result) for job, result in run_replicates(jobs, _random_draws, 3, executor=serial))
+    with executor('thread', 3) as threads:
+        assert dict((job['replicate'], result) for job, result in run_replicates(jobs, _random_draws, 3, executor=threads)) == expected
+
+    fh, checkpoint = tempfile.mkstemp(suffix='.jsonl')
+    os.close(fh)
+    os.remove(checkpoint)
+    try:
+        with executor('serial') as serial:
+            for count, (job, result) in enumerate(run_replicates(jobs, _random_draws, 3, checkpoint, serial)):
+                if count == 4:
+                    break
+            with open(checkpoint, 'a') as out:
+                out.write('{"job": {"replicate": 2')
+            resumed = dict((job['replicate'], result) for job, result in run_replicates(jobs, _random_draws, 3, checkpoint, serial))
+        assert resumed == expected
+        with open(checkpoint) as fh:
+            records = [json.loads(line) for line in fh]
+        assert sorted(r['job']['replicate'] for r in records) == list(range(12))
+    finally:
+        os.remove(checkpoint)
+
+
+def test_sequence_chains():
+    ''' Chains evolve under the model of SimulateSequence.bf: hidden nodes and sampled tips,
+        the expected number of substitutions, and per-chain seeds '''
+    from hivclustering.simulation import default_model, simulate_chains
+
+    model = default_model()
+    assert len(model.class_rates) == 3 and abs(model.frequencies.sum() - 1) < 1e-12
+    p1, p2 = model.transition([0.1, 0.25])
+    assert np.allclose(p1 @ p2, model.transition(0.35))
+    assert np.allclose(model.frequencies @ p1, model.frequencies)
+    # one expected substitution per site per unit of branch length
+    assert abs((model.frequencies * (1 - np.diag(model.transition(1e-6)))).sum() / 1e-6 - 1) < 1e-4
+
+    rng = np.random.default_rng(4)
+    founder = ''.join('ACGT'[k] for k in rng.integers(0, 4, 2000))
+    # 2 descends from 1 along a branch of 0.2; 3 descends from 2's hidden node and is sampled 0.1 later
+    tree = [[1, -1, 0, 0.], [2, 1, 0.2, 0.], [3, 2, 0., 0.1]]
+    chains = [(founder, tree)] * 40
+    results = simulate_chains(chains, list(range(40)))
+    assert all(r[1] == founder for r in results)
+
+    states = 'ACGT'
+    classes = model.classes_for(len(founder))
+    for node, length in ((2, 0.2), (3, 0.3)):
+        stay = np.diagonal(model.transition(np.multiply.outer(model.class_rates, length)), axis1=1, axis2=2)
+        expected = sum(1 - stay[c, states.index(f)] for c, f in zip(classes.tolist(), founder)) * len(chains)
+        observed = sum(sum(a != b for a, b in zip(r[node], founder)) for r in results)
+        assert abs(observed - expected) < 5 * expected ** 0.5
+
+    assert simulate_chains(chains[:1], [7]) == simulate_chains([(founder[:500], tree), chains[0]], [1, 7])[1:]
+
+
+def test_chain_pairs():
+    ''' Transmission chains are walked depth first, as by recursion, and clustered, on chains
+        deeper than the recursion limit '''
+    import sys
+
+    def recursive(network, root, seen, pairs):
+        for n in network.adjacency_list.get(root, ()):
+            if n not in seen:
+                seen.add(n)
+                pairs.append([root, n])
+                recursive(network, n, seen, pairs)
+
+    network = transmission_network()
+    roots = network.generate_pref_attachment_network(300, start_with=4, random_attachment=0.3, start_new_tree=0.05,
+                                                     start_date=datetime.datetime(2000, 1, 1), tick_rate=3, seed=5)
+    network.compute_adjacency()
+    seen, expected = set(roots), []
+    for root in roots:
+        recursive(network, root, seen, expected)
+    walked, pairs = set(roots), []
+    for root in roots:
+        network.construct_cluster_representation(root, walked, pairs)
+    assert pairs == expected and walked == seen
+
+    path = transmission_network()
+    path.insert_forest(np.arange(-1, sys.getrecursionlimit() * 2))
+    path.compute_adjacency()
+    root = path.has_node_with_id('1')
+    pairs = []
+    path.construct_cluster_representation(root, set([root]), pairs)
+    assert [(a.id, b.id) for a, b in pairs] == [(str(k), str(k + 1)) for k in range(1, sys.getrecursionlimit() * 2 + 1)]
+    # and clustered, as one cluster, without raising the recursion limit
+    path.compute_clusters()
+    assert set(n.cluster_id for n in path.nodes) == set([1])
+
+
+def test_transition_cache_threads():
+    ''' Threads sharing a model get the right tables while others empty its bounded cache '''
+    import threading
+    from hivclustering import simulation
+    from hivclustering.simulation import gtr_model
+
+    import sys
+
+    model = gtr_model()
+    cached_lengths = simulation._cached_lengths
+    simulation._cached_lengths = 16
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)  # switch threads often, so that the cache is emptied under others
+    errors = []
+
+    def work(offset):
+        try:
+            rng = np.random.default_rng(offset)
+            for k in range(200):
+                lengths = rng.integers(1, 200, 12) * 1e-3
+                tables = model.cumulative(lengths.tolist())
+                assert np.allclose(tables[:, 1], np.cumsum(model.transition(lengths * model.class_rates[1]), axis=-1))
+        except Exception as e:
+            errors.append(e)
+
+    try:
+        threads = [threading.Thread(target=work, args=(k,)) for k in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        simulation._cached_lengths = cached_lengths
+        sys.setswitchinterval(switch_interval)
+    assert not errors, errors
+    assert len(model._cumulative) <= 16 + 4 * 12
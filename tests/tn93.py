@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import random
+from math import log
+
+from hivclustering import *
+from hivclustering.tn93 import tn93_pairs
+
+
+def reference_tn93(s1, s2):
+    ''' Textbook TN93 with base frequencies from the pair '''
+    counts = dict((c, 0) for c in 'ACGT')
+    p1 = p2 = q = 0
+    for a, b in zip(s1, s2):
+        counts[a] += 1
+        counts[b] += 1
+        if a != b:
+            if set((a, b)) == set('AG'):
+                p1 += 1
+            elif set((a, b)) == set('CT'):
+                p2 += 1
+            else:
+                q += 1
+    n = float(len(s1))
+    p1, p2, q = p1 / n, p2 / n, q / n
+    a, c, g, t = [counts[k] / (2 * n) for k in 'ACGT']
+    r, y = a + g, c + t
+    return (-2 * a * g / r * log(1 - r / (2 * a * g) * p1 - q / (2 * r)) - 2 * c * t / y * log(1 - y / (2 * c * t) * p2 - q / (2 * y))
+            - 2 * (r * y - a * g * y / r - c * t * r / y) * log(1 - q / (2 * r * y)))
+
+
+def simulated_alignment(count=120, length=400):
+    random.seed(11)
+    root = [random.choice('ACGT') for k in range(length)]
+    sequences = []
+    for k in range(count):
+        sequence = list(root)
+        for m in range(random.randint(1, 30)):
+            sequence[random.randrange(length)] = random.choice('ACGT')
+        sequences.append(''.join(sequence))
+    return ['S%d' % k for k in range(count)], sequences
+
+
+def test_tn93_distances():
+    ''' Distances match the textbook formula and threshold pruning loses no pairs '''
+    names, sequences = simulated_alignment()
+    all_pairs = dict(((a, b), d) for a, b, d in tn93_pairs(names, sequences, None, processes=1))
+    assert len(all_pairs) == len(names) * (len(names) - 1) // 2
+    for (a, b), d in all_pairs.items():
+        assert abs(d - reference_tn93(sequences[int(a[1:])], sequences[int(b[1:])])) < 1e-10
+
+    within = set(k for k, d in all_pairs.items() if d <= 0.02)
+    assert within == set((a, b) for a, b, d in tn93_pairs(names, sequences, 0.02, processes=2))
+
+
+def test_tn93_network():
+    ''' Pairs feed transmission_network without a CSV round-trip '''
+    names, sequences = simulated_alignment()
+    network = transmission_network()
+    network.read_from_pairs(tn93_pairs(names, sequences, 0.02), parsePlain, 0.02)
+    assert len(network.edges) == len([d for a, b, d in tn93_pairs(names, sequences, 0.02) if d <= 0.02])
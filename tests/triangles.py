@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+import itertools
+import random
+
+from hivclustering import *
+from hivclustering.triangles import adjacency_csr, triangles, triangle_counts, clustering_values, transitivity
+
+
+def test_each_triangle_once():
+    ''' Oriented enumeration finds every triangle exactly once, in batches of any size '''
+    random.seed(5)
+    node_count = 60
+    pairs = set(tuple(sorted(random.sample(range(node_count), 2))) for k in range(400))
+    linked = set(pairs) | set((b, a) for a, b in pairs)
+    expected = set(t for t in itertools.combinations(range(node_count), 3)
+                   if (t[0], t[1]) in linked and (t[0], t[2]) in linked and (t[1], t[2]) in linked)
+
+    indptr, indices = adjacency_csr(node_count, [p[0] for p in pairs], [p[1] for p in pairs])
+    for batch in (1, 7, None):
+        found = [tuple(sorted(t)) for a, b, c in triangles(indptr, indices, batch) for t in zip(a.tolist(), b.tolist(), c.tolist())]
+        assert len(found) == len(set(found))
+        assert set(found) == expected
+
+    counts = triangle_counts(indptr, indices)
+    assert counts.tolist() == [sum(1 for t in expected if k in t) for k in range(node_count)]
+    degrees = indptr[1:] - indptr[:-1]
+    values = clustering_values(counts, degrees)
+    for k in range(node_count):
+        d = int(degrees[k])
+        assert abs(values[k] - (2 * counts[k] / d / (d - 1) if d > 1 else 0.)) < 1e-12
+    assert abs(transitivity(counts, degrees) - 3 * len(expected) / sum(int(d) * (int(d) - 1) / 2 for d in degrees)) < 1e-12
+
+
+def test_network_statistics():
+    ''' Triangle counts and clustering coefficients of a small network '''
+    network = transmission_network()
+    # a square with one diagonal, and a pendant node
+    for a, b in [('A', 'B'), ('B', 'C'), ('C', 'D'), ('D', 'A'), ('A', 'C'), ('D', 'E')]:
+        network.add_an_edge(a, b, 0.01, parsePlain)
+    by_node, network_transitivity = network.triangle_statistics()
+    by_id = dict((n.id, v) for n, v in by_node.items())
+    assert by_id == {'A': (2, 2 / 3), 'B': (1, 1.), 'C': (2, 2 / 3), 'D': (1, 1 / 3), 'E': (0, 0.)}
+    # 2 triangles; 3 + 1 + 3 + 3 connected triples
+    assert abs(network_transitivity - 6 / 10) < 1e-12
+    assert dict((n.id, v) for n, v in network.clustering_coefficients().items()) == {'A': 2 / 3, 'B': 1., 'C': 2 / 3, 'D': 1 / 3}
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+import io
+import json
+import random
+
+from hivclustering import *
+from hivclustering.networkbuild import write_network_json
+
+
+def make_network(node_count=300, edge_count=600):
+    random.seed(11)
+    network = transmission_network()
+    for k in range(edge_count):
+        p1, p2 = random.sample(range(node_count), 2)
+        network.add_an_edge("S%d|%02d01%d" % (p1, 1 + p1 % 12, 2000 + p1 % 3), "S%d|%02d01%d" % (p2, 1 + p2 % 12, 2000 + p2 % 3),
+                            round(random.random() * 0.015, 5), parseAEH)
+    network.compute_clusters()
+    return network
+
+
+def assembled_json(network, network_info):
+    ''' the network JSON as hivnetworkcsv used to build it, in memory '''
+    network_info = dict(network_info)
+    nodes = []
+    node_idx = {}
+    triangles = network.triangle_statistics()[0]
+    for idx, cluster in network.retrieve_clusters().items():
+        for n in cluster:
+            if idx is not None:
+                nodes.append({'id': n.id, 'cluster': idx, 'attributes': list(n.attributes), 'edi': n.get_edi(), 'baseline': n.get_baseline_date(True),
+                              'triangles': triangles[n][0], 'clustering': triangles[n][1]})
+            node_idx[n] = len(nodes) - 1
+    edges = []
+    for e in network.reduce_edge_set():
+        if e.visible:
+            edge_source = e.compute_direction()
+            if edge_source is not None:
+                src, rcp, directed = node_idx[edge_source], node_idx[e.p2 if edge_source != e.p2 else e.p1], True
+            else:
+                src, rcp, directed = node_idx[e.p1], node_idx[e.p2], False
+            edges.append({'source': src, 'target': rcp, 'directed': directed, 'length': network.distances[e],
+                          'support': e.edge_reject_p, 'removed': not e.has_support(), 'sequences': e.sequences, 'attributes': list(e.attribute)})
+    network_info['Nodes'] = nodes
+    network_info['Edges'] = edges
+    return json.dumps(network_info, indent=4, sort_keys=True) + "\n"
+
+
+def test_streamed_json_matches_assembled():
+    ''' The streaming JSON writer produces the same bytes as json.dumps of the whole object '''
+    network = make_network()
+    info = {'Network Summary': {'Edges': len(network.edges), 'Nodes': len(network.nodes)},
+            'Cluster sizes': [len(c) for c in network.retrieve_clusters().values()],
+            'Settings': {'threshold': 0.015, 'contaminant-ids': []}}
+
+    for network_info in (info, {}):
+        out = io.StringIO()
+        write_network_json(network, network_info, out)
+        assert out.getvalue() == assembled_json(network, network_info)
+
+        out = io.StringIO()
+        write_network_json(network, network_info, out, compact=True)
+        assert json.loads(out.getvalue()) == json.loads(assembled_json(network, network_info))
+        assert "\n" not in out.getvalue().rstrip("\n")
+
+    empty = transmission_network()
+    out = io.StringIO()
+    write_network_json(empty, info, out)
+    assert out.getvalue() == assembled_json(empty, info)
+
+
+def unbuffered_writers():
+    ''' the writers as they were before output went through _buffered_sink, writing to file directly '''
+
+    def generate_dot(network, file, year_vis=None, reduce_edges=True, attribute_color=None):
+        if network.adjacency_list is None:
+            network.compute_adjacency()
+        file.write('digraph G { overlap="voronoi";\n outputorder = edgesfirst;\nnode[style=filled];\n')
+        nodes_drawn = set()
+        directed = {'undirected': 0, 'directed': 0}
+        for edge in network.edge_iterator() if reduce_edges == False else network.reduce_edge_set():
+            if edge.visible:
+                if edge.p1 not in nodes_drawn:
+                    nodes_drawn.add(edge.p1)
+                    file.write(edge.p1.get_dot_string(year_vis))
+                if edge.p2 not in nodes_drawn:
+                    nodes_drawn.add(edge.p2)
+                    file.write(edge.p2.get_dot_string(year_vis))
+                if isinstance(edge.compute_direction(), type(None)):
+                    directed['undirected'] += 1
+                else:
+                    directed['directed'] += 1
+                edge_attr = edge.direction()
+                if year_vis is not None:
+                    if edge.check_date(year_vis) == False:
+                        file.write('%s [style="invis" arrowhead = "%s"];\n' % (edge_attr[0], edge_attr[1]))
+                        continue
+                if attribute_color is not None:
+                    color = attribute_color(edge)
+                    if color is not None:
+                        file.write('%s [style="bold" label = "%s" arrowhead = "%s" color = "%s"];\n' %
+                                   (edge_attr[0], edge.label(), edge_attr[1], color))
+                        continue
+                file.write('%s [style="bold" label = "%s" arrowhead = "%s"];\n' % (edge_attr[0], edge.label(), edge_attr[1]))
+        file.write("\n};")
+        return directed
+
+    def generate_delimited(network, file, year_vis=None, reduce_edges=True):
+        if network.adjacency_list is None:
+            network.compute_adjacency()
+        file.write("%s\n" % ','.join(['ID1', 'ID2', 'Linktype']))
+        for edge in network.edge_iterator() if reduce_edges == False else network.reduce_edge_set():
+            if edge.visible:
+                edge_attr = edge.direction(do_csv=True)
+                if year_vis is not None:
+                    if edge.check_date(year_vis) == False:
+                        continue
+                file.write('%s\n' % (edge_attr[0]))
+
+    def generate_csv(network, file):
+        file.write("ID1,ID2,Distance")
+        for edge in network.edge_iterator():
+            if edge.visible:
+                file.write("%s,%s,%g\n" % (edge.p1.id, edge.p2.id, network.distances[edge]))
+
+    def write_clusters(network, file):
+        file.write("SequenceID,ClusterID\n")
+        for node in network.nodes:
+            if node.cluster_id is not None:
+                for d in node.dates:
+                    try:
+                        file.write("%s,%d\n" % (network.sequence_ids[network.make_sequence_key(node.id, d)], node.cluster_id))
+                        break
+                    except KeyError:
+                        pass
+
+    def spool_pairwise_distances(network, file, baseline=False):
+        file.write(','.join(['Seq1', 'Seq2', 'Distance']))
+        file.write('\n')
+        for ext_edge in network.edge_iterator():
+            if baseline:
+                if ext_edge.p1.get_baseline_date(True) != ext_edge.date1 or ext_edge.p2.get_baseline_date(True) != ext_edge.date2:
+                    continue
+            file.write(','.join([ext_edge.p1.id, ext_edge.p2.id, str(network.distances[ext_edge])]))
+            file.write('\n')
+
+    return {'generate_csv': generate_csv, 'generate_dot': generate_dot, 'generate_delimited': generate_delimited,
+            'write_clusters': write_clusters, 'spool_pairwise_distances': spool_pairwise_distances}
+
+
+def test_buffered_writers_match_unbuffered():
+    ''' generate_dot, generate_delimited, write_clusters and spool_pairwise_distances write
+        the same bytes as the unbuffered writers (for generate_csv, see test_generated_csv_header) '''
+    network = make_network()
+    # a patient with two sequences, so that some edges are not between baseline sequences
+    network.add_an_edge("S0|01012005", "S1|02012005", 0.004, parseAEH)
+    network.compute_clusters()
+    network.compute_adjacency()
+
+    color = lambda e: 'red' if network.distances[e] < 0.005 else None
+    calls = [('generate_dot', {}), ('generate_dot', {'reduce_edges': False, 'attribute_color': color}),
+             ('generate_dot', {'year_vis': 2001}), ('generate_delimited', {}),
+             ('generate_delimited', {'reduce_edges': False, 'year_vis': 2001}), ('write_clusters', {}),
+             ('spool_pairwise_distances', {}), ('spool_pairwise_distances', {'baseline': True})]
+
+    reference = unbuffered_writers()
+    for name, kwargs in calls:
+        expected, out = io.StringIO(), io.StringIO()
+        expected_result = reference[name](network, expected, **kwargs)
+        assert getattr(network, name)(out, **kwargs) == expected_result
+        assert out.getvalue() == expected.getvalue(), (name, kwargs)
+        assert len(out.getvalue()) > 100
+
+
+def test_stage_profiler():
+    ''' Stages are recorded (nested by path) only while a profiler is installed '''
+    from hivclustering import profiling
+
+    with profiling.stage('unprofiled') as counts:
+        counts['items'] = 1
+
+    profiler = profiling.stage_profiler()
+    previous = profiling.set_profiler(profiler)
+    try:
+        with profiling.stage('build') as counts:
+            network = make_network()
+            with profiling.stage('clusters') as inner:
+                inner['clusters'] = len(network.retrieve_clusters())
+            counts.update(nodes=len(network.nodes), edges=len(network.edges))
+    finally:
+        profiling.set_profiler(previous)
+
+    out = io.StringIO()
+    profiler.write(out)
+    trace = json.loads(out.getvalue())
+    assert [s['stage'] for s in trace['stages']] == ['build', 'build/clusters']
+    build = trace['stages'][0]
+    assert build['counts'] == {'nodes': len(network.nodes), 'edges': len(network.edges)}
+    assert build['wall'] >= trace['stages'][1]['wall'] >= 0 and build['cpu'] >= 0
+    if build['process peak rss'] is not None:
+        assert build['process peak rss'] >= build['peak rss increase'] >= trace['stages'][1]['peak rss increase'] >= 0
+
+
+def test_generated_csv_header():
+    ''' generate_csv ends its header line, so that its output (header included) is a valid
+        network CSV; the edge lines are those the unbuffered writer wrote '''
+    network = make_network()
+    out, unbuffered = io.StringIO(), io.StringIO()
+    network.generate_csv(out)
+    unbuffered_writers()['generate_csv'](network, unbuffered)
+    assert out.getvalue() == unbuffered.getvalue().replace("ID1,ID2,Distance", "ID1,ID2,Distance\n", 1)
+
+    out.seek(0)
+    copy = transmission_network()
+    copy.read_from_csv_file(out, parsePlain)
+    assert len(copy.edges) == len(network.edges)
+    assert sorted((e.p1.id, e.p2.id) for e in copy.edges) == sorted((e.p1.id, e.p2.id) for e in network.edges)